@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+
+# asyncio based engine for processing work items. This module requires Python 3 & the aiohttp package and is only
+# imported when '--engine asyncio' is specified, so that the threaded engine continues to work on Python 2.7.
+#
+# The work items & results are identical to the threaded workers in copy-to-adls.py, copy-acls.py & identity-mapper.py.
+# All requests run on a single event loop, with concurrency bounded by a semaphore rather than the number of threads.
+
+import asyncio, contextvars, logging, json, datetime, hashlib, base64, time, collections, queue, threading
+from adls_copy_utils import AdlsCopyUtils, CopyJournal, ConcurrencyController, DeadLetterFile, ThrottledError, VerificationManifest, IdentityResolver
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+log = logging.getLogger(__name__)
+
+# Maximum number of work items handed from the (blocking) inventory stream to the event loop per hop to the executor
+FEED_BATCH_SIZE = 1000
+
+# Number of requests made by the current work item. Sub-tasks started by the item inherit the same counter.
+_item_requests = contextvars.ContextVar("item_requests", default=None)
+
+async def _countRequest(session, context, params):
+    counter = _item_requests.get()
+    if counter is not None:
+        counter[0] += 1
+
+async def _startRequest(session, context, params):
+    context.start_time = time.time()
+
+async def _recordMetrics(session, context, params):
+    if AdlsCopyUtils.metrics:
+        # As with the threaded engine, latency is measured to the arrival of the response headers
+        AdlsCopyUtils.metrics.recordRequest(params.method, str(params.url), params.response.status, time.time() - context.start_time, 
+            params.headers.get("Content-Length"), params.response.headers.get("Content-Length"))
+
+def countRequests():
+    # Starts counting the requests made by the current work item. Returns a single element list holding the count.
+    counter = [0]
+    _item_requests.set(counter)
+    return counter
+
+class AsyncWorkQueue:
+    def __init__(self, session, target, args, max_parallelism, max_retries, dead_letters, on_abandoned=None):
+        self.session = session
+        self.target = target
+        self.args = args
+        # Called with the same arguments as the target when an item is abandoned
+        self.on_abandoned = on_abandoned
+        self.slots = asyncio.Semaphore(max_parallelism)
+        # Limits the number of items in flight below max_parallelism when the service is throttling us
+        self.concurrency = ConcurrencyController(max_parallelism)
+        # Futures of the items waiting for the concurrency limit, woken in order as items release it
+        self.limit_waiters = collections.deque()
+        self.max_retries = max_retries
+        self.dead_letters = dead_letters
+        self.pending = set()
+        self.abandoned = 0
+
+    async def acquire(self):
+        # Wait for the concurrency limit before taking a slot. Items waiting for the limit would otherwise hold the 
+        # slots that the ranges of the running items (which hold the limit) need, & neither could make progress.
+        while not self.concurrency.tryAcquire():
+            waiter = asyncio.get_event_loop().create_future()
+            self.limit_waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Woken, but cancelled before it could take the limit - pass the wake up on
+                    self._wakeLimitWaiters()
+                raise
+        await self.slots.acquire()
+
+    def release(self, success):
+        self.concurrency.release(success=success)
+        self.slots.release()
+        self._wakeLimitWaiters()
+
+    def _wakeLimitWaiters(self):
+        # Wakes as many waiting items as the (possibly changed) limit now allows
+        available = int(self.concurrency.limit) - self.concurrency.active
+        while available > 0 and self.limit_waiters:
+            waiter = self.limit_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                available -= 1
+
+    def start(self, item):
+        # The caller must have acquired a slot for the item
+        task = asyncio.ensure_future(_processItem(self, item))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    def addItem(self, item):
+        # Queues an item generated by a worker. This never blocks the worker - the item waits for its own slot.
+        async def queueItem():
+            await self.acquire()
+            self.start(item)
+        task = asyncio.ensure_future(queueItem())
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def drain(self):
+        while self.pending:
+            await asyncio.wait(list(self.pending))
+
+    async def run(self, coroutine):
+        async with self.slots:
+            return await coroutine
+
+    async def gather(self, coroutines):
+        # Called from within a work item that holds a slot. The slot is given up while waiting, otherwise parents
+        # holding every slot would starve their own sub-tasks. If any of the coroutines fails, the others are 
+        # cancelled & have finished before the error is raised, so none of them outlive the attempt.
+        self.slots.release()
+        tasks = [asyncio.ensure_future(self.run(coroutine)) for coroutine in coroutines]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            unfinished = [task for task in tasks if not task.done()]
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                await asyncio.wait(unfinished)
+            await self.slots.acquire()
+        for task in tasks:
+            if not task.cancelled() and task.exception():
+                raise task.exception()
+        return [task.result() for task in tasks]
+
+def processWorkQueue(target, args, work_items, max_parallelism, max_retries=AdlsCopyUtils.DEFAULT_MAX_RETRIES, dead_letter_file=None, on_abandoned=None):
+    if aiohttp is None:
+        raise ImportError("The asyncio engine requires the aiohttp package. Install it using: pip install aiohttp")
+    dead_letters = DeadLetterFile(dead_letter_file) if dead_letter_file else None
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_processWorkQueue(target, args, work_items, max_parallelism, max_retries, dead_letters, on_abandoned))
+    finally:
+        loop.close()
+        if dead_letters:
+            dead_letters.close()
+
+class InventoryFeeder:
+    # Reads the inventory stream on its own thread. Each batch holds whatever has been read so far, rather than waiting
+    # for a full batch, so items are never held back by a stream that blocks until earlier items have been processed
+    # (eg. DirectoryTracker waiting for directories to be created).
+    END = object()
+
+    def __init__(self, work_items):
+        self.items = queue.Queue(FEED_BATCH_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._feed, args=(work_items,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _feed(self, work_items):
+        try:
+            for item in work_items:
+                self.items.put(item)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.items.put(self.END)
+
+    def nextBatch(self):
+        # Blocks until at least 1 item has been read. Returns an empty batch at the end of the stream.
+        batch = []
+        item = self.items.get()
+        while item is not self.END:
+            batch.append(item)
+            if len(batch) >= FEED_BATCH_SIZE:
+                return batch
+            try:
+                item = self.items.get_nowait()
+            except queue.Empty:
+                return batch
+        # Leave the end marker for the next batch
+        self.items.put(self.END)
+        if self.error and not batch:
+            raise self.error
+        return batch
+
+async def _processWorkQueue(target, args, work_items, max_parallelism, max_retries, dead_letters, on_abandoned):
+    log.debug("Processing work items using %d concurrent requests", max_parallelism)
+    loop = asyncio.get_event_loop()
+    # Each work item may have a source & destination request in flight at the same time
+    connector = aiohttp.TCPConnector(limit=max_parallelism * 2)
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_startRequest)
+    trace_config.on_request_end.append(_countRequest)
+    trace_config.on_request_end.append(_recordMetrics)
+    async with aiohttp.ClientSession(connector=connector, trace_configs=[trace_config]) as session:
+        work_queue = AsyncWorkQueue(session, target, args, max_parallelism, max_retries, dead_letters, on_abandoned)
+        metrics = AdlsCopyUtils.metrics
+        if metrics:
+            metrics.trackQueue(lambda: max(len(work_queue.pending) - work_queue.concurrency.active, 0), lambda: work_queue.concurrency.active, lambda: int(work_queue.concurrency.limit))
+        # The inventory stream performs blocking I/O, so it is consumed off the event loop
+        feeder = InventoryFeeder(work_items)
+        item_count = 0
+        while True:
+            batch = await loop.run_in_executor(None, feeder.nextBatch)
+            if not batch:
+                break
+            for item in batch:
+                # Only start a new item when a slot is free, so that we only ever hold a window of items in memory
+                await work_queue.acquire()
+                work_queue.start(item)
+            item_count += len(batch)
+        log.debug("All %d work items queued", item_count)
+        if metrics:
+            metrics.queueComplete(item_count)
+        await work_queue.drain()
+        log.debug("Queue has been drained")
+    if metrics:
+        metrics.report()
+    return {"items": item_count, "abandoned": work_queue.abandoned}
+
+async def _processItem(work_queue, item):
+    attempt = 0
+    success = False
+    metrics = AdlsCopyUtils.metrics
+    try:
+        while True:
+            try:
+                if metrics:
+                    metrics.increment("items", state="started")
+                await work_queue.target(work_queue, item, *work_queue.args)
+                success = True
+                if metrics:
+                    metrics.increment("items", state="completed")
+                return
+            except (IOError, aiohttp.ClientError) as e:
+                attempt += 1
+                if metrics:
+                    metrics.increment("items", state="failed")
+                if isinstance(e, ThrottledError):
+                    work_queue.concurrency.throttled()
+                if not AdlsCopyUtils.isRetriable(e) or attempt > work_queue.max_retries:
+                    log.warning("Abandoning item after %d attempts: %s. Details: %s", attempt, item, e.args)
+                    work_queue.abandoned += 1
+                    if metrics:
+                        metrics.increment("items", state="abandoned")
+                    if work_queue.on_abandoned:
+                        work_queue.on_abandoned(work_queue, item, *work_queue.args)
+                    if work_queue.dead_letters:
+                        work_queue.dead_letters.write(item, e)
+                    return
+                delay = AdlsCopyUtils.getRetryDelay(e, attempt)
+                log.debug("Retrying item in %.1fs (attempt %d of %d). Details: %s", delay, attempt, work_queue.max_retries, e.args)
+                await asyncio.sleep(delay)
+    finally:
+        work_queue.release(success)
+
+async def _raiseForResponse(response):
+    if response.ok:
+        return
+    # The dfs endpoint returns JSON errors, but the blob endpoint returns XML
+    details = await response.text()
+    try:
+        details = json.loads(details)
+    except ValueError:
+        pass
+    raise AdlsCopyUtils.createResponseError(response.status, response.headers, details)
+
+async def _mapIdentities(identity_map, function, *args):
+    # Identities missing from the map are looked up in the directory, which blocks until their batch has been
+    # resolved. That happens on an executor thread, so that a lookup doesn't stall every other request.
+    if isinstance(identity_map, IdentityResolver) and identity_map.directory:
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+    return function(*args)
+
+async def _add_identity_header(headers, identity_type, identity, header, identity_map):
+    mapped_identity = await _mapIdentities(identity_map, AdlsCopyUtils.lookupIdentity, identity_type, identity, identity_map)
+    if mapped_identity:
+        headers[header] = mapped_identity
+
+async def create_adls_resource(session, account, container, resource_type, resource, token_handler, identity_map, inherited_group=None):
+    resource_uri = "{0}/{1}/{2}?resource={3}".format(AdlsCopyUtils.dfsEndpoint(account), container, resource["name"], resource_type)
+    log.debug(resource_uri)
+    async with session.put(resource_uri,
+            headers = {
+                "x-ms-version": AdlsCopyUtils.ADLS_REST_VERSION,
+                "content-length": "0",
+                "x-ms-permissions": resource["permissions"]["permissions"],
+                "x-ms-umask": "0000",
+                "Authorization": token_handler.checkAccessToken()
+            }) as create_request:
+        await _raiseForResponse(create_request)
+    # Set owner & group
+    headers = {
+        "x-ms-version": AdlsCopyUtils.ADLS_REST_VERSION,
+        "content-length": "0",
+        "Authorization": token_handler.checkAccessToken()
+    }
+    await _add_identity_header(headers, AdlsCopyUtils.IDENTITY_USER, resource["permissions"]["owner"], "x-ms-owner", identity_map)
+    await _add_identity_header(headers, AdlsCopyUtils.IDENTITY_GROUP, resource["permissions"]["group"], "x-ms-group", identity_map)
+    group = headers.get("x-ms-group")
+    if resource_type == "file":
+        # New files are owned by the caller & inherit their parent's group
+        if headers.get("x-ms-owner") == token_handler.getObjectId():
+            del headers["x-ms-owner"]
+        if group and group == inherited_group:
+            del headers["x-ms-group"]
+        if "x-ms-owner" not in headers and "x-ms-group" not in headers:
+            log.debug("Skipping setAccessControl for %s", resource["name"])
+            return group
+    set_owner_url = "{0}/{1}/{2}?action=setAccessControl".format(AdlsCopyUtils.dfsEndpoint(account), container, resource["name"])
+    log.debug(set_owner_url)
+    async with session.patch(set_owner_url, headers=headers) as set_owner_request:
+        await _raiseForResponse(set_owner_request)
+    return group
+
+async def _hashing(stream, hasher):
+    # Hashes the source body as it is streamed into the append request
+    async for chunk in stream.iter_chunked(64 * 1024):
+        hasher.update(chunk)
+        yield chunk
+
+async def copy_range(session, source_url, dest_base_url, name, offset, length, token_handler, journal, flush=False, hasher=None, content_md5=None):
+    async with session.get(source_url,
+            headers = {
+                "x-ms-range": "bytes={0}-{1}".format(offset, offset + length - 1)
+            }) as source_request:
+        await _raiseForResponse(source_request)
+        append_url = dest_base_url + "action=append&position=" + str(offset)
+        headers = {
+            "Authorization": token_handler.checkAccessToken(),
+            "Content-Length": source_request.headers["Content-Length"]
+        }
+        if flush:
+            append_url += "&flush=true"
+            headers["x-ms-version"] = AdlsCopyUtils.ADLS_APPEND_FLUSH_REST_VERSION
+        if content_md5:
+            headers["Content-MD5"] = content_md5
+        # Stream the source body straight into the append request
+        data = _hashing(source_request.content, hasher) if hasher else source_request.content
+        async with session.patch(append_url, headers=headers, data=data) as dest_request:
+            await _raiseForResponse(dest_request)
+    if journal:
+        if flush:
+            journal.recordFlushed(name, offset + length)
+        else:
+            journal.recordAppend(name, offset, length)
+
+async def flush_file(session, dest_base_url, file, token_handler, journal, md5=None):
+    headers = {
+        "content-length": "0",
+        "Authorization": token_handler.checkAccessToken()
+    }
+    if md5:
+        headers["x-ms-version"] = AdlsCopyUtils.ADLS_REST_VERSION
+        headers["x-ms-content-md5"] = base64.b64encode(md5).decode("ascii")
+    async with session.patch(dest_base_url + "action=flush&position=" + str(file["length"]), headers=headers) as dest_request:
+        if not dest_request.ok and journal:
+            # The appended data may have been discarded, so the next attempt must copy the whole file again
+            journal.recordCreated(file["name"])
+        await _raiseForResponse(dest_request)
+    if journal:
+        journal.recordFlushed(file["name"], file["length"])
+
+async def create_directory(work_queue, directory, dest_account, dest_container, token_handler, identity_map, journal, directory_tracker):
+    log.debug(directory["name"])
+    if not (journal and journal.lookup(directory["name"])):
+        group = await create_adls_resource(work_queue.session, dest_account, dest_container, "directory", directory, token_handler, identity_map)
+        if journal:
+            journal.recordFlushed(directory["name"])
+    else:
+        group = AdlsCopyUtils.lookupIdentity(AdlsCopyUtils.IDENTITY_GROUP, directory["permissions"]["group"], identity_map)
+    _release_children(work_queue, directory, directory_tracker, group)
+
+def _release_children(work_queue, directory, directory_tracker, group=None):
+    for item in directory_tracker.directoryCreated(directory["name"], group):
+        work_queue.addItem(item)
+
+def copy_files_abandoned(work_queue, file, source_account, source_container, dest_account, dest_container, sas_token, token_handler, identity_map, block_size, parallel_copy_threshold, fast_path, journal, manifest, directory_tracker, request_stats):
+    # Don't hold up an abandoned directory's contents - creating them will implicitly create the directory
+    if file["is_folder"]:
+        _release_children(work_queue, file, directory_tracker)
+
+async def copy_files(work_queue, file, source_account, source_container, dest_account, dest_container, sas_token, token_handler, identity_map, block_size, parallel_copy_threshold, fast_path, journal, manifest, directory_tracker, request_stats):
+    request_count = countRequests()
+    if file["is_folder"]:
+        await create_directory(work_queue, file, dest_account, dest_container, token_handler, identity_map, journal, directory_tracker)
+        request_stats.record("directory", request_count[0])
+    else:
+        await copy_file(work_queue, file, source_account, source_container, dest_account, dest_container, sas_token, token_handler, identity_map, block_size, parallel_copy_threshold, fast_path, journal, manifest, directory_tracker)
+        request_stats.record("file", request_count[0])
+
+async def copy_file(work_queue, file, source_account, source_container, dest_account, dest_container, sas_token, token_handler, identity_map, block_size, parallel_copy_threshold, fast_path, journal, manifest, directory_tracker):
+    session = work_queue.session
+    log.debug(file["name"])
+    source_url = "{0}/{1}/{2}?{3}".format(AdlsCopyUtils.blobEndpoint(source_account, "http"), source_container, file["name"], sas_token)
+    dest_base_url = "{0}/{1}/{2}?".format(AdlsCopyUtils.dfsEndpoint(dest_account), dest_container, file["name"])
+    progress = journal.lookup(file["name"]) if journal else None
+    start_offset = 0
+    if not progress:
+        # Create the destination file
+        await create_adls_resource(session, dest_account, dest_container, "file", file, token_handler, identity_map, file.get("parent_group"))
+        if journal:
+            journal.recordCreated(file["name"])
+    elif progress[0] == CopyJournal.STATE_FLUSHED:
+        log.debug("Skipping previously copied file: %s", file["name"])
+        return
+    else:
+        # Resume a partially copied file from the last appended position
+        start_offset = progress[1]
+        log.debug("Resuming copy of %s from offset %d", file["name"], start_offset)
+        journal.recordCreated(file["name"], start_offset)
+    file_block_size = AdlsCopyUtils.getBlockSize(file["length"], block_size)
+    # The file is hashed as it is copied, unless we're resuming part way through
+    hashing = start_offset == 0
+    if fast_path and start_offset == 0 and file["length"] <= file_block_size:
+        # Small files are appended & flushed in a single request. An empty file is complete once it is created. The 
+        # source MD5 (if any) is checked by the service, so the file is only hashed for the manifest.
+        hasher = hashlib.md5() if manifest else None
+        if file["length"] > 0:
+            await copy_range(session, source_url, dest_base_url, file["name"], 0, file["length"], token_handler, journal, flush=True, hasher=hasher, content_md5=file.get("content_md5"))
+        elif journal:
+            journal.recordFlushed(file["name"])
+        if manifest:
+            manifest.write(file, hasher.digest())
+        return
+    ranges = [(offset, min(file_block_size, file["length"] - offset)) for offset in range(start_offset, file["length"], file_block_size)]
+    if file["length"] - start_offset > parallel_copy_threshold:
+        # Append all of the ranges concurrently at their own offsets, hashing each range separately
+        log.debug("Copying %s as %d parallel ranges", file["name"], len(ranges))
+        # The MD5 of the ranges can't be checked against the source, so is only calculated for the manifest
+        hashing = hashing and manifest is not None
+        hashers = [hashlib.md5() if hashing else None for _ in ranges]
+        await work_queue.gather([copy_range(session, source_url, dest_base_url, file["name"], offset, length, token_handler, journal, hasher=hasher) for (offset, length), hasher in zip(ranges, hashers)])
+        await flush_file(session, dest_base_url, file, token_handler, journal)
+        if manifest:
+            md5 = hashlib.md5(b"".join(hasher.digest() for hasher in hashers)).digest() if hashing else None
+            manifest.write(file, md5, VerificationManifest.MD5_OF_RANGES, file_block_size)
+        return
+    hasher = hashlib.md5() if hashing else None
+    for offset, length in ranges:
+        await copy_range(session, source_url, dest_base_url, file["name"], offset, length, token_handler, journal, hasher=hasher)
+    md5 = hasher.digest() if hasher else None
+    if md5:
+        try:
+            if manifest:
+                manifest.verify(file, md5)
+            else:
+                VerificationManifest.checkMd5(file, md5)
+        except IOError:
+            if journal:
+                journal.recordCreated(file["name"])
+            raise
+    # Flush the file
+    await flush_file(session, dest_base_url, file, token_handler, journal, md5)
+    if manifest:
+        manifest.write(file, md5)
+
+async def apply_file_acls(work_queue, file, account, container, token_handler, acl_mapper):
+    filename = file["file"]
+    if not filename:
+        filename = "/"
+    log.debug(filename)
+    if file.get("recursive"):
+        await _set_access_control_recursive(work_queue.session, account, container, filename, file, token_handler, acl_mapper)
+        return
+    # Set owner & group
+    headers = {
+        "x-ms-version": AdlsCopyUtils.ADLS_REST_VERSION,
+        "content-length": "0",
+        "Authorization": token_handler.checkAccessToken(),
+        "x-ms-acl": await _mapIdentities(acl_mapper.identity_map, acl_mapper.mapAcl, file["acl"])
+    }
+    await _add_identity_header(headers, AdlsCopyUtils.IDENTITY_USER, file["owner"], "x-ms-owner", acl_mapper.identity_map)
+    await _add_identity_header(headers, AdlsCopyUtils.IDENTITY_GROUP, file["group"], "x-ms-group", acl_mapper.identity_map)
+    set_owner_url = "{0}/{1}/{2}?action=setAccessControl".format(AdlsCopyUtils.dfsEndpoint(account), container, filename)
+    log.debug(set_owner_url)
+    async with work_queue.session.patch(set_owner_url, headers=headers) as set_owner_request:
+        if not set_owner_request.ok:
+            await _raiseAclError(filename, set_owner_request, headers)
+
+async def _set_access_control_recursive(session, account, container, filename, file, token_handler, acl_mapper):
+    mapped_acl = await _mapIdentities(acl_mapper.identity_map, acl_mapper.mapAcl, file["acl"])
+    base_url = "{0}/{1}/{2}?action=setAccessControlRecursive&mode=set&maxRecords={3}".format(AdlsCopyUtils.dfsEndpoint(account), container, filename, AdlsCopyUtils.RECURSIVE_ACL_PAGE_SIZE)
+    continuation = None
+    while True:
+        headers = {
+            "x-ms-version": AdlsCopyUtils.ADLS_RECURSIVE_ACL_REST_VERSION,
+            "content-length": "0",
+            "Authorization": token_handler.checkAccessToken(),
+            "x-ms-acl": mapped_acl
+        }
+        params = {"continuation": continuation} if continuation else None
+        async with session.patch(base_url, headers=headers, params=params) as acl_request:
+            if not acl_request.ok:
+                await _raiseAclError(filename, acl_request, headers)
+                return
+            result = await acl_request.json(content_type=None)
+            if result.get("failureCount"):
+                raise AdlsCopyUtils.createResponseError(acl_request.status, acl_request.headers, result)
+            continuation = acl_request.headers.get("x-ms-continuation")
+        if not continuation:
+            break
+
+async def _raiseAclError(filename, response, headers):
+    # The body may be empty or not JSON (eg. from a proxy), in which case the text is reported as is
+    err = await response.text()
+    try:
+        err = json.loads(err)
+    except ValueError:
+        pass
+    code = err["error"].get("code") if isinstance(err, dict) and isinstance(err.get("error"), dict) else None
+    # Allow 'PathNotFound' errors to fail silently
+    if code == "PathNotFound":
+        log.debug("Skipping missing file: %s", filename)
+    else:
+        if code == "InvalidNamedUserOrNamedGroup":
+            err["x-ms-acl"] = headers["x-ms-acl"]
+            err["owner"] = headers.get("x-ms-owner")
+            err["group"] = headers.get("x-ms-group")
+        raise AdlsCopyUtils.createResponseError(response.status, response.headers, err)
+
+async def update_files_owners(work_queue, file, account, container, sas_token, permissions_mapper):
+    # The item is left untouched, so that it can be retried (or dead-lettered) as it was originally listed. Items whose
+    # permissions don't change have already been skipped, unless their lookup failed then.
+    permissions = await _mapIdentities(permissions_mapper.identity_map, permissions_mapper.mapPermissions, file["permissions"])
+    if permissions is None:
+        return
+    # Merge the updated information into the other metadata properties, so that we can update in 1 call
+    metadata = dict(file["metadata"])
+    metadata[AdlsCopyUtils.METDATA_PERMISSIONS] = permissions
+    if file["is_folder"]:
+        metadata[AdlsCopyUtils.METADATA_ISFOLDER] = "true"
+    url = "{0}/{1}/{2}?comp=metadata&{3}".format(AdlsCopyUtils.blobEndpoint(account, "http"), container, file["name"], sas_token)
+    log.debug(url)
+    metadata_headers = {
+        "x-ms-version": "2018-03-28",
+        "x-ms-date": datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
+    }
+    metadata_headers.update({"x-ms-meta-" + name: value for (name, value) in metadata.items()})
+    async with work_queue.session.put(url, headers=metadata_headers) as response:
+        if not response.ok:
+            raise AdlsCopyUtils.createResponseError(response.status, response.headers, await response.text())
+    log.debug("Updated ownership for %s", file["name"])
@@ -1,18 +1,49 @@
 #!/usr/bin/env python
 
-import logging, subprocess, json, datetime, os.path, itertools, threading, argparse
+import logging, json, datetime, os.path, itertools, threading, argparse, sqlite3, heapq, random, time, base64, calendar, zlib, hmac, hashlib
+import email.utils
+import xml.etree.ElementTree as ElementTree
 import requests
-from collections import deque
+from collections import deque, OrderedDict
+from array import array
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 try:
     import queue
 except ImportError:
     import Queue as queue
+try:
+    from urllib.parse import urlparse, parse_qsl, quote
+except ImportError:
+    from urlparse import urlparse, parse_qsl
+    from urllib import quote
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 log = logging.getLogger(__name__)
 
 class AdlsCopyUtils():
 
     ADLS_REST_VERSION = "2018-11-09"
+    # Appending & flushing in a single request requires a later version of the API
+    ADLS_APPEND_FLUSH_REST_VERSION = "2023-08-03"
+    # setAccessControlRecursive was introduced in this version
+    ADLS_RECURSIVE_ACL_REST_VERSION = "2020-02-10"
+    # Maximum number of paths updated by each setAccessControlRecursive call
+    RECURSIVE_ACL_PAGE_SIZE = 2000
+
+    # Shared pool of keep-alive connections used for all REST calls. Configured via configureHttpSessions
+    http_sessions = None
+    # Counters, latencies & progress reporting for the run. Configured via configureMetrics
+    metrics = None
+    # Service endpoints. These may be overridden (eg. to run against a local test server) via configureEndpoints
+    blob_endpoint = None
+    dfs_endpoint = None
+    login_endpoint = "https://login.microsoftonline.com"
 
     IDENTITY_USER = "user"
     IDENTITY_GROUP = "group"
@@ -20,6 +51,26 @@ class AdlsCopyUtils():
     METDATA_PERMISSIONS = "hdi_permission"
     METADATA_ISFOLDER = "hdi_isfolder"
 
+    # The largest single append the dfs endpoint will accept
+    MAX_APPEND_SIZE = 100 * pow(2, 20)
+    # Very large files have their block size scaled up so that they don't generate an excessive number of ranges
+    MAX_RANGES_PER_FILE = 10000
+
+    ENGINE_THREADS = "threads"
+    ENGINE_ASYNCIO = "asyncio"
+
+    # Maximum number of results the List Blobs API will return per page
+    LIST_PAGE_SIZE = 5000
+    # Parallel listings walk this many levels of the directory tree, beneath which each prefix is listed in a single pass
+    PARALLEL_LIST_DEPTH = 2
+    # Bound on the number of items buffered ahead of the workers, per worker thread
+    WORK_QUEUE_DEPTH_PER_THREAD = 100
+
+    # Retry policy for failed work items - exponential backoff (with full jitter) between attempts
+    DEFAULT_MAX_RETRIES = 5
+    RETRY_BASE_DELAY = 1.0
+    RETRY_MAX_DELAY = 120.0
+
     @staticmethod
     def configureLogging(log_config, log_level, log_file):
         if log_config:
@@ -27,6 +78,41 @@ class AdlsCopyUtils():
         else:
             logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=getattr(logging, log_level.upper()), filename=log_file)
 
+    @staticmethod
+    def configureHttpSessions(max_parallelism):
+        AdlsCopyUtils.http_sessions = HttpSessionPool(max_parallelism)
+        return AdlsCopyUtils.http_sessions
+
+    @staticmethod
+    def configureMetrics(args):
+        AdlsCopyUtils.metrics = Metrics(args.progress_interval, args.metrics_file, args.metrics_port, args.metrics_interval)
+        return AdlsCopyUtils.metrics
+
+    @staticmethod
+    def configureEndpoints(args):
+        AdlsCopyUtils.blob_endpoint = args.blob_endpoint
+        AdlsCopyUtils.dfs_endpoint = args.dfs_endpoint
+        if args.login_endpoint:
+            AdlsCopyUtils.login_endpoint = args.login_endpoint.rstrip("/")
+
+    @staticmethod
+    def blobEndpoint(account, scheme="https"):
+        if AdlsCopyUtils.blob_endpoint:
+            return AdlsCopyUtils.blob_endpoint.rstrip("/").format(account=account)
+        return "{0}://{1}.blob.core.windows.net".format(scheme, account)
+
+    @staticmethod
+    def dfsEndpoint(account):
+        if AdlsCopyUtils.dfs_endpoint:
+            return AdlsCopyUtils.dfs_endpoint.rstrip("/").format(account=account)
+        return "https://{0}.dfs.core.windows.net".format(account)
+
+    @staticmethod
+    def httpSession():
+        if not AdlsCopyUtils.http_sessions:
+            AdlsCopyUtils.configureHttpSessions(1)
+        return AdlsCopyUtils.http_sessions.session
+
     @staticmethod
     def createCommandArgsParser(description, add_source_args=True, add_dest_args=False):
         parser = argparse.ArgumentParser(description=description)
@@ -34,7 +120,7 @@ class AdlsCopyUtils():
             parser.add_argument('-s', '--source-account', required=True, help="The name of the storage account to process")
             parser.add_argument('-k', '--source-key', required=True, help="The storage account key")
             parser.add_argument('-c', '--source-container', required=True, help="The name of the storage account container")
-            parser.add_argument('-p', '--prefix', default='""', help="A prefix that constrains the processing. Use this option to process entire account on multiple instances")
+            parser.add_argument('-p', '--prefix', default="", help="A prefix that constrains the processing. Use this option to process entire account on multiple instances")
         if type(add_dest_args) is tuple:
             add_dest_flag = add_dest_args[0]
             dest_required_flag = add_dest_args[1]
@@ -46,134 +132,1452 @@ class AdlsCopyUtils():
             parser.add_argument('-C', '--dest-container', required=dest_required_flag, help="The name of the destination storage container")
             parser.add_argument('-I', '--dest-spn-id', required=dest_required_flag, help="The client id for the service principal used to authenticate to the destination account")
             parser.add_argument('-S', '--dest-spn-secret', required=dest_required_flag, help="The client secret for the service principal used to authenticate to the destination account")
+        parser.add_argument('--shard', type=AdlsCopyUtils.parseShard, help="Only process the paths in this shard, specified as i/N (eg. 0/4 to 3/4). Paths are assigned to one of the N shards using a stable hash of their name, so that N instances (on one or many machines) each process an equal share.")
+        parser.add_argument('--stats-file', help="The name of a file to write the statistics for this run to (JSON). Used by run-shards.py to combine the statistics of each shard.")
         parser.add_argument('-i', '--identity-map', default="./identity_map.json", help="The name of the JSON file containing the initial map of source identities to target identities")
-        parser.add_argument('-t', '--max-parallelism', type=int, default=10, help="The number of threads to process this work in parallel")
+        parser.add_argument('--identity-directory', help="Where to look up identities that aren't in the identity map. Either 'graph' (Azure AD, via Microsoft Graph) or the name of a JSON file in the same format as the identity map (eg. an export of the directory).")
+        parser.add_argument('--identity-cache', help="The name of a file that caches the identities resolved via --identity-directory (including those that couldn't be found) between runs")
+        parser.add_argument('--graph-url', default=GraphDirectory.GRAPH_URL, help="The base url of the Microsoft Graph API used by '--identity-directory graph'")
+        parser.add_argument('--directory-spn-id', help="The client id for the service principal used to query Microsoft Graph. Defaults to the destination service principal.")
+        parser.add_argument('--directory-spn-secret', help="The client secret for the service principal used to query Microsoft Graph")
+        parser.add_argument('-t', '--max-parallelism', type=int, default=10, help="The number of threads (or concurrent requests for the asyncio engine) to process this work in parallel")
+        parser.add_argument('-e', '--engine', default=AdlsCopyUtils.ENGINE_THREADS, choices=[AdlsCopyUtils.ENGINE_THREADS, AdlsCopyUtils.ENGINE_ASYNCIO], help="The engine used to process work items. 'asyncio' (Python 3 only, requires the aiohttp package) runs all requests on a single event loop, allowing much higher parallelism.")
+        parser.add_argument('--max-retries', type=int, default=AdlsCopyUtils.DEFAULT_MAX_RETRIES, help="The number of times a failed item is retried before it is abandoned")
+        parser.add_argument('--dead-letter-file', help="The name of a file that items are written to when they have exhausted their retries. The file can be replayed using --replay-dead-letters")
+        parser.add_argument('--replay-dead-letters', help="The name of a dead letter file, written by a previous run, whose items will be processed instead of the normal input")
+        parser.add_argument('--progress-interval', type=int, default=60, help="The interval (in seconds) between progress lines (items & bytes processed, throughput, in-flight requests & ETA). 0 disables them.")
+        parser.add_argument('--metrics-file', help="The name of a file that request counts, latencies & throughput are written to in Prometheus text format, every --metrics-interval seconds")
+        parser.add_argument('--metrics-interval', type=int, default=Metrics.METRICS_FILE_INTERVAL, help="The interval (in seconds) between writes of --metrics-file. Independent of --progress-interval.")
+        parser.add_argument('--metrics-port', type=int, help="Serve the metrics in Prometheus text format over HTTP on this (local) port, at /metrics")
+        parser.add_argument('--blob-endpoint', help="Override the blob service endpoint, eg. http://127.0.0.1:8100/blob/{account} for a local test server. {account} is replaced with the account name.")
+        parser.add_argument('--dfs-endpoint', help="Override the dfs (ADLS Gen2) service endpoint, eg. http://127.0.0.1:8100/dfs/{account}")
+        parser.add_argument('--login-endpoint', help="Override the Azure AD endpoint used to acquire OAuth tokens")
         parser.add_argument('-f', '--log-config', help="The name of a configuration file for logging.")
         parser.add_argument('-l', '--log-file', help="Name of file to have log output written to (default is stdout/stderr)")
         parser.add_argument('-v', '--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="Level of log information to output. Default is 'INFO'.")
         return parser
 
+    @staticmethod
+    def parseShard(value):
+        try:
+            index, count = [int(part) for part in value.split("/")]
+        except ValueError:
+            raise argparse.ArgumentTypeError("Shard must be specified as i/N. Got: {0}".format(value))
+        if count < 1 or not 0 <= index < count:
+            raise argparse.ArgumentTypeError("Shard index must be between 0 and N-1. Got: {0}".format(value))
+        return (index, count)
+
+    @staticmethod
+    def shardOf(name, shard_count):
+        # crc32 is stable across processes & machines (unlike hash()), so every instance agrees on the assignment
+        return (zlib.crc32(name.encode("utf-8")) & 0xffffffff) % shard_count
+
+    @staticmethod
+    def filterShard(items, shard, name_key="name"):
+        if not shard:
+            return items
+        index, count = shard
+        log.info("Processing shard %d of %d", index, count)
+        return (item for item in items if AdlsCopyUtils.shardOf(item[name_key], count) == index)
+
+    @staticmethod
+    def mergeStats(total, stats):
+        # Sums the counters in 2 (possibly nested) dicts of statistics
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                AdlsCopyUtils.mergeStats(total.setdefault(key, {}), value)
+            else:
+                total[key] = total.get(key, 0) + value
+        return total
+
+    @staticmethod
+    def writeStats(file_name, stats):
+        with open(file_name, "w") as f:
+            json.dump(stats, f, sort_keys=True)
+
     @staticmethod
     def getSasToken(account, key):
-        log.info("Acquiring SAS token")
-        sas_token_bytes = subprocess.check_output("az storage account generate-sas --account-name {0} --account-key {1} --services b --resource-types sco --permissions lwr --expiry {2} --output json".format(
-                account, 
-                key, 
-                (datetime.datetime.utcnow() + datetime.timedelta(days=2)).strftime("%Y-%m-%dT%H:%MZ")),
-            shell=True)
-        return json.loads(sas_token_bytes.decode("utf-8"))
-
-    @staticmethod
-    def getSourceFileList(account, key, container, prefix=None):
-        log.info("Fetching complete file list")
-        process = subprocess.Popen("az storage blob list --account-name {0} --account-key {1} --container-name {2} --prefix {3} --output json --num-results 1000000000 --include m".format(
-                account, 
-                key, 
-                container, 
-                prefix),
-            stdout=subprocess.PIPE,
-            shell=True)
-        return [{
-                "name": x["name"], 
-                "parent_directory": os.path.dirname(x["name"]),
-                "is_folder": AdlsCopyUtils.METADATA_ISFOLDER in x["metadata"],
-                "permissions": json.loads(x["metadata"][AdlsCopyUtils.METDATA_PERMISSIONS]),
-                "length": x["properties"]["contentLength"],
-                "metadata": {k: v for k, v in x["metadata"].items()
-                    if k not in {AdlsCopyUtils.METADATA_ISFOLDER, AdlsCopyUtils.METDATA_PERMISSIONS}}
-            } 
-            for x 
-            in json.load(process.stdout)]
+        log.info("Signing SAS token")
+        return AccountSasToken(SharedKeyCredential(account, key), "rwl")
+
+    @staticmethod
+    def getSourceFileList(account, sas_token, container, prefix=None):
+        log.info("Streaming file list")
+        # The listing may outlive any single SAS, so each page is signed with the account key instead
+        list_url = "{0}/{1}?restype=container&comp=list&include=metadata&maxresults={2}".format(
+            AdlsCopyUtils.blobEndpoint(account), 
+            container, 
+            AdlsCopyUtils.LIST_PAGE_SIZE)
+        for blob in AdlsCopyUtils.listBlobs(list_url, prefix, auth=sas_token.credential):
+            yield AdlsCopyUtils.parseBlobListEntry(blob)
+
+    @staticmethod
+    def getSourceFileListParallel(account, sas_token, container, prefix=None, parallelism=8):
+        # Lists the container as a set of prefixes, in parallel. The items are returned as they're listed, so aren't in
+        # lexical order.
+        log.info("Streaming file list using %d concurrent listings", parallelism)
+        list_url = "{0}/{1}?restype=container&comp=list&include=metadata&maxresults={2}".format(
+            AdlsCopyUtils.blobEndpoint(account), 
+            container, 
+            AdlsCopyUtils.LIST_PAGE_SIZE)
+        prefixes = queue.Queue()
+        results = queue.Queue(AdlsCopyUtils.LIST_PAGE_SIZE * parallelism)
+        mutex = threading.Lock()
+        # The number of prefixes that have been queued, but not yet completely listed
+        outstanding = [1]
+        listing_complete = object()
+
+        def lister():
+            while True:
+                next_prefix = prefixes.get()
+                if next_prefix is None:
+                    return
+                list_prefix, depth = next_prefix
+                try:
+                    if depth < AdlsCopyUtils.PARALLEL_LIST_DEPTH:
+                        # Each sub-directory is listed separately
+                        for element in AdlsCopyUtils.listBlobs(list_url, list_prefix, auth=sas_token.credential, delimiter="/"):
+                            if element.tag == "BlobPrefix":
+                                with mutex:
+                                    outstanding[0] += 1
+                                prefixes.put((element.findtext("Name"), depth + 1))
+                            else:
+                                results.put(AdlsCopyUtils.parseBlobListEntry(element))
+                    else:
+                        for blob in AdlsCopyUtils.listBlobs(list_url, list_prefix, auth=sas_token.credential):
+                            results.put(AdlsCopyUtils.parseBlobListEntry(blob))
+                except Exception as e:
+                    results.put(e)
+                with mutex:
+                    outstanding[0] -= 1
+                    if not outstanding[0]:
+                        results.put(listing_complete)
+
+        prefixes.put((prefix.strip('"') if prefix else "", 0))
+        listers = [threading.Thread(target=lister) for _ in range(parallelism)]
+        for thread in listers:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is listing_complete:
+                    break
+                elif isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            for thread in listers:
+                prefixes.put(None)
+
+    @staticmethod
+    def getDestinationFileList(account, container, token_handler, prefix=None):
+        # The destination is listed via its blob endpoint (rather than dfs List Paths), so that the paths are returned
+        # in the same lexical order as the source listing
+        log.info("Streaming destination file list")
+        list_url = "{0}/{1}?restype=container&comp=list&include=metadata&maxresults={2}".format(
+            AdlsCopyUtils.blobEndpoint(account), 
+            container, 
+            AdlsCopyUtils.LIST_PAGE_SIZE)
+        for blob in AdlsCopyUtils.listBlobs(list_url, prefix, lambda: {
+                    "x-ms-version": AdlsCopyUtils.ADLS_REST_VERSION,
+                    "Authorization": token_handler.checkAccessToken()
+                }):
+            metadata_element = blob.find("Metadata")
+            yield {
+                "name": blob.findtext("Name"),
+                "is_folder": metadata_element is not None and metadata_element.find(AdlsCopyUtils.METADATA_ISFOLDER) is not None,
+                "length": int(blob.findtext("Properties/Content-Length")),
+                "last_modified": blob.findtext("Properties/Last-Modified"),
+                "content_md5": blob.findtext("Properties/Content-MD5") or None
+            }
+
+    @staticmethod
+    def listBlobs(list_url, prefix=None, headers=lambda: None, auth=None, delimiter=None):
+        # Yields each Blob element. With a delimiter, the BlobPrefix elements (ie. sub-directories) are yielded too.
+        # Older invocations passed the prefix quoted for the shell
+        if prefix:
+            prefix = prefix.strip('"')
+        params = {}
+        if prefix:
+            params["prefix"] = prefix
+        if delimiter:
+            params["delimiter"] = delimiter
+        while True:
+            with AdlsCopyUtils.httpSession().get(list_url, params=params, headers=headers(), auth=auth) as list_request:
+                if not list_request:
+                    raise IOError(list_request.text)
+                page = ElementTree.fromstring(list_request.content)
+            blobs = page.find("Blobs")
+            for element in blobs if blobs is not None else []:
+                yield element
+            next_marker = page.findtext("NextMarker")
+            if not next_marker:
+                break
+            log.debug("Fetching next page of file list")
+            params["marker"] = next_marker
+
+    @staticmethod
+    def parseHttpDate(value):
+        # Returns the seconds since the epoch for an RFC 1123 date, eg. 'Mon, 01 Jan 2019 10:00:00 GMT'
+        return calendar.timegm(email.utils.parsedate(value))
+
+    @staticmethod
+    def mergeListings(source, dest):
+        # Joins two listings that are both in lexical order by name. Yields (source entry, destination entry) pairs,
+        # with None for the side that doesn't have the path.
+        source = iter(source)
+        dest = iter(dest)
+        source_entry = next(source, None)
+        dest_entry = next(dest, None)
+        while source_entry is not None or dest_entry is not None:
+            if dest_entry is None or (source_entry is not None and source_entry["name"] < dest_entry["name"]):
+                yield source_entry, None
+                source_entry = next(source, None)
+            elif source_entry is None or dest_entry["name"] < source_entry["name"]:
+                yield None, dest_entry
+                dest_entry = next(dest, None)
+            else:
+                yield source_entry, dest_entry
+                source_entry = next(source, None)
+                dest_entry = next(dest, None)
+
+    @staticmethod
+    def parseBlobListEntry(blob):
+        metadata_element = blob.find("Metadata")
+        metadata = {x.tag: x.text or "" for x in metadata_element} if metadata_element is not None else {}
+        name = blob.findtext("Name")
+        return {
+            "name": name, 
+            "parent_directory": os.path.dirname(name),
+            "is_folder": AdlsCopyUtils.METADATA_ISFOLDER in metadata,
+            "permissions": json.loads(metadata[AdlsCopyUtils.METDATA_PERMISSIONS]),
+            "length": int(blob.findtext("Properties/Content-Length")),
+            "last_modified": blob.findtext("Properties/Last-Modified"),
+            "content_md5": blob.findtext("Properties/Content-MD5") or None,
+            "metadata": {k: v for k, v in metadata.items()
+                if k not in {AdlsCopyUtils.METADATA_ISFOLDER, AdlsCopyUtils.METDATA_PERMISSIONS}}
+        }
 
     @staticmethod
     def loadIdentityMap(map_file_name):
         log.info("Loading identity map from: %s", map_file_name)
         with open(map_file_name) as f:
-            return {t: {s["source"]: s["target"] for s in i} 
-                for t, i 
-                in itertools.groupby(json.load(f), lambda x: x["type"])}
+            identity_map = {AdlsCopyUtils.IDENTITY_USER: {}, AdlsCopyUtils.IDENTITY_GROUP: {}}
+            for identity in json.load(f):
+                identity_map.setdefault(identity["type"], {})[identity["source"]] = identity["target"]
+            return identity_map
+
+    @staticmethod
+    def createIdentityResolver(args):
+        identity_map = AdlsCopyUtils.loadIdentityMap(args.identity_map)
+        directory = None
+        if args.identity_directory == "graph":
+            client_id = args.directory_spn_id or getattr(args, "dest_spn_id", None)
+            client_secret = args.directory_spn_secret or getattr(args, "dest_spn_secret", None)
+            if not client_id or not client_secret:
+                raise ValueError("A service principal (--directory-spn-id & --directory-spn-secret) is required to look up identities in Microsoft Graph")
+            directory = GraphDirectory(OAuthBearerToken(client_id, client_secret, GraphDirectory.SCOPE), args.graph_url)
+        elif args.identity_directory:
+            directory = FileDirectory(args.identity_directory)
+        return IdentityResolver(identity_map, directory, args.identity_cache if directory else None)
 
     @staticmethod
     def lookupIdentity(identity_type, identity, identity_map):
-        retval = ""
-        if identity in identity_map[identity_type]:
-            retval = identity_map[identity_type][identity]
-        else:
-            # TODO: Lookup identity in AAD
-            retval=identity
-        return retval
+        if isinstance(identity_map, IdentityResolver):
+            return identity_map.lookup(identity_type, identity)
+        return identity_map[identity_type].get(identity, identity)
+
+    @staticmethod
+    def mapAclEntry(entry, identity_map):
+        # Format is [scope:][type]:[id]:[permissions]
+        items = entry.split(":")
+        id_idx = 1 if len(items) == 3 else 2
+        if items[id_idx]:
+            items[id_idx] = AdlsCopyUtils.lookupIdentity(items[id_idx - 1], items[id_idx], identity_map)
+        return ":".join(items)
+
+    @staticmethod
+    def getBlockSize(length, block_size):
+        while length > block_size * AdlsCopyUtils.MAX_RANGES_PER_FILE and block_size < AdlsCopyUtils.MAX_APPEND_SIZE:
+            block_size = min(block_size * 2, AdlsCopyUtils.MAX_APPEND_SIZE)
+        return block_size
+
+    @staticmethod
+    def raiseForResponse(response):
+        if response:
+            return
+        try:
+            details = response.json()
+        except ValueError:
+            details = response.text
+        raise AdlsCopyUtils.createResponseError(response.status_code, response.headers, details)
+
+    @staticmethod
+    def createResponseError(status_code, headers, details):
+        if status_code in (429, 503):
+            # ServerBusy or throttled - the service may tell us how long to back off for
+            retry_after = headers.get("Retry-After")
+            try:
+                retry_after = float(retry_after) if retry_after else None
+            except ValueError:
+                retry_after = None
+            return ThrottledError(details, status_code, retry_after)
+        return RequestError(details, status_code)
+
+    @staticmethod
+    def isRetriable(error):
+        # Errors not associated with a response (eg. connection failures) are assumed to be transient
+        return not isinstance(error, RequestError) or error.isRetriable()
+
+    @staticmethod
+    def getRetryDelay(error, attempt):
+        if isinstance(error, ThrottledError) and error.retry_after:
+            return error.retry_after
+        return random.uniform(0, min(AdlsCopyUtils.RETRY_MAX_DELAY, AdlsCopyUtils.RETRY_BASE_DELAY * pow(2, attempt)))
+
+    @staticmethod
+    def loadAcls(source_fd):
+        # Streams the ACL entries exported by export-acls.py (newline delimited JSON). The JSON array written by 
+        # earlier versions of copy-acls.sh is also accepted, although that has to be loaded in full.
+        first_line = source_fd.readline()
+        while first_line and not first_line.strip():
+            first_line = source_fd.readline()
+        if first_line.lstrip().startswith("["):
+            for entry in json.loads(first_line + source_fd.read()):
+                yield entry
+            return
+        for line in itertools.chain([first_line], source_fd):
+            if line.strip():
+                yield json.loads(line)
+
+    @staticmethod
+    def loadDeadLetters(dead_letter_file):
+        log.info("Replaying dead letters from: %s", dead_letter_file)
+        with open(dead_letter_file) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)["item"]
 
     class WorkQueue:
-        stop_event = threading.Event()
-        work_queue = queue.Queue()
+        # Queued to wake the workers once the queue has been drained
+        STOP = object()
 
-        def __init__(self, work_items):
+        def __init__(self, work_items=(), max_size=0, max_parallelism=0, max_retries=0, dead_letters=None):
+            self.stop_event = threading.Event()
+            self.work_queue = queue.Queue()
+            # The bound is enforced separately from the queue, so that work items generated by the workers themselves
+            # can always be queued. Otherwise a worker could block forever on a full queue that only it can drain.
+            self.capacity = threading.BoundedSemaphore(max_size) if max_size else None
+            self.concurrency = ConcurrencyController(max_parallelism) if max_parallelism else None
+            self.max_retries = max_retries
+            self.dead_letters = dead_letters
+            self.current = threading.local()
+            self.mutex = threading.Lock()
+            self.abandoned = 0
+            # Items waiting to be retried, ordered by the time they're due
+            self.retry_schedule = []
+            self.retry_condition = threading.Condition()
+            self.retry_sequence = itertools.count()
+            self.retry_thread = threading.Thread(target=self._retryScheduler)
+            self.retry_thread.daemon = True
+            self.retry_thread.start()
             for item in work_items:
-                self.work_queue.put(item)
+                self.addItem(item)
 
-        def nextItem(self, timeout=5):
-            try:
-                return self.work_queue.get(True, timeout)
-            except queue.Empty:
+        def addItem(self, item, bounded=True, attempt=0):
+            # Blocks while the queue is full, so that producers can't run ahead of the workers
+            bounded = bounded and self.capacity is not None
+            if bounded:
+                self.capacity.acquire()
+            self.work_queue.put((item, bounded, attempt))
+
+        def nextItem(self):
+            # Blocks until an item is available, or returns None once the queue has been stopped. Workers beyond the 
+            # current concurrency limit (reduced when the service throttles us) wait here.
+            if self.concurrency and not self.concurrency.acquire():
                 return None
+            item, bounded, attempt = self.work_queue.get()
+            if item is self.STOP:
+                # Pass it on to the next worker
+                self.work_queue.put((item, bounded, attempt))
+                if self.concurrency:
+                    self.concurrency.release()
+                return None
+            if bounded:
+                self.capacity.release()
+            self.current.attempt = attempt
+            if AdlsCopyUtils.metrics:
+                AdlsCopyUtils.metrics.increment("items", state="started")
+            return item
 
         def itemDone(self):
+            if self.concurrency:
+                self.concurrency.release(success=True)
+            if AdlsCopyUtils.metrics:
+                AdlsCopyUtils.metrics.increment("items", state="completed")
             self.work_queue.task_done()
 
+        def itemFailed(self, item, error, on_abandoned=None):
+            # Returns True if the item will be retried. The item remains outstanding (so the queue can't drain) until 
+            # it has been re-queued or abandoned. If the item is abandoned, on_abandoned (if given) returns what is 
+            # dead-lettered in its place, or None to dead-letter nothing.
+            throttled = isinstance(error, ThrottledError)
+            if self.concurrency:
+                self.concurrency.release(throttled=throttled)
+            attempt = getattr(self.current, "attempt", 0) + 1
+            if AdlsCopyUtils.metrics:
+                AdlsCopyUtils.metrics.increment("items", state="failed")
+            if AdlsCopyUtils.isRetriable(error) and attempt <= self.max_retries:
+                delay = AdlsCopyUtils.getRetryDelay(error, attempt)
+                log.debug("Retrying item in %.1fs (attempt %d of %d). Details: %s", delay, attempt, self.max_retries, error.args)
+                with self.retry_condition:
+                    heapq.heappush(self.retry_schedule, (time.time() + delay, next(self.retry_sequence), item, attempt))
+                    self.retry_condition.notify()
+                return True
+            else:
+                log.warning("Abandoning item after %d attempts. Details: %s", attempt, error.args)
+                with self.mutex:
+                    self.abandoned += 1
+                if AdlsCopyUtils.metrics:
+                    AdlsCopyUtils.metrics.increment("items", state="abandoned")
+                dead_letter_item = on_abandoned() if on_abandoned else item
+                if self.dead_letters and dead_letter_item is not None:
+                    self.dead_letters.write(dead_letter_item, error)
+                self.work_queue.task_done()
+                return False
+
+        def _retryScheduler(self):
+            while True:
+                with self.retry_condition:
+                    while not self.retry_schedule or self.retry_schedule[0][0] > time.time():
+                        self.retry_condition.wait(self.retry_schedule[0][0] - time.time() if self.retry_schedule else None)
+                    _, _, item, attempt = heapq.heappop(self.retry_schedule)
+                self.addItem(item, bounded=False, attempt=attempt)
+                self.work_queue.task_done()
+
         def isDone(self):
             return self.stop_event.is_set()
 
+        def stop(self):
+            # Wakes all of the workers, whether they're waiting for an item or for the concurrency limit
+            self.stop_event.set()
+            if self.concurrency:
+                self.concurrency.close()
+            self.work_queue.put((self.STOP, False, 0))
+
         def size(self):
             return self.work_queue.qsize()
 
     @staticmethod
-    def processWorkQueue(target, args, work_items, max_parallelism):
-        work_queue = AdlsCopyUtils.WorkQueue(work_items)
-        log.debug("Processing %d files using %d threads", work_queue.size(), max_parallelism)
+    def processWorkQueue(target, args, work_items, max_parallelism, max_retries=DEFAULT_MAX_RETRIES, dead_letter_file=None):
+        # Work items may be a (lazy) stream - the queue is bounded so that we only ever hold a window of items in memory
+        dead_letters = DeadLetterFile(dead_letter_file) if dead_letter_file else None
+        work_queue = AdlsCopyUtils.WorkQueue(max_size=max_parallelism * AdlsCopyUtils.WORK_QUEUE_DEPTH_PER_THREAD, 
+            max_parallelism=max_parallelism, 
+            max_retries=max_retries, 
+            dead_letters=dead_letters)
+        log.debug("Processing work items using %d threads", max_parallelism)
         args.extend([work_queue])
         args_tuple = tuple(args)
+        metrics = AdlsCopyUtils.metrics
+        if metrics:
+            metrics.trackQueue(work_queue.size, lambda: work_queue.concurrency.active, lambda: int(work_queue.concurrency.limit))
         threads = [threading.Thread(target=target, args=args_tuple) for _ in range(max_parallelism)]
         for thread in threads:
             thread.daemon=True
             thread.start()
+        # Feed the queue while the workers are draining it
+        item_count = 0
+        for item in work_items:
+            work_queue.addItem(item)
+            item_count += 1
+        log.debug("All %d work items queued", item_count)
+        if metrics:
+            metrics.queueComplete(item_count)
         # Wait for the queue to be drained
         work_queue.work_queue.join()
         log.debug("Queue has been drained")
         # Kill the threads
-        work_queue.stop_event.set()
+        work_queue.stop()
         for thread in threads:
             thread.join()
+        if dead_letters:
+            dead_letters.close()
+        stats = {"items": item_count, "abandoned": work_queue.abandoned}
+        if metrics:
+            metrics.report()
+        if AdlsCopyUtils.http_sessions:
+            AdlsCopyUtils.http_sessions.logStats()
+            stats["http"] = AdlsCopyUtils.http_sessions.connectionStats()
+        return stats
+
+class RequestError(IOError):
+    def __init__(self, details, status_code=None):
+        super(RequestError, self).__init__(details)
+        self.status_code = status_code
+
+    def isRetriable(self):
+        return self.status_code is None or self.status_code >= 500 or self.status_code in (408, 429)
+
+class ThrottledError(RequestError):
+    def __init__(self, details, status_code, retry_after=None):
+        super(ThrottledError, self).__init__(details, status_code)
+        self.retry_after = retry_after
+
+class ConcurrencyController:
+    # Adjusts the number of concurrently processed items using AIMD - the limit is halved when the service throttles
+    # us & recovers by (approximately) 1 for every 'limit' successful items.
+    DECREASE_INTERVAL = 2.0
+
+    def __init__(self, max_parallelism):
+        self.max_limit = max_parallelism
+        self.limit = float(max_parallelism)
+        self.active = 0
+        self.last_decrease = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        # Returns False if the timeout expires or the controller is closed while waiting
+        with self.condition:
+            deadline = time.time() + timeout if timeout is not None else None
+            while self.active >= int(self.limit) and not self.closed:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            if self.closed:
+                return False
+            self.active += 1
+            return True
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def tryAcquire(self):
+        return self.acquire(0)
+
+    def release(self, success=False, throttled=False):
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self._decrease()
+            elif success and self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self._decrease()
+
+    def _decrease(self):
+        # Many in-flight requests will be throttled at the same time - only count that as a single event
+        now = time.time()
+        if now - self.last_decrease > self.DECREASE_INTERVAL:
+            self.last_decrease = now
+            self.limit = max(1.0, self.limit / 2)
+            log.warning("Throttling detected. Reducing concurrency to %d", int(self.limit))
+
+class Inventory:
+    # Compact, columnar store for a materialized listing. Each column is an array, directory names are interned & 
+    # the permissions & metadata (which are shared by most blobs) are stored once per distinct value. Entries are 
+    # exposed as read-only mappings with the same keys as parseBlobListEntry, so they can be passed to the workers.
+    ENTRY_KEYS = ("name", "parent_directory", "is_folder", "permissions", "length", "last_modified", "content_md5", "metadata")
+
+    def __init__(self, entries=()):
+        self.names = []
+        self.parents = array("l")
+        self.lengths = array("q")
+        self.modified_times = array("q")
+        self.folders = array("b")
+        self.content_md5s = []
+        self.permissions = array("l")
+        self.metadata = array("l")
+        # Interned values & their index
+        self.values = []
+        self.value_index = {}
+        for entry in entries:
+            self.add(entry)
+
+    def _intern(self, value):
+        idx = self.value_index.get(value)
+        if idx is None:
+            idx = len(self.values)
+            self.values.append(value)
+            self.value_index[value] = idx
+        return idx
+
+    def add(self, entry):
+        self.names.append(entry["name"])
+        self.parents.append(self._intern(entry["parent_directory"]))
+        self.lengths.append(entry["length"])
+        self.modified_times.append(AdlsCopyUtils.parseHttpDate(entry["last_modified"]))
+        self.folders.append(1 if entry["is_folder"] else 0)
+        self.content_md5s.append(entry.get("content_md5"))
+        self.permissions.append(self._intern(tuple(sorted(entry["permissions"].items()))))
+        self.metadata.append(self._intern(tuple(sorted(entry["metadata"].items()))))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        return InventoryEntry(self, idx)
+
+    def __iter__(self):
+        for idx in range(len(self.names)):
+            yield InventoryEntry(self, idx)
+
+    def folderEntries(self):
+        for idx in range(len(self.names)):
+            if self.folders[idx]:
+                yield InventoryEntry(self, idx)
+
+    def fileEntries(self):
+        for idx in range(len(self.names)):
+            if not self.folders[idx]:
+                yield InventoryEntry(self, idx)
+
+    def filesBySize(self, largest_first=True):
+        # Only an array of indexes is sorted - the entries themselves aren't copied
+        indexes = array("l", sorted((idx for idx in range(len(self.names)) if not self.folders[idx]), key=self.lengths.__getitem__, reverse=largest_first))
+        for idx in indexes:
+            yield InventoryEntry(self, idx)
+
+class InventoryEntry(Mapping):
+    __slots__ = ("inventory", "idx")
+
+    def __init__(self, inventory, idx):
+        self.inventory = inventory
+        self.idx = idx
+
+    def __getitem__(self, key):
+        inventory = self.inventory
+        if key == "name":
+            return inventory.names[self.idx]
+        elif key == "parent_directory":
+            return inventory.values[inventory.parents[self.idx]]
+        elif key == "is_folder":
+            return inventory.folders[self.idx] == 1
+        elif key == "permissions":
+            return dict(inventory.values[inventory.permissions[self.idx]])
+        elif key == "length":
+            return inventory.lengths[self.idx]
+        elif key == "last_modified":
+            return email.utils.formatdate(inventory.modified_times[self.idx], usegmt=True)
+        elif key == "content_md5":
+            return inventory.content_md5s[self.idx]
+        elif key == "metadata":
+            return dict(inventory.values[inventory.metadata[self.idx]])
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(Inventory.ENTRY_KEYS)
+
+    def __len__(self):
+        return len(Inventory.ENTRY_KEYS)
+
+class AclMapper:
+    # Most paths share a handful of distinct ACLs, so the mapped form of each is only computed once
+    MAX_CACHE_SIZE = 100000
+
+    def __init__(self, identity_map):
+        self.identity_map = identity_map
+        self.cache = {}
+
+    def mapAcl(self, acl):
+        key = tuple(acl)
+        mapped_acl = self.cache.get(key)
+        if mapped_acl is None:
+            mapped_acl = ",".join([AdlsCopyUtils.mapAclEntry(entry, self.identity_map) for entry in acl])
+            if len(self.cache) >= self.MAX_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = mapped_acl
+        return mapped_acl
+
+class PermissionsMapper:
+    # Maps the owner & group of the permissions stored in blob metadata. Most paths share a handful of distinct 
+    # permissions, so the mapped & serialized form of each is only computed once.
+    MAX_CACHE_SIZE = 100000
+
+    def __init__(self, identity_map):
+        self.identity_map = identity_map
+        self.cache = {}
+        self.unchanged = 0
+
+    def mapPermissions(self, permissions):
+        # Returns the serialized mapped permissions, or None if the mapping doesn't change them
+        key = tuple(sorted(permissions.items()))
+        if key in self.cache:
+            return self.cache[key]
+        mapped = dict(permissions)
+        mapped["owner"] = AdlsCopyUtils.lookupIdentity(AdlsCopyUtils.IDENTITY_USER, permissions["owner"], self.identity_map)
+        mapped["group"] = AdlsCopyUtils.lookupIdentity(AdlsCopyUtils.IDENTITY_GROUP, permissions["group"], self.identity_map)
+        serialized = json.dumps(mapped) if mapped != permissions else None
+        if len(self.cache) >= self.MAX_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[key] = serialized
+        return serialized
+
+    def filterChanged(self, items):
+        # Drops the items whose metadata the mapping wouldn't change. Items whose identities can't be looked up are 
+        # passed through, so that the workers retry (or dead-letter) them rather than the failure ending the listing.
+        for item in items:
+            try:
+                if self.mapPermissions(item["permissions"]) is None:
+                    self.unchanged += 1
+                    continue
+            except IOError as e:
+                log.debug("Failed to map the permissions of: %s. Error: %s", item["name"], e)
+            yield item
+
+class IdentityResolver:
+    # Maps source identities to their target, first via the identity map & then via a directory (if any). Identities 
+    # that aren't in the map are looked up in batches by a background thread, & the results (including identities that 
+    # weren't found) are cached in memory & optionally persisted between runs. Unresolved identities are passed through.
+    BATCH_WAIT = 0.05
+    MAX_CACHE_SIZE = 100000
+    # Identities that weren't found are looked up again after this long, in case they have since been created
+    NEGATIVE_TTL = 24 * 60 * 60
+
+    class PendingLookup:
+        def __init__(self):
+            self.event = threading.Event()
+            self.target = None
+            self.error = None
+
+    def __init__(self, identity_map, directory=None, cache_file=None):
+        self.identity_map = identity_map
+        self.directory = directory
+        self.mutex = threading.Lock()
+        # (type, identity) -> (target or None, time resolved), in least recently used order
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.resolved = 0
+        self.not_found = 0
+        self.cache_file = cache_file
+        if cache_file:
+            self._loadCache()
+        if directory:
+            self.requests = queue.Queue()
+            self.resolver_thread = threading.Thread(target=self._resolver)
+            self.resolver_thread.daemon = True
+            self.resolver_thread.start()
+
+    def _loadCache(self):
+        connection = sqlite3.connect(self.cache_file)
+        connection.execute("CREATE TABLE IF NOT EXISTS identities (type TEXT, source TEXT, target TEXT, resolved REAL, PRIMARY KEY (type, source))")
+        # The most recently resolved entries are kept, & expired negative entries are dropped
+        for identity_type, source, target, resolved in connection.execute(
+                "SELECT type, source, target, resolved FROM identities WHERE target IS NOT NULL OR resolved > ? ORDER BY resolved DESC LIMIT ?", 
+                (time.time() - self.NEGATIVE_TTL, self.MAX_CACHE_SIZE)):
+            self.cache[(identity_type, source)] = (target, resolved)
+        connection.close()
+        log.info("Loaded %d cached identities from: %s", len(self.cache), self.cache_file)
+
+    def _saveCache(self):
+        connection = sqlite3.connect(self.cache_file)
+        with connection:
+            connection.execute("DELETE FROM identities")
+            connection.executemany("INSERT INTO identities VALUES (?, ?, ?, ?)", 
+                ((identity_type, source, target, resolved) for (identity_type, source), (target, resolved) in self.cache.items()))
+        connection.close()
+
+    def lookup(self, identity_type, identity):
+        # An identity in the map is never looked up, even if its target is blank (which means it isn't mapped)
+        identities = self.identity_map.get(identity_type, {})
+        if identity in identities:
+            return identities[identity]
+        if not self.directory:
+            return identity
+        key = (identity_type, identity)
+        with self.mutex:
+            cached = self.cache.pop(key, None)
+            if cached and (cached[0] or cached[1] > time.time() - self.NEGATIVE_TTL):
+                self.cache[key] = cached
+                self.hits += 1
+                return cached[0] or identity
+            # Concurrent lookups of the same identity share a single request
+            pending = self.pending.get(key)
+            if not pending:
+                pending = self.pending[key] = IdentityResolver.PendingLookup()
+                self.requests.put(key)
+        pending.event.wait()
+        if pending.error:
+            raise IOError("Failed to look up {0} {1}. Details: {2}".format(identity_type, identity, pending.error))
+        return pending.target or identity
+
+    def _resolver(self):
+        while True:
+            # Gather the identities requested over a short window, so that they're looked up together
+            batch = [self.requests.get()]
+            deadline = time.time() + self.BATCH_WAIT
+            while len(batch) < self.directory.BATCH_SIZE:
+                try:
+                    batch.append(self.requests.get(True, max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            for identity_type in set(key[0] for key in batch):
+                identities = [key[1] for key in batch if key[0] == identity_type]
+                try:
+                    targets, error = self.directory.resolve(identity_type, identities), None
+                except Exception as e:
+                    log.warning("Failed to look up %d identities. Details: %s", len(identities), e)
+                    targets, error = {}, e
+                now = time.time()
+                with self.mutex:
+                    for identity in identities:
+                        key = (identity_type, identity)
+                        target = targets.get(identity)
+                        if not error:
+                            if target:
+                                self.resolved += 1
+                            else:
+                                self.not_found += 1
+                            self.cache[key] = (target, now)
+                            if len(self.cache) > self.MAX_CACHE_SIZE:
+                                self.cache.popitem(last=False)
+                        pending = self.pending.pop(key)
+                        pending.target = target
+                        pending.error = error
+                        pending.event.set()
+
+    def close(self):
+        if self.directory:
+            log.info("Identity lookups: %d resolved, %d not found, %d cache hits", self.resolved, self.not_found, self.hits)
+        if self.cache_file:
+            with self.mutex:
+                self._saveCache()
+
+class FileDirectory:
+    # A directory loaded from a JSON file in the identity map format. Useful for testing, or where the directory has 
+    # been exported.
+    BATCH_SIZE = 1000
+
+    def __init__(self, file_name):
+        self.identities = AdlsCopyUtils.loadIdentityMap(file_name)
+
+    def resolve(self, identity_type, identities):
+        entries = self.identities.get(identity_type, {})
+        return {identity: entries[identity] for identity in identities if entries.get(identity)}
+
+class GraphDirectory:
+    # Looks up users by their on-premises account name & groups by their display name, returning their object ids
+    GRAPH_URL = "https://graph.microsoft.com/v1.0"
+    SCOPE = "https://graph.microsoft.com/.default"
+    # The maximum number of values in a single $filter 'in' clause
+    BATCH_SIZE = 15
+    LOOKUPS = {
+        AdlsCopyUtils.IDENTITY_USER: ("users", "onPremisesSamAccountName"),
+        AdlsCopyUtils.IDENTITY_GROUP: ("groups", "displayName")
+    }
+
+    def __init__(self, token_handler, graph_url=GRAPH_URL):
+        self.token_handler = token_handler
+        self.graph_url = graph_url.rstrip("/")
+
+    def resolve(self, identity_type, identities):
+        collection, attribute = self.LOOKUPS[identity_type]
+        values = ",".join("'{0}'".format(identity.replace("'", "''")) for identity in identities)
+        params = {
+            "$filter": "{0} in ({1})".format(attribute, values),
+            "$select": "id," + attribute,
+            "$count": "true"
+        }
+        # Filtering on some attributes requires an 'advanced query'
+        with AdlsCopyUtils.httpSession().get(self.graph_url + "/" + collection, params=params, headers={
+                    "Authorization": self.token_handler.checkAccessToken(),
+                    "ConsistencyLevel": "eventual"
+                }) as response:
+            AdlsCopyUtils.raiseForResponse(response)
+            # Directory attributes are matched case insensitively
+            requested = {identity.lower(): identity for identity in identities}
+            return {requested[entry[attribute].lower()]: entry["id"] for entry in response.json()["value"] if (entry.get(attribute) or "").lower() in requested}
+
+class DeadLetterFile:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.count = 0
+        self.mutex = threading.Lock()
+        self.file = open(file_name, "a")
+
+    def write(self, item, error):
+        line = json.dumps({"item": item, "error": error.args}, default=lambda value: dict(value) if isinstance(value, Mapping) else str(value))
+        with self.mutex:
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.count += 1
+
+    def close(self):
+        self.file.close()
+        if self.count:
+            log.warning("%d items could not be processed and have been written to: %s", self.count, self.file_name)
+
+class VerificationManifest:
+    # Records the hash of each copied file, computed over the bytes as they were streamed to the destination
+    MD5 = "md5"
+    # Files copied as parallel ranges are hashed per range. The hash is the MD5 of the concatenated range MD5s.
+    MD5_OF_RANGES = "md5-of-ranges"
+
+    def __init__(self, file_name):
+        log.info("Writing verification manifest: %s", file_name)
+        self.file_name = file_name
+        self.mutex = threading.Lock()
+        self.file = open(file_name, "a")
+        self.verified = 0
+        self.mismatched = 0
+
+    def verify(self, file, md5):
+        try:
+            VerificationManifest.checkMd5(file, md5)
+        except IOError:
+            with self.mutex:
+                self.mismatched += 1
+            raise
+
+    @staticmethod
+    def checkMd5(file, md5):
+        # Compares the MD5 of the copied bytes with the source's Content-MD5 (if it has one)
+        source_md5 = file.get("content_md5")
+        if source_md5 and source_md5 != base64.b64encode(md5).decode("ascii"):
+            raise IOError("MD5 of copied data does not match the source Content-MD5 for: {0}".format(file["name"]))
+
+    def write(self, file, md5, md5_type=MD5, block_size=None):
+        md5 = base64.b64encode(md5).decode("ascii") if md5 is not None else None
+        entry = {
+            "name": file["name"],
+            "length": file["length"],
+            "md5": md5,
+            "md5_type": md5_type,
+            "source_md5": file.get("content_md5"),
+            "verified": md5_type == self.MD5 and md5 is not None and file.get("content_md5") == md5
+        }
+        if block_size:
+            entry["block_size"] = block_size
+        line = json.dumps(entry)
+        with self.mutex:
+            self.file.write(line + "\n")
+            if entry["verified"]:
+                self.verified += 1
+
+    def close(self):
+        self.file.close()
+        log.info("Verification manifest: %d files matched the source Content-MD5, %d did not", self.verified, self.mismatched)
+
+    @staticmethod
+    def load(file_name):
+        with open(file_name) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+class CopyJournal:
+    # Durable record of the progress of each file, so that an interrupted copy can be resumed. Writes are buffered 
+    # & committed in batches by a background thread so that the journal doesn't throttle the workers. Each worker
+    # thread reads via its own connection, which WAL mode allows to run alongside the writer.
+    STATE_CREATED = 1
+    STATE_APPENDED = 2
+    STATE_FLUSHED = 3
+
+    BATCH_SIZE = 1000
+    COMMIT_INTERVAL = 5
+
+    def __init__(self, journal_file):
+        log.info("Using copy journal: %s", journal_file)
+        self.connection = sqlite3.connect(journal_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, state INTEGER NOT NULL, offset INTEGER NOT NULL)")
+        self.connection.commit()
+        self.journal_file = journal_file
+        self.readers = threading.local()
+        self.reader_connections = []
+        self.mutex = threading.Lock()
+        self.pending = {}
+        # The batch being written by commit, which lookup must still see until it has been committed
+        self.committing = {}
+        # For files being copied, the contiguous appended offset & any ranges appended out of order beyond it
+        self.in_flight = {}
+        self.commit_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.writer = threading.Thread(target=self._writer)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def lookup(self, name):
+        with self.mutex:
+            if name in self.pending:
+                return self.pending[name]
+            if name in self.committing:
+                return self.committing[name]
+        # Anything no longer buffered has already been committed, so is visible to the reader
+        row = self._readerConnection().execute("SELECT state, offset FROM files WHERE name = ?", (name,)).fetchone()
+        return tuple(row) if row else None
+
+    def _readerConnection(self):
+        connection = getattr(self.readers, "connection", None)
+        if connection is None:
+            connection = self.readers.connection = sqlite3.connect(self.journal_file, check_same_thread=False)
+            with self.mutex:
+                self.reader_connections.append(connection)
+        return connection
+
+    def recordCreated(self, name, offset=0):
+        # offset is non-zero when resuming a partially appended file
+        with self.mutex:
+            self.in_flight[name] = [offset, {}]
+        self._record(name, self.STATE_CREATED if offset == 0 else self.STATE_APPENDED, offset)
+
+    def recordAppend(self, name, offset, length):
+        # Only the offset up to which the file has been contiguously appended is recorded, so that resuming from 
+        # it never leaves a gap
+        with self.mutex:
+            progress = self.in_flight.setdefault(name, [offset, {}])
+            progress[1][offset] = length
+            if progress[0] not in progress[1]:
+                return
+            while progress[0] in progress[1]:
+                progress[0] += progress[1].pop(progress[0])
+            contiguous_offset = progress[0]
+        self._record(name, self.STATE_APPENDED, contiguous_offset)
+
+    def recordFlushed(self, name, length=0):
+        with self.mutex:
+            self.in_flight.pop(name, None)
+        self._record(name, self.STATE_FLUSHED, length)
+
+    def _record(self, name, state, offset):
+        with self.mutex:
+            self.pending[name] = (state, offset)
+            if len(self.pending) >= self.BATCH_SIZE:
+                self.commit_event.set()
+
+    def commit(self):
+        # Only called by the writer thread (or once it has stopped). The batch is written outside of the mutex, so 
+        # that the workers aren't held up by the disk I/O.
+        with self.mutex:
+            self.committing, self.pending = self.pending, {}
+        if self.committing:
+            self.connection.executemany("INSERT OR REPLACE INTO files (name, state, offset) VALUES (?, ?, ?)", 
+                [(name, state, offset) for name, (state, offset) in self.committing.items()])
+            self.connection.commit()
+        with self.mutex:
+            self.committing = {}
+
+    def _writer(self):
+        while not self.stop_event.is_set():
+            self.commit_event.wait(self.COMMIT_INTERVAL)
+            self.commit_event.clear()
+            self.commit()
+
+    def close(self):
+        self.stop_event.set()
+        self.commit_event.set()
+        self.writer.join()
+        self.commit()
+        self.connection.close()
+        for connection in self.reader_connections:
+            connection.close()
+
+class HttpSessionPool:
+    # The number of distinct hosts we keep connections to (source blob, destination dfs, AAD)
+    POOL_HOSTS = 4
+
+    def __init__(self, max_parallelism):
+        # A single session, with a connection pool per host that is large enough for every worker to hold a 
+        # keep-alive connection to both the blob & dfs endpoints concurrently
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=self.POOL_HOSTS, pool_maxsize=max_parallelism)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        # Count the requests made by each thread, so that callers can measure the cost of each work item
+        self.thread_requests = threading.local()
+        self.session.hooks["response"].append(self._countRequest)
+        self.session.hooks["response"].append(self._recordMetrics)
+
+    def _countRequest(self, response, *args, **kwargs):
+        self.thread_requests.count = self.threadRequestCount() + 1
+
+    def _recordMetrics(self, response, *args, **kwargs):
+        if AdlsCopyUtils.metrics:
+            # Latency is measured to the arrival of the response headers, so excludes streaming the body
+            AdlsCopyUtils.metrics.recordRequest(response.request.method, response.request.url, response.status_code, response.elapsed.total_seconds(), 
+                response.request.headers.get("Content-Length"), response.headers.get("Content-Length"))
+
+    def threadRequestCount(self):
+        return getattr(self.thread_requests, "count", 0)
+
+    def connectionStats(self):
+        pools = self.adapter.poolmanager.pools
+        stats = {"requests": 0, "connections": 0}
+        for key in pools.keys():
+            pool = pools[key]
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+        stats["reused"] = stats["requests"] - stats["connections"]
+        return stats
+
+    def logStats(self):
+        stats = self.connectionStats()
+        log.info("HTTP requests: %d, connections opened: %d, connection reuses: %d", stats["requests"], stats["connections"], stats["reused"])
+
+class RequestStats:
+    # Histogram of the number of HTTP requests needed to process each kind of work item
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.histograms = {}
+
+    def record(self, kind, requests):
+        with self.mutex:
+            histogram = self.histograms.setdefault(kind, {})
+            histogram[requests] = histogram.get(requests, 0) + 1
+
+    def toDict(self):
+        # Histogram buckets are keyed by string, so that they survive a round trip through JSON
+        with self.mutex:
+            return {kind: {str(requests): items for requests, items in histogram.items()} for kind, histogram in self.histograms.items()}
+
+    def logStats(self):
+        with self.mutex:
+            for kind, histogram in sorted(self.histograms.items()):
+                items = sum(histogram.values())
+                requests = sum(count * items_with_count for count, items_with_count in histogram.items())
+                log.info("Requests per %s: %.2f average over %d items. Histogram: %s", kind, float(requests) / items, items, 
+                    ", ".join("{0}: {1}".format(count, items_with_count) for count, items_with_count in sorted(histogram.items())))
+
+class SharedKeyCredential(requests.auth.AuthBase):
+    # Signs requests (and SAS tokens) locally with the storage account key. Can be passed as the 'auth' of a request.
+    def __init__(self, account, key):
+        self.account = account
+        self.key = base64.b64decode(key)
+
+    def sign(self, string_to_sign):
+        return base64.b64encode(hmac.new(self.key, string_to_sign.encode("utf-8"), hashlib.sha256).digest()).decode("utf-8")
+
+    def __call__(self, request):
+        request.headers["x-ms-date"] = email.utils.formatdate(usegmt=True)
+        request.headers.setdefault("x-ms-version", AdlsCopyUtils.ADLS_REST_VERSION)
+        headers = dict((name.lower(), str(value).strip()) for name, value in request.headers.items())
+        content_length = headers.get("content-length", "")
+        url = urlparse(request.url)
+        # See https://docs.microsoft.com/rest/api/storageservices/authorize-with-shared-key
+        string_to_sign = "\n".join([request.method.upper()] + 
+            [headers.get(name, "") for name in ["content-encoding", "content-language"]] + 
+            ["" if content_length == "0" else content_length] + 
+            [headers.get(name, "") for name in ["content-md5", "content-type", "date", "if-modified-since", "if-match", "if-none-match", "if-unmodified-since", "range"]] + 
+            ["{0}:{1}".format(name, value) for name, value in sorted(headers.items()) if name.startswith("x-ms-")] + 
+            ["/{0}{1}".format(self.account, url.path or "/")])
+        params = {}
+        for name, value in parse_qsl(url.query, keep_blank_values=True):
+            params.setdefault(name.lower(), []).append(value)
+        for name, values in sorted(params.items()):
+            string_to_sign += "\n{0}:{1}".format(name, ",".join(sorted(values)))
+        request.headers["Authorization"] = "SharedKey {0}:{1}".format(self.account, self.sign(string_to_sign))
+        return request
+
+class AccountSasToken:
+    # A blob service account SAS, signed locally & regenerated well before it expires. Formats as the current token,
+    # so it can be embedded directly in each request url.
+    SAS_VERSION = "2018-11-09"
+    LIFETIME = datetime.timedelta(days=1)
+    # A token is regenerated once it has less than this much time left, so that a url built with it remains valid for
+    # the duration of any request
+    REFRESH_MARGIN = datetime.timedelta(hours=4)
+    # Allows for clock skew between this machine & the service
+    START_MARGIN = datetime.timedelta(minutes=15)
+
+    def __init__(self, credential, permissions):
+        self.credential = credential
+        self.permissions = permissions
+        self.token = None
+        self.token_refresh_time = datetime.datetime.utcnow()
+
+    def _generate(self):
+        now = datetime.datetime.utcnow()
+        expiry = now + AccountSasToken.LIFETIME
+        fields = {
+            "sv": AccountSasToken.SAS_VERSION,
+            "ss": "b",
+            "srt": "sco",
+            "sp": self.permissions,
+            "st": (now - AccountSasToken.START_MARGIN).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "se": expiry.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+        # See https://docs.microsoft.com/rest/api/storageservices/create-account-sas (signedIP & signedProtocol are empty)
+        string_to_sign = "\n".join([self.credential.account, fields["sp"], fields["ss"], fields["srt"], fields["st"], fields["se"], "", "", fields["sv"], ""])
+        fields["sig"] = self.credential.sign(string_to_sign)
+        log.debug("Generated SAS token expiring at %s", fields["se"])
+        # A single assignment, so that other threads see either the old or the new token
+        self.token, self.token_refresh_time = "&".join("{0}={1}".format(name, quote(value, safe="")) for name, value in sorted(fields.items())), expiry - AccountSasToken.REFRESH_MARGIN
+
+    def __str__(self):
+        # Signing is cheap, so there is no need to lock - concurrent callers at worst sign the token twice
+        if datetime.datetime.utcnow() > self.token_refresh_time:
+            self._generate()
+        return self.token
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+class Metrics:
+    # Counters & per-operation latency histograms for every REST call & work item, reported as periodic progress lines 
+    # and in Prometheus text format (to a file and/or a local HTTP endpoint)
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    PREFIX = "adls_copy_"
+
+    # The default interval (in seconds) between writes of the metrics file
+    METRICS_FILE_INTERVAL = 15
+
+    def __init__(self, progress_interval=0, metrics_file=None, metrics_port=None, metrics_interval=None):
+        self.mutex = threading.Lock()
+        # (name, sorted labels) -> value
+        self.counters = {}
+        # operation -> [count per bucket..., sum, count]
+        self.latencies = {}
+        self.start_time = time.time()
+        self.queue_size = self.in_flight = self.concurrency_limit = lambda: 0
+        self.expected_items = None
+        self.queue_start = 0
+        self.last_report = (self.start_time, 0, 0)
+        self.progress_interval = progress_interval
+        self.metrics_file = metrics_file
+        if progress_interval > 0:
+            self._startReporter(self.logProgress, progress_interval)
+        if metrics_file:
+            self._startReporter(self.writeMetricsFile, metrics_interval or self.METRICS_FILE_INTERVAL)
+        if metrics_port:
+            self._serve(metrics_port)
+
+    @staticmethod
+    def operationOf(method, url):
+        query = urlparse(url).query
+        params = dict(parse_qsl(query))
+        if "resource" in params:
+            return "create"
+        if "action" in params:
+            action = params["action"]
+            return "append_flush" if action == "append" and params.get("flush") == "true" else action
+        if "comp" in params:
+            return params["comp"]
+        if "oauth2" in url:
+            return "token"
+        return "read" if method == "GET" else method.lower()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.mutex:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def recordRequest(self, method, url, status, seconds, request_length=None, response_length=None):
+        operation = Metrics.operationOf(method, url)
+        with self.mutex:
+            histogram = self.latencies.get(operation)
+            if histogram is None:
+                histogram = self.latencies[operation] = [0] * (len(self.LATENCY_BUCKETS) + 2)
+            for idx, bucket in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bucket:
+                    histogram[idx] += 1
+                    break
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            key = ("requests", (("operation", operation), ("status", "{0}xx".format(status // 100))))
+            self.counters[key] = self.counters.get(key, 0) + 1
+            if status in (429, 503):
+                self.counters[("throttled", ())] = self.counters.get(("throttled", ()), 0) + 1
+            # Bytes are counted from the request that uploaded them & the response that downloaded them
+            if operation in ("append", "append_flush") and request_length:
+                self.counters[("bytes", (("direction", "written"),))] = self.counters.get(("bytes", (("direction", "written"),)), 0) + int(request_length)
+            elif operation == "read" and response_length and status < 300:
+                self.counters[("bytes", (("direction", "read"),))] = self.counters.get(("bytes", (("direction", "read"),)), 0) + int(response_length)
+
+    def trackQueue(self, queue_size, in_flight, concurrency_limit):
+        self.queue_size = queue_size
+        self.in_flight = in_flight
+        self.concurrency_limit = concurrency_limit
+        self.expected_items = None
+        self.queue_start = self._itemsFinished()
+
+    def queueComplete(self, item_count):
+        # Once all of the items have been queued, the ETA can be estimated. Items queued by the workers themselves (eg.
+        # the ranges of large files) aren't included, so this is approximate.
+        self.expected_items = self.queue_start + item_count
+
+    def _itemsFinished(self):
+        return self.counter("items", state="completed") + self.counter("items", state="abandoned")
+
+    def progressLine(self):
+        now = time.time()
+        finished = self._itemsFinished()
+        bytes_written = self.counter("bytes", direction="written")
+        last_time, last_finished, last_bytes = self.last_report
+        self.last_report = (now, finished, bytes_written)
+        interval = max(now - last_time, 0.001)
+        line = "Progress: {0} items completed ({1:.1f}/s), {2} failed attempts, {3} abandoned, {4} queued, {5} in flight (limit {6}), {7:.1f} MB written ({8:.1f} MB/s), {9} throttled requests".format(
+            self.counter("items", state="completed"), (finished - last_finished) / interval, self.counter("items", state="failed"), 
+            self.counter("items", state="abandoned"), self.queue_size(), self.in_flight(), self.concurrency_limit(), 
+            bytes_written / float(pow(2, 20)), (bytes_written - last_bytes) / float(pow(2, 20)) / interval, self.counter("throttled"))
+        if self.expected_items is not None:
+            # Based on the average rate of the run so far
+            rate = finished / max(now - self.start_time, 0.001)
+            remaining = max(self.expected_items - finished, 0)
+            if rate > 0:
+                line += ", ETA {0}".format(datetime.timedelta(seconds=int(remaining / rate)))
+        return line
+
+    def toPrometheus(self):
+        lines = []
+        with self.mutex:
+            counters = sorted(self.counters.items())
+            latencies = sorted((operation, list(histogram)) for operation, histogram in self.latencies.items())
+        for name in sorted(set(name for (name, _), _ in counters)):
+            lines.append("# TYPE {0}{1}_total counter".format(self.PREFIX, name))
+            for (counter_name, labels), value in counters:
+                if counter_name == name:
+                    lines.append("{0}{1}_total{2} {3}".format(self.PREFIX, name, Metrics._labels(labels), value))
+        for name, value in [("items_queued", self.queue_size()), ("items_in_flight", self.in_flight()), ("concurrency_limit", self.concurrency_limit())]:
+            lines.append("# TYPE {0}{1} gauge".format(self.PREFIX, name))
+            lines.append("{0}{1} {2}".format(self.PREFIX, name, value))
+        lines.append("# TYPE {0}request_duration_seconds histogram".format(self.PREFIX))
+        for operation, histogram in latencies:
+            cumulative = 0
+            for bucket, count in zip(self.LATENCY_BUCKETS + ("+Inf",), histogram[:-2] + [histogram[-1] - sum(histogram[:-2])]):
+                cumulative += count
+                lines.append("{0}request_duration_seconds_bucket{1} {2}".format(self.PREFIX, Metrics._labels((("operation", operation), ("le", str(bucket)))), cumulative))
+            lines.append("{0}request_duration_seconds_sum{1} {2}".format(self.PREFIX, Metrics._labels((("operation", operation),)), histogram[-2]))
+            lines.append("{0}request_duration_seconds_count{1} {2}".format(self.PREFIX, Metrics._labels((("operation", operation),)), histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join('{0}="{1}"'.format(name, value) for name, value in labels) + "}"
+
+    def logProgress(self):
+        log.info(self.progressLine())
+
+    def writeMetricsFile(self):
+        # Replace the file atomically, so that a scraper never sees a partial file
+        temp_file = self.metrics_file + ".tmp"
+        with open(temp_file, "w") as f:
+            f.write(self.toPrometheus())
+        os.rename(temp_file, self.metrics_file)
+
+    def report(self):
+        # Final report, once all work has been processed
+        if self.progress_interval > 0:
+            self.logProgress()
+        if self.metrics_file:
+            self.writeMetricsFile()
+
+    def _startReporter(self, action, interval):
+        reporter = threading.Thread(target=self._reporter, args=(action, interval))
+        reporter.daemon = True
+        reporter.start()
+
+    def _reporter(self, action, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                action()
+            except Exception as e:
+                log.warning("Failed to report metrics. Details: %s", e)
+
+    def _serve(self, port):
+        metrics = self
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.toPrometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        server = HTTPServer(("localhost", port), MetricsHandler)
+        log.info("Serving metrics at http://localhost:%d/metrics", port)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
 
 class OAuthBearerToken:
-    def __init__(self, client_id, client_secret):
+    # Tokens are refreshed in the background this long before they expire, so that requests never wait for a refresh
+    REFRESH_MARGIN = datetime.timedelta(minutes=5)
+    # Interval between attempts when a background refresh fails
+    REFRESH_RETRY_INTERVAL = 30
+
+    def __init__(self, client_id, client_secret, scope="https://storage.azure.com/.default"):
         self.access_token = ""
-        self.token_refresh_time = datetime.datetime.utcnow()
+        self.token_expiry_time = datetime.datetime.utcnow()
+        self.token_refresh_time = self.token_expiry_time
         self.client_id = client_id
         self.client_secret = client_secret
+        self.scope = scope
         self.mutex = threading.Lock()
+        self.object_id = None
         # Validate the args by acquiring the token
         self.checkAccessToken()
+        self.refresh_thread = threading.Thread(target=self._refreshLoop)
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def getObjectId(self):
+        # The object id of the authenticated principal - this is the owner of any path that we create
+        if not self.object_id:
+            payload = self.access_token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)).decode("utf-8"))
+            self.object_id = claims.get("oid")
+        return self.object_id
+
+    def _refreshToken(self):
+        log.debug("Refreshing OAuth token")
+        with AdlsCopyUtils.httpSession().post(AdlsCopyUtils.login_endpoint + "/common/oauth2/v2.0/token", 
+                data={
+                    "client_id": self.client_id, 
+                    "client_secret": self.client_secret,
+                    "scope": self.scope,
+                    "grant_type": "client_credentials"
+                },
+                headers={
+                    "Content-Type": "application/x-www-form-urlencoded"
+                }) as auth_request:
+            token_response = auth_request.json()
+            if auth_request:
+                self.token_expiry_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=token_response["expires_in"])
+                self.token_refresh_time = self.token_expiry_time - min(OAuthBearerToken.REFRESH_MARGIN, datetime.timedelta(seconds=token_response["expires_in"] // 2))
+                self.access_token = token_response["access_token"]
+            else:
+                raise IOError(token_response)
+
+    def _refreshLoop(self):
+        while True:
+            delay = (self.token_refresh_time - datetime.datetime.utcnow()).total_seconds()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                with self.mutex:
+                    if datetime.datetime.utcnow() > self.token_refresh_time:
+                        self._refreshToken()
+            except Exception as e:
+                log.warning("Failed to refresh OAuth token. Retrying in %ds. Details: %s", OAuthBearerToken.REFRESH_RETRY_INTERVAL, e)
+                time.sleep(OAuthBearerToken.REFRESH_RETRY_INTERVAL)
 
     def checkAccessToken(self):
-        if datetime.datetime.utcnow() > self.token_refresh_time:
+        # The token is normally refreshed in the background. Callers only wait if that has failed & the token expired.
+        if datetime.datetime.utcnow() > self.token_expiry_time:
             with self.mutex:            
-                if datetime.datetime.utcnow() > self.token_refresh_time:
-                    log.debug("Refreshing OAuth token")
-                    with requests.post("https://login.microsoftonline.com/common/oauth2/v2.0/token", 
-                            data={
-                                "client_id": self.client_id, 
-                                "client_secret": self.client_secret,
-                                "scope": "https://storage.azure.com/.default",
-                                "grant_type": "client_credentials"
-                            },
-                            headers={
-                                "Content-Type": "application/x-www-form-urlencoded"
-                            }) as auth_request:
-                        token_response = auth_request.json()
-                        if auth_request:
-                            self.token_refresh_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=token_response["expires_in"])
-                            self.access_token = token_response["access_token"]
-                        else:
-                            raise IOError(token_response)
+                if datetime.datetime.utcnow() > self.token_expiry_time:
+                    self._refreshToken()
         return "Bearer " + self.access_token
-
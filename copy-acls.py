@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
 import requests
-import sys, subprocess, datetime, json, itertools, os.path, threading, argparse, logging
-from adls_copy_utils import AdlsCopyUtils, OAuthBearerToken
+import sys, subprocess, datetime, json, itertools, os.path, threading, argparse, logging, tempfile, shutil
+from collections import Counter
+from adls_copy_utils import AdlsCopyUtils, OAuthBearerToken, AclMapper
 
 log = logging.getLogger(__name__)
 
@@ -11,15 +12,73 @@ def add_identity_header(headers, identity_type, identity, header, identity_map):
     if mapped_identity:
         headers[header] = mapped_identity
 
-def map_acl_entry(entry, identity_map):
-    # Format is [scope:][type]:[id]:[permissions]
-    items = entry.split(":")
-    id_idx = 1 if len(items) == 3 else 2
-    if items[id_idx]:
-        items[id_idx] = AdlsCopyUtils.lookupIdentity(items[id_idx - 1], items[id_idx], identity_map)
-    return ":".join(items)
+def set_access_control(account, container, filename, file, token_handler, acl_mapper):
+    # Set owner, group & ACL
+    headers = {
+        "x-ms-version": AdlsCopyUtils.ADLS_REST_VERSION,
+        "content-length": "0",
+        "Authorization": token_handler.checkAccessToken(),
+        "x-ms-acl": acl_mapper.mapAcl(file["acl"])
+    }
+    add_identity_header(headers, "user", file["owner"], "x-ms-owner", acl_mapper.identity_map)
+    add_identity_header(headers, "group", file["group"], "x-ms-group", acl_mapper.identity_map)
+    set_owner_url = "{0}/{1}/{2}?action=setAccessControl".format(AdlsCopyUtils.dfsEndpoint(account), container, filename)
+    log.debug(set_owner_url)
+    log.debug(headers)
+    with AdlsCopyUtils.httpSession().patch(set_owner_url, headers=headers) as set_owner_request:
+        if not set_owner_request:
+            raise_acl_error(filename, set_owner_request, headers)
 
-def apply_file_acls(account, container, token_handler, identity_map, work_queue):
+def set_access_control_recursive(account, container, filename, file, token_handler, acl_mapper):
+    # Applies the ACL to the directory & everything beneath it, a page of paths at a time. Owner & group aren't 
+    # changed - they were set when the data was copied.
+    mapped_acl = acl_mapper.mapAcl(file["acl"])
+    base_url = "{0}/{1}/{2}?action=setAccessControlRecursive&mode=set&maxRecords={3}".format(AdlsCopyUtils.dfsEndpoint(account), container, filename, AdlsCopyUtils.RECURSIVE_ACL_PAGE_SIZE)
+    continuation = None
+    paths = 0
+    while True:
+        headers = {
+            "x-ms-version": AdlsCopyUtils.ADLS_RECURSIVE_ACL_REST_VERSION,
+            "content-length": "0",
+            "Authorization": token_handler.checkAccessToken(),
+            "x-ms-acl": mapped_acl
+        }
+        url = base_url
+        if continuation:
+            url += "&continuation=" + requests.utils.quote(continuation, safe="")
+        log.debug(url)
+        with AdlsCopyUtils.httpSession().patch(url, headers=headers) as acl_request:
+            if not acl_request:
+                raise_acl_error(filename, acl_request, headers)
+                return
+            result = acl_request.json()
+            if result.get("failureCount"):
+                raise AdlsCopyUtils.createResponseError(acl_request.status_code, acl_request.headers, result)
+            paths += result.get("directoriesSuccessful", 0) + result.get("filesSuccessful", 0)
+            continuation = acl_request.headers.get("x-ms-continuation")
+        if not continuation:
+            break
+    log.debug("Applied ACL recursively to %d paths beneath: %s", paths, filename)
+
+def raise_acl_error(filename, response, headers):
+    # The body may be empty or not JSON (eg. from a proxy), in which case the text is reported as is
+    err = response.text
+    try:
+        err = json.loads(err)
+    except ValueError:
+        pass
+    code = err["error"].get("code") if isinstance(err, dict) and isinstance(err.get("error"), dict) else None
+    # Allow 'PathNotFound' errors to fail silently
+    if code == "PathNotFound":
+        log.debug("Skipping missing file: %s", filename)
+    else:
+        if code == "InvalidNamedUserOrNamedGroup":
+            err["x-ms-acl"] = headers["x-ms-acl"]
+            err["owner"] = headers.get("x-ms-owner")
+            err["group"] = headers.get("x-ms-group")
+        raise AdlsCopyUtils.createResponseError(response.status_code, response.headers, err)
+
+def apply_file_acls(account, container, token_handler, acl_mapper, work_queue):
     log = logging.getLogger(threading.currentThread().name)
     log.debug("Thread starting: %d", threading.currentThread().ident)
     while not work_queue.isDone():
@@ -30,50 +89,147 @@ def apply_file_acls(account, container, token_handler, identity_map, work_queue)
                 if not filename:
                     filename = "/" 
                 log.debug(filename)
-                # Set owner & group
-                mapped_acl = [map_acl_entry(entry, identity_map) for entry in file["acl"]]
-                headers = {
-                    "x-ms-version": AdlsCopyUtils.ADLS_REST_VERSION,
-                    "content-length": "0",
-                    "Authorization": token_handler.checkAccessToken(),
-                    "x-ms-acl": ",".join(mapped_acl)
-                }
-                add_identity_header(headers, "user", file["owner"], "x-ms-owner", identity_map)
-                add_identity_header(headers, "group", file["group"], "x-ms-group", identity_map)
-                set_owner_url = "https://{0}.dfs.core.windows.net/{1}/{2}?action=setAccessControl".format(account, container, filename)
-                log.debug(set_owner_url)
-                log.debug(headers)
-                with requests.patch(set_owner_url, headers=headers) as set_owner_request:
-                    require_retry = False
-                    throw_err = False
-                    if not set_owner_request:
-                        throw_err = True
-                        err = set_owner_request.json()
-                        if "error" in err and "code" in err["error"]:
-                            # Allow 'PathNotFound' errors to fail silently
-                            code = err["error"]["code"]
-                            if code == "PathNotFound":
-                                log.debug("Skipping missing file: %s", filename)
-                                throw_err = False
-                            elif code == "InvalidNamedUserOrNamedGroup":
-                                err["m-ms-acl"] = ",".join(mapped_acl)
-                                err["owner"] = headers["owner"]
-                                err["group"] = headers["group"]
-                    if not require_retry:
-                        work_queue.itemDone()
-                    if throw_err:
-                        raise IOError(err)
+                if file.get("recursive"):
+                    set_access_control_recursive(account, container, filename, file, token_handler, acl_mapper)
+                else:
+                    set_access_control(account, container, filename, file, token_handler, acl_mapper)
+                work_queue.itemDone()
             except IOError as e:
-                log.warning("Failed to copy file: %s. Details: %s", filename, e.args)
+                log.debug("Failed to apply ACLs to file: %s. Details: %s", filename, e.args)
+                work_queue.itemFailed(file, e)
     log.debug("Thread ending")
 
+def is_descendant(name, directory):
+    return directory == "" or name.startswith(directory + "/")
+
+def access_acl(acl):
+    # The entries that a file receives when a directory's ACL is applied recursively - files can't have default entries
+    return tuple(entry for entry in acl if not entry.startswith("default:"))
+
+def with_next(entries):
+    # Pairs each entry with the one that follows it. In the (depth-first) export, a path is a directory if the next 
+    # path is beneath it.
+    entries = iter(entries)
+    current = next(entries, None)
+    for following in entries:
+        yield current, following
+        current = following
+    if current is not None:
+        yield current, None
+
+class AclPlanner:
+    # Plans the calls needed to apply the exported ACLs. Large subtrees typically share the ACL of their root 
+    # (inherited from its default ACL), so a single setAccessControlRecursive call on the root, followed by 
+    # setAccessControl calls for the paths that differ, replaces a call for every path.
+    #
+    # The export is read twice. The first pass counts the ACLs within each directory's subtree. The second pass 
+    # decides, top down, which directories are worth applying recursively & writes out the remaining exceptions. 
+    # Paths that have no children are treated as files, so an empty directory without a default ACL beneath a
+    # recursively applied directory will receive the default entries.
+    def __init__(self, min_subtree_size):
+        self.min_subtree_size = min_subtree_size
+        # Histograms of the ACLs beneath the directories that are large enough to be applied recursively
+        self.subtrees = {}
+        self.paths = 0
+        self.recursive_calls = 0
+        # Recursive items, by nesting depth
+        self.phases = []
+        self.exceptions = 0
+
+    @staticmethod
+    def matchKey(acl, is_directory):
+        return ("d" if is_directory else "f", tuple(acl))
+
+    def countSubtrees(self, entries):
+        # Each frame is [name, subtree size, histogram of subtree ACLs]
+        stack = []
+        def close():
+            name, size, histogram = stack.pop()
+            if size >= self.min_subtree_size:
+                self.subtrees[name] = (size, histogram)
+            if stack:
+                stack[-1][1] += size + 1
+                stack[-1][2].update(histogram)
+            return size
+        for entry, following in with_next(entries):
+            name = entry["file"]
+            while stack and not is_descendant(name, stack[-1][0]):
+                close()
+            if stack and name.rpartition("/")[0] != stack[-1][0]:
+                raise ValueError("Planning requires the ACLs in depth-first order, as written by export-acls.py. Out of order path: " + name)
+            is_directory = following is not None and is_descendant(following["file"], name)
+            if stack:
+                stack[-1][2][self.matchKey(entry["acl"], is_directory)] += 1
+            if is_directory:
+                stack.append([name, 0, Counter()])
+            elif stack:
+                stack[-1][1] += 1
+            self.paths += 1
+        while stack:
+            close()
+
+    @staticmethod
+    def matches(histogram, acl):
+        # The number of paths that would be correct if the directory ACL was applied recursively
+        return histogram[AclPlanner.matchKey(acl, True)] + histogram[AclPlanner.matchKey(access_acl(acl), False)]
+
+    def plan(self, entries, exceptions_fd):
+        # Each frame is [name, ACL applied to the subtree (or None)]
+        stack = []
+        for entry, following in with_next(entries):
+            name = entry["file"]
+            while stack and not is_descendant(name, stack[-1][0]):
+                stack.pop()
+            applied = stack[-1][1] if stack else None
+            is_directory = following is not None and is_descendant(following["file"], name)
+            if applied is None:
+                correct = False
+            elif is_directory:
+                correct = tuple(entry["acl"]) == applied
+            else:
+                correct = tuple(entry["acl"]) == access_acl(applied)
+            if name in self.subtrees:
+                size, histogram = self.subtrees.pop(name)
+                calls = (size + 1 + AdlsCopyUtils.RECURSIVE_ACL_PAGE_SIZE - 1) // AdlsCopyUtils.RECURSIVE_ACL_PAGE_SIZE
+                saved = self.matches(histogram, entry["acl"]) + (0 if correct else 1)
+                if applied is not None:
+                    saved -= self.matches(histogram, applied)
+                if saved > calls:
+                    depth = len(stack)
+                    while len(self.phases) <= depth:
+                        self.phases.append([])
+                    item = dict(entry)
+                    item["recursive"] = True
+                    self.phases[depth].append(item)
+                    self.recursive_calls += calls
+                    applied = tuple(entry["acl"])
+                    correct = True
+            if not correct:
+                exceptions_fd.write(json.dumps(entry) + "\n")
+                self.exceptions += 1
+            if is_directory:
+                stack.append([name, applied])
+
+    def logStats(self):
+        recursive_items = sum(len(phase) for phase in self.phases)
+        log.info("ACL plan for %d paths: %d recursive applications in %d phases (approx. %d calls) & %d individual paths. Saves approx. %d calls.", 
+            self.paths, recursive_items, len([phase for phase in self.phases if phase]), self.recursive_calls, self.exceptions, self.paths - self.recursive_calls - self.exceptions)
+
 if __name__ == '__main__':
     parser = AdlsCopyUtils.createCommandArgsParser("Apply ACLs to ADLS account", False, (True, False))
     parser.add_argument('-g', '--generate-identity-map', action='store_true', help="Specify this flag to generate a based identity mapping file using the unique identities in the source account. The identity map will be written to the file specified by the --identity-map argument.")
-    parser.add_argument('-s', '--source-acls', help="The filename containing the JSON definition. If omitted, input is read from stdin")
+    parser.add_argument('-s', '--source-acls', help="The filename containing the ACLs exported by export-acls.py. If omitted, input is read from stdin")
+    parser.add_argument('-R', '--recursive', action='store_true', help="Plan the ACL changes so that directories whose subtree mostly shares their ACL are applied with a single recursive call, followed by individual calls for the paths that differ. The owner & group of paths covered by a recursive call are not changed (they are set by copy-to-adls.py). Requires two passes over the source ACLs.")
+    parser.add_argument('--recursive-min-paths', type=int, default=100, help="The minimum number of paths beneath a directory for it to be considered for a recursive call")
+    parser.add_argument('-T', '--temp-dir', help="The directory used for the temporary files written while planning recursive changes. Defaults to the system temp directory.")
     args = parser.parse_known_args()[0]
+    if args.shard and (args.recursive or args.generate_identity_map):
+        parser.error("--shard can't be used with --recursive or --generate-identity-map, as these need to see every path")
 
     AdlsCopyUtils.configureLogging(args.log_config, args.log_level, args.log_file)
+    AdlsCopyUtils.configureHttpSessions(args.max_parallelism)
+    AdlsCopyUtils.configureMetrics(args)
+    AdlsCopyUtils.configureEndpoints(args)
     print("Processing source ACLs")
 
     # Queue the items up
@@ -83,15 +239,16 @@ if __name__ == '__main__':
 
     if args.generate_identity_map:
         log.info("Generating identity map from source account to file: " + args.identity_map)
-        acls = json.load(source_fd)
-        unique_users = set([item.split(":")[1] 
-            for file in acls 
-            for item in file["acl"]+["user:"+file["owner"]+":"] 
-                if item.split(":")[0] == "user" and item.split(":")[1]]) 
-        unique_groups = set([item.split(":")[1] 
-            for file in acls 
-            for item in file["acl"]+["group:"+file["group"]+":"] 
-                if item.split(":")[0] == "group" and item.split(":")[1]]) 
+        # Single pass over the (streamed) ACLs
+        unique_users = set()
+        unique_groups = set()
+        for file in AdlsCopyUtils.loadAcls(source_fd):
+            for item in file["acl"] + ["user:" + file["owner"] + ":", "group:" + file["group"] + ":"]:
+                entry_parts = item.split(":")
+                if entry_parts[0] == "user" and entry_parts[1]:
+                    unique_users.add(entry_parts[1])
+                elif entry_parts[0] == "group" and entry_parts[1]:
+                    unique_groups.add(entry_parts[1])
         identities = [
             {
                 "type": identity_type["type"],
@@ -103,8 +260,8 @@ if __name__ == '__main__':
         with open(args.identity_map, "w+") as f:
             json.dump(identities, f)
     else:
-        # Load identity map
-        identity_map = AdlsCopyUtils.loadIdentityMap(args.identity_map)
+        # Load identity map (& the directory used to resolve identities missing from it)
+        identity_map = AdlsCopyUtils.createIdentityResolver(args)
 
         if not args.dest_account or not args.dest_container:
             parser.print_help()
@@ -113,10 +270,46 @@ if __name__ == '__main__':
         # OAuth token handler
         token_handler = OAuthBearerToken(args.dest_spn_id, args.dest_spn_secret)
 
+        stats = {}
+        def process_items(work_items):
+            acl_args = [args.dest_account, args.dest_container, token_handler, acl_mapper]
+            work_items = AdlsCopyUtils.filterShard(work_items, args.shard, "file")
+            if args.engine == AdlsCopyUtils.ENGINE_ASYNCIO:
+                import adls_copy_async
+                AdlsCopyUtils.mergeStats(stats, adls_copy_async.processWorkQueue(adls_copy_async.apply_file_acls, acl_args, work_items, args.max_parallelism, args.max_retries, args.dead_letter_file))
+            else:
+                AdlsCopyUtils.mergeStats(stats, AdlsCopyUtils.processWorkQueue(apply_file_acls, acl_args, work_items, args.max_parallelism, args.max_retries, args.dead_letter_file))
+
+        acl_mapper = AclMapper(identity_map)
         log.info("Applying ACLs in destination")
-        AdlsCopyUtils.processWorkQueue(apply_file_acls,
-            [args.dest_account, args.dest_container, token_handler, identity_map],
-            json.load(source_fd),
-            args.max_parallelism)
+        if args.replay_dead_letters:
+            process_items(AdlsCopyUtils.loadDeadLetters(args.replay_dead_letters))
+        elif args.recursive:
+            if source_fd is sys.stdin:
+                # Planning requires multiple passes
+                spooled_fd = tempfile.TemporaryFile(mode="w+", dir=args.temp_dir)
+                shutil.copyfileobj(source_fd, spooled_fd)
+                source_fd = spooled_fd
+            planner = AclPlanner(args.recursive_min_paths)
+            log.info("Planning ACL changes")
+            planner.countSubtrees(AdlsCopyUtils.loadAcls(source_fd))
+            source_fd.seek(0)
+            with tempfile.TemporaryFile(mode="w+", dir=args.temp_dir) as exceptions_fd:
+                planner.plan(AdlsCopyUtils.loadAcls(source_fd), exceptions_fd)
+                exceptions_fd.seek(0)
+                planner.logStats()
+                # Each level of recursive changes must complete before the level beneath it, and the exceptions are 
+                # applied last
+                for depth, phase in enumerate(planner.phases):
+                    if phase:
+                        log.info("Applying %d recursive ACLs at depth %d", len(phase), depth)
+                        process_items(phase)
+                log.info("Applying %d individual ACLs", planner.exceptions)
+                process_items(AdlsCopyUtils.loadAcls(exceptions_fd))
+        else:
+            process_items(AdlsCopyUtils.loadAcls(source_fd))
+        identity_map.close()
+        if args.stats_file:
+            AdlsCopyUtils.writeStats(args.stats_file, stats)
 
     print("All work processed. Exiting")
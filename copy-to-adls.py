@@ -1,25 +1,25 @@
 #!/usr/bin/env python
 
 import requests
-import subprocess, datetime, json, itertools, os.path, threading, argparse, logging
-from adls_copy_utils import AdlsCopyUtils, OAuthBearerToken
+import subprocess, datetime, json, itertools, os.path, threading, argparse, logging, hashlib, base64, heapq
+from adls_copy_utils import AdlsCopyUtils, OAuthBearerToken, CopyJournal, RequestStats, Inventory, VerificationManifest
 
 BLOCK_SIZE = 20 * pow(2, 20)
 
 log = logging.getLogger(__name__)
 
 def add_identity_header(headers, identity_type, identity, header, identity_map):
+    # Identities missing from the map are resolved via the directory (if any) by lookupIdentity
     mapped_identity = AdlsCopyUtils.lookupIdentity(identity_type, identity, identity_map)
     if mapped_identity:
         headers[header] = mapped_identity
-    else:
-        # TODO: Lookup identity in AAD
-        pass
 
-def create_adls_resource(account, container, resource_type, resource, token_handler, identity_map):
-    resource_uri = "https://{0}.dfs.core.windows.net/{1}/{2}?resource={3}".format(account, container, resource["name"], resource_type)
+def create_adls_resource(account, container, resource_type, resource, token_handler, identity_map, inherited_group=None):
+    # Returns the owning group of the new resource, if known
+    resource_uri = "{0}/{1}/{2}?resource={3}".format(AdlsCopyUtils.dfsEndpoint(account), container, resource["name"], resource_type)
     log.debug(resource_uri)
-    create_request = requests.put(resource_uri,
+    http = AdlsCopyUtils.httpSession()
+    create_request = http.put(resource_uri,
         headers = {
             "x-ms-version": AdlsCopyUtils.ADLS_REST_VERSION,
             "content-length": "0", 
@@ -27,79 +27,409 @@ def create_adls_resource(account, container, resource_type, resource, token_hand
             "x-ms-umask": "0000",
             "Authorization": token_handler.checkAccessToken()
         })
-    if create_request:
-        # Set owner & group
+    AdlsCopyUtils.raiseForResponse(create_request)
+    # Set owner & group
+    headers = {
+        "x-ms-version": AdlsCopyUtils.ADLS_REST_VERSION,
+        "content-length": "0",
+        "Authorization": token_handler.checkAccessToken()
+    }
+    add_identity_header(headers, "user", resource["permissions"]["owner"], "x-ms-owner", identity_map)
+    add_identity_header(headers, "group", resource["permissions"]["group"], "x-ms-group", identity_map)
+    group = headers.get("x-ms-group")
+    if resource_type == "file":
+        # A new file is owned by the caller & inherits the group of its parent directory, so don't send a request
+        # that won't change anything. Directories always get an explicit owner & group, as they may already exist.
+        if headers.get("x-ms-owner") == token_handler.getObjectId():
+            del headers["x-ms-owner"]
+        if group and group == inherited_group:
+            del headers["x-ms-group"]
+        if "x-ms-owner" not in headers and "x-ms-group" not in headers:
+            log.debug("Skipping setAccessControl for %s", resource["name"])
+            return group
+    set_owner_url = "{0}/{1}/{2}?action=setAccessControl".format(AdlsCopyUtils.dfsEndpoint(account), container, resource["name"])
+    log.debug(set_owner_url)
+    log.debug(headers)
+    set_owner_request = http.patch(set_owner_url, headers=headers)
+    AdlsCopyUtils.raiseForResponse(set_owner_request)
+    return group
+
+class RangeCopy:
+    # Tracks the ranges of a large file that are being appended concurrently by multiple workers
+    def __init__(self, file, block_size, start_offset=0):
+        self.file = file
+        self.block_size = block_size
+        self.start_offset = start_offset
+        self.range_count = (file["length"] - start_offset + block_size - 1) // block_size
+        # The offsets of the ranges that have been appended. A range whose flush fails is retried, so it may complete
+        # more than once.
+        self.completed = set()
+        # Set when one of the ranges has exhausted its retries - the remaining ranges are then skipped
+        self.abandoned = False
+        # The MD5 of each range, if the file is being hashed. A resumed file can't be hashed as a whole.
+        self.range_md5s = {} if start_offset == 0 else None
+        self.mutex = threading.Lock()
+
+    def ranges(self):
+        for offset in range(self.start_offset, self.file["length"], self.block_size):
+            yield {
+                "name": self.file["name"],
+                "range_copy": self,
+                "offset": offset,
+                "length": min(self.block_size, self.file["length"] - offset)
+            }
+
+    def rangeMd5(self, offset, md5):
+        with self.mutex:
+            self.range_md5s[offset] = md5
+
+    def md5OfRanges(self):
+        return hashlib.md5(b"".join(self.range_md5s[offset] for offset in sorted(self.range_md5s))).digest()
+
+    def abandon(self):
+        # Returns True for the first range to be abandoned, which is then responsible for dead-lettering the file
+        with self.mutex:
+            first = not self.abandoned
+            self.abandoned = True
+            return first
+
+    def rangeDone(self, offset):
+        # Returns True once every range has completed, for the range that is then responsible for flushing the file
+        with self.mutex:
+            self.completed.add(offset)
+            return len(self.completed) == self.range_count
+
+class HashingReader:
+    # Wraps the source response stream, hashing the bytes as they are read by the destination request
+    def __init__(self, raw, length, hasher):
+        self.raw = raw
+        self.length = length
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.hasher.update(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(64 * 1024), b"")
+
+    def __len__(self):
+        return self.length
+
+def copy_range(source_url, dest_base_url, offset, length, token_handler, flush=False, hasher=None, content_md5=None):
+    http = AdlsCopyUtils.httpSession()
+    with http.get(source_url, 
+            headers = {
+                "x-ms-range": "bytes={0}-{1}".format(offset, offset + length - 1)
+            }, 
+            stream=True) as source_request:
+        AdlsCopyUtils.raiseForResponse(source_request)
+        source_request.raw.decode_content = True
+        source_request.raw.__dict__["len"] = int(source_request.headers["Content-Length"])
+        data = source_request.raw
+        if hasher:
+            data = HashingReader(source_request.raw, int(source_request.headers["Content-Length"]), hasher)
+        append_url = dest_base_url + "action=append&position=" + str(offset)
         headers = {
-            "x-ms-version": AdlsCopyUtils.ADLS_REST_VERSION,
-            "content-length": "0",
             "Authorization": token_handler.checkAccessToken()
         }
-        add_identity_header(headers, "user", resource["permissions"]["owner"], "x-ms-owner", identity_map)
-        add_identity_header(headers, "group", resource["permissions"]["group"], "x-ms-group", identity_map)
-        set_owner_url = "https://{0}.dfs.core.windows.net/{1}/{2}?action=setAccessControl".format(account, container, resource["name"])
-        log.debug(set_owner_url)
-        log.debug(headers)
-        set_owner_request = requests.patch(set_owner_url, headers=headers)
-        if not set_owner_request:
-            raise IOError(set_owner_request.json())
+        if flush:
+            # Commit the file in the same request as the data
+            append_url += "&flush=true"
+            headers["x-ms-version"] = AdlsCopyUtils.ADLS_APPEND_FLUSH_REST_VERSION
+        if content_md5:
+            # The service rejects the append if the data doesn't match
+            headers["Content-MD5"] = content_md5
+        dest_request = http.patch(append_url, headers=headers, data=data)
+        AdlsCopyUtils.raiseForResponse(dest_request)
+
+def flush_file(dest_base_url, length, token_handler, md5=None):
+    headers = {
+        "content-length": "0",
+        "Authorization": token_handler.checkAccessToken()
+    }
+    if md5:
+        # Stored as the file's Content-MD5 property
+        headers["x-ms-version"] = AdlsCopyUtils.ADLS_REST_VERSION
+        headers["x-ms-content-md5"] = base64.b64encode(md5).decode("ascii")
+    dest_request = AdlsCopyUtils.httpSession().patch(dest_base_url + "action=flush&position=" + str(length), headers=headers)
+    AdlsCopyUtils.raiseForResponse(dest_request)
+
+def commit_file(dest_base_url, file, token_handler, journal, manifest=None, md5=None):
+    try:
+        if md5:
+            if manifest:
+                manifest.verify(file, md5)
+            else:
+                VerificationManifest.checkMd5(file, md5)
+        flush_file(dest_base_url, file["length"], token_handler, md5)
+    except IOError:
+        if journal:
+            # The appended data may have been discarded (eg. if we're resuming a copy after a long time), so the next
+            # attempt must copy the whole file again
+            journal.recordCreated(file["name"])
+        raise
+    if journal:
+        journal.recordFlushed(file["name"], file["length"])
+
+class DirectoryTracker:
+    # Directories are created by the workers, in parallel with copying files. An item is only handed to the workers 
+    # once its parent directory exists, so directories are created level by level, parents before children. 
+    # Directories that don't have files beneath them never hold up any copying.
+    #
+    # The items waiting for their directories are held in memory, so once max_held of them are waiting, the listing
+    # isn't read any further until some of them have been released.
+    def __init__(self, ordered=True, max_held=0):
+        self.mutex = threading.Lock()
+        self.released = threading.Condition(self.mutex)
+        # Directories that haven't been created yet & the items waiting for them
+        self.pending = {}
+        self.held = 0
+        self.max_held = max_held
+        # The owning group of each created directory, which is inherited by the files created beneath it. Each item 
+        # is given its parent's group as it is handed to the workers.
+        self.groups = {}
+        # When the listing is lexically ordered, a directory's group is dropped once the listing has moved past its
+        # contents. The heap holds (first name beyond the directory's contents, directory) for those still open.
+        self.ordered = ordered
+        self.open_directories = []
+        self.open = set()
+
+    def schedule(self, inventory):
+        # The listing is lexically ordered, so a directory is always listed before its contents
+        for item in inventory:
+            with self.mutex:
+                # Every item yielded so far has been handed to the workers, so the directories the held items are 
+                # waiting for are being created
+                while self.max_held and self.held >= self.max_held:
+                    self.released.wait()
+                if self.ordered:
+                    self._closeDirectories(item["name"])
+                waiting = self.pending.get(item["parent_directory"])
+                if waiting is not None:
+                    waiting.append(item)
+                    self.held += 1
+                else:
+                    item = self._withGroup(item, self.groups.get(item["parent_directory"]))
+                if item["is_folder"]:
+                    self.pending[item["name"]] = []
+                    if self.ordered:
+                        # All of the directory's contents sort before its name followed by the character after '/'
+                        heapq.heappush(self.open_directories, (item["name"] + chr(ord("/") + 1), item["name"]))
+                        self.open.add(item["name"])
+            if waiting is None:
+                yield item
+
+    def _closeDirectories(self, name):
+        while self.open_directories and self.open_directories[0][0] <= name:
+            _, directory = heapq.heappop(self.open_directories)
+            self.open.discard(directory)
+            self.groups.pop(directory, None)
+
+    def directoryCreated(self, name, group=None):
+        # Returns the items that were waiting for this directory
+        with self.mutex:
+            if group and (name in self.open or not self.ordered):
+                self.groups[name] = group
+            waiting = self.pending.pop(name, [])
+            if waiting:
+                self.held -= len(waiting)
+                self.released.notify_all()
+        return [self._withGroup(item, group) for item in waiting]
+
+    @staticmethod
+    def _withGroup(item, group):
+        # Listing entries may be read-only views (see Inventory), so the group is added to a copy
+        if not group:
+            return item
+        item = dict(item)
+        item["parent_group"] = group
+        return item
+
+class SyncFilter:
+    # Compares the source listing with the destination, passing through only the paths that are missing from the
+    # destination or have changed since they were copied. Both listings are streamed in lexical order & merge-joined.
+    def __init__(self, deletions_file=None):
+        self.deletions_file = deletions_file
+        self.missing = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.deleted = 0
+
+    @staticmethod
+    def isChanged(source, dest):
+        # The destination's last-modified time is when it was copied, so the source has changed if it was modified later
+        if source["is_folder"] or dest["is_folder"]:
+            return source["is_folder"] != dest["is_folder"]
+        return (source["length"] != dest["length"] or 
+            AdlsCopyUtils.parseHttpDate(source["last_modified"]) > AdlsCopyUtils.parseHttpDate(dest["last_modified"]))
+
+    def filter(self, source, dest):
+        deletions = open(self.deletions_file, "w") if self.deletions_file else None
+        try:
+            for source_entry, dest_entry in AdlsCopyUtils.mergeListings(source, dest):
+                if dest_entry is None:
+                    self.missing += 1
+                    yield source_entry
+                elif source_entry is None:
+                    self.deleted += 1
+                    if deletions:
+                        deletions.write(json.dumps(dest_entry) + "\n")
+                elif self.isChanged(source_entry, dest_entry):
+                    self.changed += 1
+                    yield source_entry
+                else:
+                    self.unchanged += 1
+        finally:
+            if deletions:
+                deletions.close()
+
+    def logStats(self):
+        log.info("Sync: %d missing, %d changed, %d unchanged & %d only in the destination", self.missing, self.changed, self.unchanged, self.deleted)
+
+def create_directory(dest_account, dest_container, directory, token_handler, identity_map, journal, directory_tracker, work_queue):
+    log.debug(directory["name"])
+    if not (journal and journal.lookup(directory["name"])):
+        group = create_adls_resource(dest_account, 
+            dest_container,
+            "directory",
+            directory,
+            token_handler,
+            identity_map)
+        if journal:
+            journal.recordFlushed(directory["name"])
+    else:
+        group = AdlsCopyUtils.lookupIdentity(AdlsCopyUtils.IDENTITY_GROUP, directory["permissions"]["group"], identity_map)
+    release_children(directory, directory_tracker, work_queue, group)
+
+def release_children(directory, directory_tracker, work_queue, group=None):
+    for item in directory_tracker.directoryCreated(directory["name"], group):
+        work_queue.addItem(item, bounded=False)
+
+def copy_file(source_url, dest_base_url, dest_account, dest_container, file, token_handler, identity_map, block_size, parallel_copy_threshold, fast_path, journal, manifest, directory_tracker, work_queue):
+    log.debug(file["name"])
+    progress = journal.lookup(file["name"]) if journal else None
+    start_offset = 0
+    if not progress:
+        # Create the destination file
+        create_adls_resource(dest_account, 
+            dest_container,
+            "file",
+            file,
+            token_handler,
+            identity_map,
+            file.get("parent_group"))
+        if journal:
+            journal.recordCreated(file["name"])
+    elif progress[0] == CopyJournal.STATE_FLUSHED:
+        log.debug("Skipping previously copied file: %s", file["name"])
+        return
+    else:
+        # Resume a partially copied file from the last appended position
+        start_offset = progress[1]
+        log.debug("Resuming copy of %s from offset %d", file["name"], start_offset)
+        journal.recordCreated(file["name"], start_offset)
+    file_block_size = AdlsCopyUtils.getBlockSize(file["length"], block_size)
+    # The file is hashed as it is copied, unless we're resuming part way through
+    hasher = hashlib.md5() if start_offset == 0 else None
+    if fast_path and start_offset == 0 and file["length"] <= file_block_size:
+        # Small files are appended & flushed in a single request. An empty file is complete once it is created.
+        # The source MD5 (if any) is checked by the service before the data is committed, so the file is only hashed 
+        # for the manifest.
+        if file["length"] > 0:
+            copy_range(source_url, dest_base_url, 0, file["length"], token_handler, flush=True, hasher=hasher if manifest else None, content_md5=file.get("content_md5"))
+        if journal:
+            journal.recordFlushed(file["name"], file["length"])
+        if manifest:
+            manifest.write(file, hasher.digest())
+    elif file["length"] - start_offset > parallel_copy_threshold:
+        # Split the file into ranges that any of the workers can append at their own offset. The last 
+        # range to complete flushes the file.
+        range_copy = RangeCopy(file, file_block_size, start_offset)
+        log.debug("Copying %s as %d parallel ranges", file["name"], range_copy.range_count)
+        for file_range in range_copy.ranges():
+            work_queue.addItem(file_range, bounded=False)
     else:
-        raise IOError(create_request.json())
+        # Copy the file, a block at a time
+        for offset in range(start_offset, file["length"], file_block_size):
+            length = min(file_block_size, file["length"] - offset)
+            copy_range(source_url, dest_base_url, offset, length, token_handler, hasher=hasher)
+            if journal:
+                journal.recordAppend(file["name"], offset, length)
+        # Flush the file
+        commit_file(dest_base_url, file, token_handler, journal, manifest, hasher.digest() if hasher else None)
+        if manifest:
+            manifest.write(file, hasher.digest() if hasher else None)
 
-def copy_files(source_account, source_container, dest_account, dest_container, sas_token, token_handler, identity_map, work_queue):
+def copy_file_range(source_url, dest_base_url, file_range, token_handler, journal, manifest):
+    # A range of a large file, being copied in parallel with its other ranges
+    range_copy = file_range["range_copy"]
+    if range_copy.abandoned:
+        log.debug("Skipping range of abandoned file: %s", file_range["name"])
+        return
+    log.debug("%s [%d-%d]", file_range["name"], file_range["offset"], file_range["offset"] + file_range["length"] - 1)
+    hasher = hashlib.md5() if manifest and range_copy.range_md5s is not None else None
+    copy_range(source_url, dest_base_url, file_range["offset"], file_range["length"], token_handler, hasher=hasher)
+    if hasher:
+        range_copy.rangeMd5(file_range["offset"], hasher.digest())
+    if journal:
+        journal.recordAppend(file_range["name"], file_range["offset"], file_range["length"])
+    if range_copy.rangeDone(file_range["offset"]):
+        commit_file(dest_base_url, range_copy.file, token_handler, journal)
+        if manifest:
+            manifest.write(range_copy.file, range_copy.md5OfRanges() if hasher else None, VerificationManifest.MD5_OF_RANGES, range_copy.block_size)
+        log.debug("Completed parallel copy of %s", file_range["name"])
+
+def copy_files(source_account, source_container, dest_account, dest_container, sas_token, token_handler, identity_map, block_size, parallel_copy_threshold, fast_path, journal, manifest, directory_tracker, request_stats, work_queue):
     log = logging.getLogger(threading.currentThread().name)
     log.debug("Thread starting: %d", threading.currentThread().ident)
     while not work_queue.isDone():
         file = work_queue.nextItem()
         if file:
+            requests_before = AdlsCopyUtils.http_sessions.threadRequestCount()
             try:
-                log.debug(file["name"])
-                # Create the destination file
-                create_adls_resource(dest_account, 
-                    dest_container,
-                    "file",
-                    file,
-                    token_handler,
-                    identity_map)
-                # Copy the file, 20MB chunks at a time
-                source_url = "http://{0}.blob.core.windows.net/{1}/{2}?{3}".format(source_account, source_container, file["name"], sas_token)
-                dest_base_url = "https://{0}.dfs.core.windows.net/{1}/{2}?".format(dest_account, dest_container, file["name"])
-                for offset in range(0, file["length"], BLOCK_SIZE):
-                    source_request = requests.get(source_url, 
-                        headers = {
-                            "x-ms-range": "bytes={0}-{1}".format(offset, offset + BLOCK_SIZE - 1)
-                        }, 
-                        stream=True)
-                    if source_request:
-                        source_request.raw.decode_content = True
-                        source_request.raw.__dict__["len"] = int(source_request.headers["Content-Length"])
-                        dest_request = requests.patch(dest_base_url + "action=append&position=" + str(offset), 
-                            headers = {
-                                "Authorization": token_handler.checkAccessToken()
-                            },
-                            data = source_request.raw)
-                        if not dest_request:
-                            raise IOError(dest_request.json())
-                    else:
-                        raise IOError(source_request.json())
-                # Flush the file
-                dest_request = requests.patch(dest_base_url + "action=flush&position=" + str(file["length"]),
-                    headers={
-                        "content-length": "0",
-                        "Authorization": token_handler.checkAccessToken()
-                    })
-                if not dest_request:
-                    raise IOError(dest_request.json())
-
+                source_url = "{0}/{1}/{2}?{3}".format(AdlsCopyUtils.blobEndpoint(source_account, "http"), source_container, file["name"], sas_token)
+                dest_base_url = "{0}/{1}/{2}?".format(AdlsCopyUtils.dfsEndpoint(dest_account), dest_container, file["name"])
+                if "range_copy" in file:
+                    copy_file_range(source_url, dest_base_url, file, token_handler, journal, manifest)
+                    kind = "range"
+                elif file["is_folder"]:
+                    create_directory(dest_account, dest_container, file, token_handler, identity_map, journal, directory_tracker, work_queue)
+                    kind = "directory"
+                else:
+                    copy_file(source_url, dest_base_url, dest_account, dest_container, file, token_handler, identity_map, block_size, parallel_copy_threshold, fast_path, journal, manifest, directory_tracker, work_queue)
+                    kind = "file"
+                request_stats.record(kind, AdlsCopyUtils.http_sessions.threadRequestCount() - requests_before)
                 work_queue.itemDone()
             except IOError as e:
-                log.warning("Failed to copy file: %s. Details: %s", file["name"], e.args)
+                log.debug("Failed to copy file: %s. Details: %s", file["name"], e.args)
+                if "range_copy" in file:
+                    # A range can't be copied in isolation, so if it is abandoned the whole file is dead-lettered (once)
+                    # & its remaining ranges are skipped
+                    range_copy = file["range_copy"]
+                    work_queue.itemFailed(file, e, on_abandoned=lambda: range_copy.file if range_copy.abandon() else None)
+                elif not work_queue.itemFailed(file, e) and file["is_folder"]:
+                    # Don't hold up the directory's contents - creating them will implicitly create the directory
+                    release_children(file, directory_tracker, work_queue)
     log.debug("Thread ending")
 
 if __name__ == '__main__':
     parser = AdlsCopyUtils.createCommandArgsParser("Remaps identities on HDFS sourced data", add_dest_args=True)
+    parser.add_argument('-b', '--block-size', type=int, default=BLOCK_SIZE // pow(2, 20), help="The size (in MB) of each block copied. Very large files will use larger blocks, up to {0}MB".format(AdlsCopyUtils.MAX_APPEND_SIZE // pow(2, 20)))
+    parser.add_argument('-j', '--journal', help="The name of a journal file that records the progress of the copy. If the copy is interrupted, re-running with the same journal skips files that have already been copied & resumes partially copied files.")
+    parser.add_argument('-P', '--parallel-copy-threshold', type=int, default=4 * BLOCK_SIZE // pow(2, 20), help="Files larger than this size (in MB) are split into blocks that are copied by multiple threads in parallel")
+    parser.add_argument('--largest-first', action='store_true', help="Load the whole listing (in a compact form) before copying, so that all of the directories are created first & files are copied largest first. This avoids a single large file prolonging the end of the copy.")
+    parser.add_argument('-m', '--manifest', help="The name of a verification manifest file. Each file is hashed (MD5) as it is copied, checked against the source Content-MD5 (if it has one) & recorded in the manifest. Use verify-copy.py to compare manifests.")
+    parser.add_argument('--sync', action='store_true', help="Only copy files & directories that are missing from the destination, or whose length differs or were modified after they were copied. Use a new journal (if any) for each sync.")
+    parser.add_argument('--deletions-report', help="With --sync, the name of a file to write the paths that exist in the destination but not the source to (one JSON object per line)")
+    parser.add_argument('--no-fast-path', action='store_true', help="Don't append & flush small files in a single request. Use this if the destination doesn't support version {0} of the REST API.".format(AdlsCopyUtils.ADLS_APPEND_FLUSH_REST_VERSION))
     args = parser.parse_known_args()[0]
 
     AdlsCopyUtils.configureLogging(args.log_config, args.log_level, args.log_file)
+    AdlsCopyUtils.configureHttpSessions(args.max_parallelism)
+    AdlsCopyUtils.configureMetrics(args)
+    AdlsCopyUtils.configureEndpoints(args)
     print("Copying directories, files and permissions from account: " + args.source_account + " to: " + args.dest_account)
 
     # OAuth token handler
@@ -108,27 +438,57 @@ if __name__ == '__main__':
     # Acquire SAS token, so that we don't have to sign each request (construct as string as Python 2.7 on linux doesn't marshall the args correctly with shell=True)
     sas_token = AdlsCopyUtils.getSasToken(args.source_account, args.source_key)
 
-    # Get the full account list 
-    inventory = AdlsCopyUtils.getSourceFileList(args.source_account, args.source_key, args.source_container, args.prefix)
+    # Stream the account list - listing continues while the files are being copied
+    if args.replay_dead_letters:
+        inventory = AdlsCopyUtils.loadDeadLetters(args.replay_dead_letters)
+    else:
+        inventory = AdlsCopyUtils.getSourceFileList(args.source_account, sas_token, args.source_container, args.prefix)
+    sync_filter = None
+    if args.sync and not args.replay_dead_letters:
+        sync_filter = SyncFilter(args.deletions_report)
+        inventory = sync_filter.filter(inventory, AdlsCopyUtils.getDestinationFileList(args.dest_account, args.dest_container, token_handler, args.prefix))
+    # Directories are sharded like files. A file whose parent belongs to another shard is created straight away - ADLS
+    # creates any missing parents, which the other shard then updates with the correct permissions.
+    inventory = AdlsCopyUtils.filterShard(inventory, args.shard)
+    if args.largest_first:
+        listing = Inventory(inventory)
+        log.info("Loaded listing of %d items", len(listing))
+        inventory = itertools.chain(listing.folderEntries(), listing.filesBySize())
     
-    # Load identity map
-    identity_map = AdlsCopyUtils.loadIdentityMap(args.identity_map)
-
-    # Create the directories first
-    log.info("Creating directory structure in destination")
-    for directory in [x for x in inventory if x["is_folder"]]:
-        dir_base_url = "https://{0}.dfs.core.windows.net/{1}/{2}".format(args.dest_account, args.dest_container, directory["name"])
-        create_adls_resource(args.dest_account, 
-            args.dest_container,
-            "directory",
-            directory,
-            token_handler,
-            identity_map)
-    # Now copy the files in parallel
-    log.info("Copying files from source to destination")
-    AdlsCopyUtils.processWorkQueue(copy_files, 
-        [args.source_account, args.source_container, args.dest_account, args.dest_container, sas_token, token_handler, identity_map], 
-        [file for file in inventory if not file["is_folder"]], 
-        args.max_parallelism)
+    # Load identity map (& the directory used to resolve identities missing from it)
+    identity_map = AdlsCopyUtils.createIdentityResolver(args)
+
+    journal = CopyJournal(args.journal) if args.journal else None
+    manifest = VerificationManifest(args.manifest) if args.manifest else None
+
+    # Directories are created by the workers, alongside the file copies. The items waiting for their directories count
+    # against the same window of the listing as the work queue.
+    max_held = args.max_parallelism * AdlsCopyUtils.WORK_QUEUE_DEPTH_PER_THREAD
+    # A replayed dead letter file or a listing copied largest first isn't lexically ordered
+    directory_tracker = DirectoryTracker(ordered=not (args.largest_first or args.replay_dead_letters), max_held=max_held)
+    request_stats = RequestStats()
+
+    log.info("Creating directory structure and copying files from source to destination")
+    copy_args = [args.source_account, args.source_container, args.dest_account, args.dest_container, sas_token, token_handler, identity_map, 
+        min(args.block_size * pow(2, 20), AdlsCopyUtils.MAX_APPEND_SIZE), args.parallel_copy_threshold * pow(2, 20), not args.no_fast_path, journal, manifest, directory_tracker, request_stats]
+    if args.engine == AdlsCopyUtils.ENGINE_ASYNCIO:
+        import adls_copy_async
+        stats = adls_copy_async.processWorkQueue(adls_copy_async.copy_files, copy_args, directory_tracker.schedule(inventory), args.max_parallelism, args.max_retries, args.dead_letter_file, 
+            on_abandoned=adls_copy_async.copy_files_abandoned)
+    else:
+        stats = AdlsCopyUtils.processWorkQueue(copy_files, copy_args, directory_tracker.schedule(inventory), args.max_parallelism, args.max_retries, args.dead_letter_file)
+    identity_map.close()
+    if journal:
+        journal.close()
+    if manifest:
+        manifest.close()
+    request_stats.logStats()
+    if sync_filter:
+        sync_filter.logStats()
+    if args.stats_file:
+        stats["requests_per_item"] = request_stats.toDict()
+        if sync_filter:
+            stats["sync"] = {"missing": sync_filter.missing, "changed": sync_filter.changed, "unchanged": sync_filter.unchanged, "deleted": sync_filter.deleted}
+        AdlsCopyUtils.writeStats(args.stats_file, stats)
 
     print("All work processed. Exiting")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+# Copies the paths in a file list produced by generate-file-list.py to a Data Box, running a bounded number of distcp
+# jobs at a time. Unlike distcp-to-databox.sh, which submits a job for every path at once, new jobs are only started
+# as others complete, so neither the YARN queue nor the Data Box is overloaded. The existence of every destination
+# path is checked up front using a few batched listings, rather than a 'hadoop fs -test' per path.
+#
+# When the sizes of the paths are available (generate-file-list.py --write-sizes), the largest paths are started first
+# and the total size of the paths being copied at once is capped by --max-inflight-size, so a few very large
+# directories can't starve the rest & the copy doesn't end with one long job running on its own.
+
+import sys, subprocess, threading, argparse, logging, shlex, os, time, collections
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+log = logging.getLogger(__name__)
+
+# The number of paths checked by each 'hadoop fs -ls -d' call
+EXISTS_BATCH_SIZE = 200
+# The number of lines of output logged when a job fails
+FAILED_OUTPUT_LINES = 20
+
+def readFileList(fileList, sizesFile):
+    # Returns a list of {path, size} in file list order. Paths without a known size are given a size of None.
+    sizes = {}
+    if sizesFile:
+        with open(sizesFile) as fp:
+            for line in fp:
+                size, _, path = line.rstrip("\r\n").partition("\t")
+                if path:
+                    sizes[path] = int(size)
+    with open(fileList) as fp:
+        paths = [line.rstrip("\r\n") for line in fp if line.strip()]
+    return [{'path': path, 'size': sizes.get(path)} for path in paths]
+
+def hadoopFsCommand(hadoopOpts, destDnsName, destAccountKey):
+    command = ["hadoop", "fs"] + hadoopOpts
+    if destAccountKey:
+        command += ["-D", "fs.azure.account.key.{0}={1}".format(destDnsName, destAccountKey)]
+    return command
+
+def findExistingPaths(destRoot, paths, fsCommand):
+    # Lists the destination paths (without their contents) in batches. Paths that don't exist are reported on stderr
+    # & cause a non-zero exit code, but the ones that do are still listed.
+    existing = set()
+    for idx in range(0, len(paths), EXISTS_BATCH_SIZE):
+        batch = paths[idx:idx + EXISTS_BATCH_SIZE]
+        process = subprocess.Popen(fsCommand + ["-ls", "-d"] + [destRoot + path for path in batch], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        stdout, stderr = process.communicate()
+        for line in stdout.splitlines():
+            # The path is the last value & may contain spaces
+            fields = line.split(None, 7)
+            if len(fields) == 8 and fields[7].startswith(destRoot):
+                existing.add(fields[7][len(destRoot):])
+        errors = [line for line in stderr.splitlines() if line.startswith("ls:") and "No such file or directory" not in line]
+        if process.returncode != 0 and errors:
+            raise IOError("Failed to list destination paths: {0}".format("\n".join(errors)))
+    return existing
+
+class DistcpJob:
+    def __init__(self, item, command, completions):
+        self.item = item
+        self.start_time = time.time()
+        self.output = collections.deque(maxlen=FAILED_OUTPUT_LINES)
+        self.completions = completions
+        log.debug(" ".join(arg if not arg.startswith("fs.azure.account.key.") else arg.partition("=")[0] + "=..." for arg in command))
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        self.reader = threading.Thread(target=self._wait)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _wait(self):
+        for line in self.process.stdout:
+            self.output.append(line.rstrip("\r\n"))
+            log.debug("[%s] %s", self.item["path"], self.output[-1])
+        self.retcode = self.process.wait()
+        self.completions.put(self)
+
+class DistcpScheduler:
+    # Keeps up to max_jobs distcp jobs running, largest paths first. Paths with a known size are only started if they
+    # fit within the size still available under max_inflight_size, although a path is always started when nothing
+    # else is running so that paths larger than the limit still get copied.
+    def __init__(self, items, buildCommand, max_jobs, max_inflight_size):
+        # Stable sort, so paths without sizes keep their file list order
+        self.pending = sorted(items, key=lambda item: item["size"] or 0, reverse=True)
+        self.buildCommand = buildCommand
+        self.max_jobs = max_jobs
+        self.max_inflight_size = max_inflight_size
+        self.running = []
+        self.inflight_size = 0
+        self.completions = queue.Queue()
+        self.total_size = sum(item["size"] or 0 for item in items)
+        self.completed_size = 0
+        self.completed = 0
+        self.failed = []
+
+    def _nextItem(self):
+        for idx, item in enumerate(self.pending):
+            if not self.running or not self.max_inflight_size or self.inflight_size + (item["size"] or 0) <= self.max_inflight_size:
+                return self.pending.pop(idx)
+        return None
+
+    def _start(self, item):
+        log.info("Starting copy of '%s' (%s bytes). %d jobs running", item["path"], item["size"] if item["size"] is not None else "unknown", len(self.running) + 1)
+        self.running.append(DistcpJob(item, self.buildCommand(item), self.completions))
+        self.inflight_size += item["size"] or 0
+
+    def _complete(self, job):
+        self.running.remove(job)
+        self.inflight_size -= job.item["size"] or 0
+        self.completed += 1
+        self.completed_size += job.item["size"] or 0
+        elapsed = time.time() - job.start_time
+        if job.retcode != 0:
+            self.failed.append(job.item)
+            log.error("Copy of '%s' failed after %.0fs. Exit code: %d. Last output:\n%s", job.item["path"], elapsed, job.retcode, "\n".join(job.output))
+        else:
+            log.info("Copied '%s' in %.0fs", job.item["path"], elapsed)
+        log.info("Completed %d of %d paths (%d of %d bytes). %d failed", self.completed, self.completed + len(self.running) + len(self.pending),
+            self.completed_size, self.total_size, len(self.failed))
+
+    def run(self):
+        while self.pending or self.running:
+            while len(self.running) < self.max_jobs:
+                item = self._nextItem()
+                if item is None:
+                    break
+                self._start(item)
+            self._complete(self.completions.get())
+        return self.failed
+
+    def terminate(self):
+        for job in self.running:
+            job.process.terminate()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Copy the paths in a file list to a Data Box using a bounded number of concurrent distcp jobs")
+    parser.add_argument('filelist', help="The name of a file list generated by generate-file-list.py (or any file containing 1 HDFS path per line)")
+    parser.add_argument('-d', '--dest-dns-name', required=True, help="The DNS name of the Data Box blob service endpoint, eg. mystorageaccount.blob.mydataboxno.microsoftdatabox.com")
+    parser.add_argument('-k', '--dest-account-key', help="The account key for the Data Box storage account")
+    parser.add_argument('-c', '--container', required=True, help="The Data Box container to copy to")
+    parser.add_argument('-q', '--queue', default="default", help="The YARN queue the distcp jobs are submitted to. Default is 'default'.")
+    parser.add_argument('-m', '--mappers', type=int, default=4, help="The maximum number of mappers used by each distcp job. Default is 4.")
+    parser.add_argument('--mapper-size', type=int, help="When the size of a path is known, use 1 mapper for every this many bytes (up to --mappers), so that small paths don't take a full set of containers")
+    parser.add_argument('-j', '--max-jobs', type=int, default=4, help="The maximum number of distcp jobs running at once. Default is 4.")
+    parser.add_argument('-M', '--max-inflight-size', type=int, help="The maximum total size (in bytes) of the paths being copied at once. Requires the sizes of the paths.")
+    parser.add_argument('-z', '--sizes', help="The name of the sizes file written by generate-file-list.py --write-sizes. Defaults to {filelist}.sizes, if it exists.")
+    parser.add_argument('-o', '--hadoop-opts', default="", help="Additional options passed to every hadoop command, eg. \"-libjars $azjars -D fs.AbstractFileSystem.wasb.impl=org.apache.hadoop.fs.azure.Wasb\"")
+    parser.add_argument('-x', '--distcp-opts', default="", help="Additional options passed to distcp, eg. \"-filters ./exclusions.lst\"")
+    parser.add_argument('-F', '--failed-list', help="The name of a file to write the paths that failed to copy to. It can be passed back to this script to retry them.")
+    parser.add_argument('-l', '--log-file', help="Name of file to have log output written to (default is stdout/stderr)")
+    parser.add_argument('-v', '--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="Level of log information to output. Default is 'INFO'.")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=getattr(logging, args.log_level.upper()), filename=args.log_file)
+
+    if args.max_jobs < 1 or args.mappers < 1:
+        parser.error("--max-jobs & --mappers must be at least 1")
+    sizesFile = args.sizes
+    if not sizesFile and os.path.exists(args.filelist + ".sizes"):
+        sizesFile = args.filelist + ".sizes"
+    items = readFileList(args.filelist, sizesFile)
+    unsized = sum(1 for item in items if item["size"] is None)
+    if unsized and (args.max_inflight_size or args.mapper_size):
+        log.warning("The sizes of %d of %d paths aren't known. Those paths don't count towards --max-inflight-size & use %d mappers", unsized, len(items), args.mappers)
+
+    hadoopOpts = shlex.split(args.hadoop_opts)
+    fsCommand = hadoopFsCommand(hadoopOpts, args.dest_dns_name, args.dest_account_key)
+    destRoot = "wasb://{0}@{1}".format(args.container, args.dest_dns_name)
+    log.info("Checking which of the %d paths already exist on the Data Box", len(items))
+    existing = findExistingPaths(destRoot, [item["path"] for item in items], fsCommand)
+    log.info("%d paths already exist & will be updated", len(existing))
+
+    def buildDistcpCommand(item):
+        # distcp copies the source as the target if the target doesn't exist, or into it if it does. Existing paths
+        # are therefore copied into their parent.
+        destPath = destRoot + item["path"]
+        if item["path"] in existing:
+            destPath = destPath.rpartition("/")[0]
+        mappers = args.mappers
+        if args.mapper_size and item["size"] is not None:
+            mappers = max(1, min(args.mappers, -(-item["size"] // args.mapper_size)))
+        return (["hadoop", "distcp"] + fsCommand[2:] + ["-Dmapred.job.queue.name=" + args.queue, "-m", str(mappers)] +
+            shlex.split(args.distcp_opts) + [item["path"], destPath + "/"])
+
+    scheduler = DistcpScheduler(items, buildDistcpCommand, args.max_jobs, args.max_inflight_size)
+    try:
+        failed = scheduler.run()
+    except KeyboardInterrupt:
+        log.warning("Interrupted. Stopping all running distcp jobs")
+        scheduler.terminate()
+        raise
+    if args.failed_list:
+        with open(args.failed_list, "w") as fp:
+            fp.writelines([item["path"] + "\n" for item in failed])
+        if sizesFile:
+            with open(args.failed_list + ".sizes", "w") as fp:
+                fp.writelines(["{0}\t{1}\n".format(item["size"], item["path"]) for item in failed if item["size"] is not None])
+    if failed:
+        log.error("%d of %d paths failed to copy", len(failed), len(items))
+        sys.exit(1)
+    log.info("Completed processing successfully")
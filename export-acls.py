@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Exports the owner, group & ACL of every path beneath an HDFS directory as newline delimited JSON, suitable for
+# copy-acls.py. The output of 'hadoop fs -getfacl -R' is parsed as it is streamed, and the tree may be split into
+# subtrees that are exported by several 'getfacl' processes in parallel.
+
+import sys, subprocess, json, threading, argparse, logging, tempfile, shutil, os
+from adls_copy_utils import AdlsCopyUtils
+
+log = logging.getLogger(__name__)
+
+HADOOP_FS = ["hadoop", "fs", "-Dfs.azure.localuserasfileowner.replace.principals="]
+# The number of top-level files passed to each non-recursive 'getfacl' call, keeping the command line well within ARG_MAX
+GETFACL_BATCH_SIZE = 200
+
+def relative_name(path):
+    # Paths are written relative to the root of the filesystem. Fully qualified paths (eg. hdfs://namenode:8020/dir)
+    # also have their scheme & authority removed.
+    if "://" in path:
+        parts = path.split("/", 3)
+        return parts[3] if len(parts) > 3 else ""
+    return path[1:] if path.startswith("/") else path
+
+def parse_getfacl(lines):
+    # Each path is reported as a block of '# key: value' headers, followed by the ACL entries & a blank line:
+    #   # file: /data/dir
+    #   # owner: hdfs
+    #   # group: supergroup
+    #   user::rwx
+    #   user:bob:rwx    #effective:r-x
+    #   ...
+    entry = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.startswith("# "):
+            key, _, value = line[2:].partition(":")
+            value = value.strip()
+            if key == "file":
+                if entry:
+                    yield entry
+                entry = {"file": relative_name(value), "owner": "", "group": "", "acl": []}
+            elif entry and key in ("owner", "group"):
+                entry[key] = value
+        elif line.strip() and entry:
+            # Discard the effective permissions
+            entry["acl"].append(line.split("#", 1)[0].strip())
+    if entry:
+        yield entry
+
+def list_subtrees(source_path):
+    # Returns the immediate children of the source path, split into (directories, files)
+    process = subprocess.Popen(HADOOP_FS + ["-ls", source_path], stdout=subprocess.PIPE, universal_newlines=True)
+    directories = []
+    files = []
+    for line in process.stdout:
+        fields = line.rstrip("\r\n").split(None, 7)
+        if len(fields) < 8:
+            # 'Found n items'
+            continue
+        if fields[0].startswith("d"):
+            directories.append(fields[7])
+        else:
+            files.append(fields[7])
+    retcode = process.wait()
+    if retcode != 0:
+        raise IOError("Error listing {0}. Hadoop returned: {1}".format(source_path, retcode))
+    return directories, files
+
+def export_acls(paths, recursive, output):
+    args = HADOOP_FS + ["-getfacl"] + (["-R"] if recursive else []) + paths
+    log.debug(" ".join(args))
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True)
+    count = 0
+    for entry in parse_getfacl(process.stdout):
+        output.write(json.dumps(entry) + "\n")
+        count += 1
+    retcode = process.wait()
+    if retcode != 0:
+        raise IOError("Error exporting ACLs for {0}. Hadoop returned: {1}".format(" ".join(paths), retcode))
+    return count
+
+class ShardedExport:
+    # Exports each subtree to its own temporary file, using a fixed number of concurrent getfacl processes. The files
+    # are appended to the output in their original order, so that parents still precede their children.
+    def __init__(self, shards, parallelism, temp_dir=None):
+        self.shards = shards
+        self.parallelism = parallelism
+        self.temp_dir = temp_dir
+        self.next_shard = 0
+        self.mutex = threading.Lock()
+        self.results = [None] * len(shards)
+        self.completed = [threading.Event() for shard in shards]
+
+    def _worker(self):
+        while True:
+            with self.mutex:
+                shard_idx = self.next_shard
+                self.next_shard += 1
+            if shard_idx >= len(self.shards):
+                return
+            paths, recursive = self.shards[shard_idx]
+            shard_file = tempfile.TemporaryFile(mode="w+", dir=self.temp_dir)
+            try:
+                count = export_acls(paths, recursive, shard_file)
+                shard_file.seek(0)
+                self.results[shard_idx] = (shard_file, count)
+            except Exception as e:
+                log.error("Failed to export ACLs for: %s. Details: %s", " ".join(paths), e)
+                shard_file.close()
+                self.results[shard_idx] = (None, 0)
+            self.completed[shard_idx].set()
+
+    def run(self, output):
+        workers = [threading.Thread(target=self._worker) for _ in range(min(self.parallelism, len(self.shards)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        total = 0
+        failures = 0
+        for shard_idx in range(len(self.shards)):
+            self.completed[shard_idx].wait()
+            shard_file, count = self.results[shard_idx]
+            self.results[shard_idx] = None
+            if shard_file:
+                shutil.copyfileobj(shard_file, output)
+                shard_file.close()
+                total += count
+            else:
+                failures += 1
+        return total, failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the ACLs of HDFS files & directories as newline delimited JSON")
+    parser.add_argument('-s', '--source-path', required=True, help="The HDFS path to export ACLs for. All files & directories beneath this path are exported.")
+    parser.add_argument('-o', '--output', help="The name of the file to write the ACLs to. If omitted, output is written to stdout")
+    parser.add_argument('-p', '--parallelism', type=int, default=1, help="The number of 'getfacl' processes to run concurrently. Values greater than 1 export each top-level subtree separately.")
+    parser.add_argument('-T', '--temp-dir', help="The directory used to hold the output of each subtree until it can be written in order. Defaults to the system temp directory.")
+    parser.add_argument('-f', '--log-config', help="The name of a configuration file for logging.")
+    parser.add_argument('-l', '--log-file', help="Name of file to have log output written to (default is stdout/stderr)")
+    parser.add_argument('-v', '--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="Level of log information to output. Default is 'INFO'.")
+    args = parser.parse_known_args()[0]
+
+    AdlsCopyUtils.configureLogging(args.log_config, args.log_level, args.log_file)
+    log.info("Exporting ACLs from %s", args.source_path)
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        if args.parallelism > 1:
+            directories, files = list_subtrees(args.source_path)
+            # The source path & the files directly beneath it are exported by batches of non-recursive calls, followed
+            # by a recursive call for each directory
+            top_level = [args.source_path] + files
+            shards = ([(top_level[idx:idx + GETFACL_BATCH_SIZE], False) for idx in range(0, len(top_level), GETFACL_BATCH_SIZE)] +
+                [([directory], True) for directory in directories])
+            log.info("Exporting %d subtrees using %d concurrent processes", len(directories), args.parallelism)
+            total, failures = ShardedExport(shards, args.parallelism, args.temp_dir).run(output)
+        else:
+            total = export_acls([args.source_path], True, output)
+            failures = 0
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    log.info("Exported ACLs for %d paths", total)
+    if failures:
+        log.error("Failed to export %d subtrees", failures)
+        sys.exit(1)
@@ -1,59 +1,321 @@
 #!/usr/bin/env python
 
-import sys, subprocess, logging, itertools, argparse
+import sys, subprocess, logging, itertools, argparse, tempfile, shutil, json, heapq, bisect
 
 log = logging.getLogger(__name__)
 
-def parseUsageLine(line, sourceDir):
-    # Various distros/configurations of Hadoop can have either 2 or 3 columns as the response for the du command.
-    # All of these variants place the pathname as the last value. We have to search for the prefix & do manipulation
-    # from there
-    nameIdx = line.find(sourceDir)
-    parsedLine = line[0:nameIdx].split()
+PACKING_FIRST_FIT = "first-fit"
+PACKING_FFD = "first-fit-decreasing"
+PACKING_BFD = "best-fit-decreasing"
+
+# Number of listing entries sorted in memory at a time, when a listing has to be sorted into depth-first order
+SORT_CHUNK_SIZE = 1000000
+
+def parseListingLine(line):
+    # Each line of 'hadoop fs -ls -R' has the form:
+    #   drwxr-xr-x   - hdfs supergroup          0 2019-01-01 10:00 /data/dir
+    #   -rw-r--r--   3 hdfs supergroup    1048576 2019-01-01 10:00 /data/dir/file
+    # The path is the last value & may contain spaces. Returns None for lines that aren't entries.
+    fields = line.rstrip("\r\n").split(None, 7)
+    if len(fields) < 8:
+        return None
+    return {
+        'path': fields[7],
+        'size': int(fields[4]),
+        'is_dir': fields[0].startswith("d")
+    }
+
+def parseFsImageLine(line, delimiter):
+    # Each line of 'hdfs oiv -p Delimited' has the columns:
+    #   Path, Replication, ModificationTime, AccessTime, PreferredBlockSize, BlocksCount, FileSize, NSQUOTA, DSQUOTA,
+    #   Permission, UserName, GroupName
+    # Returns None for the header line.
+    fields = line.rstrip("\r\n").split(delimiter)
+    if len(fields) < 12 or fields[0] == "Path":
+        return None
     return {
-        'path': line[nameIdx:].rstrip(),
-        'size': int(parsedLine[0]),
-        'unit': 0
+        'path': fields[0],
+        'size': int(fields[6]),
+        'is_dir': fields[9].startswith("d"),
+        'permission': fields[9],
+        'owner': fields[10],
+        'group': fields[11]
     }
 
-def processDirectoryIntoUnits(sourceDir, unitSize, dirAllocations, unitsSpaceAvailable):
-    log.info("Calculating directory sizes for '%s'", sourceDir)
-    startIdx = len(dirAllocations)
-    process = subprocess.Popen("hadoop fs -du -x '{0}'".format(sourceDir), stdout=subprocess.PIPE, shell=True)
+def baseAcl(permission):
+    # The ACL entries equivalent to the permission bits, eg. drwxr-xr-t => user::rwx, group::r-x, other::r-x
+    bits = permission[1:10].replace("t", "x").replace("T", "-")
+    return ["user::" + bits[0:3], "group::" + bits[3:6], "other::" + bits[6:9]]
+
+def exportAcls(entries, aclFp):
+    # Writes the owner, group & permissions of each entry in the format produced by export-acls.py (in fsimage order,
+    # rather than depth-first), passing the entries through
+    extendedAcls = 0
+    for entry in entries:
+        if entry["permission"].endswith("+"):
+            extendedAcls += 1
+        aclFp.write(json.dumps({
+            "file": entry["path"].lstrip("/"),
+            "owner": entry["owner"],
+            "group": entry["group"],
+            "acl": baseAcl(entry["permission"])
+        }) + "\n")
+        yield entry
+    if extendedAcls:
+        log.warning("%d paths have extended ACLs, which aren't included in the fsimage dump. Only their permission bits have been exported - use export-acls.py to export their full ACLs.", extendedAcls)
+
+def parentPath(path):
+    parent = path.rpartition("/")[0]
+    return parent if parent or not path.startswith("/") else "/"
+
+def readListing(listingFile, sourceDir, parseLine=parseListingLine):
+    # Only the entries beneath the source path are returned - an fsimage dump contains the whole namespace
+    prefix = sourceDir.rstrip("/") + "/"
+    with open(listingFile) as fp:
+        for line in fp:
+            entry = parseLine(line)
+            if entry and (entry["path"] == sourceDir or entry["path"].startswith(prefix)):
+                yield entry
+
+def saveListing(sourceDir, listingFile):
+    # Stream a single recursive listing of the tree to a file. The output is read as it is produced, rather than
+    # waiting for the process to exit, so large listings can't fill the pipe & deadlock.
+    log.info("Listing contents of '%s' to: %s", sourceDir, listingFile.name)
+    process = subprocess.Popen(["hadoop", "fs", "-ls", "-R", sourceDir], stdout=subprocess.PIPE, universal_newlines=True)
+    shutil.copyfileobj(process.stdout, listingFile)
     retcode = process.wait()
-    if retcode == 0:
-        dirAllocations += [parseUsageLine(line, sourceDir) for line in process.stdout]
-        recurseDirs = []
-        for dirIdx in range(startIdx, len(dirAllocations)):
-            if dirAllocations[dirIdx]["size"] > unitSize:
-                # We will recurse down the path after we've processed all other items
-                # This item will remain in the array, but unassigned with unit == 0. This will be filtered when we project the filelists
-                recurseDirs.append(dirAllocations[dirIdx]["path"])
-            else:
-                for unitIdx in range(0, len(unitsSpaceAvailable)):
-                    if (unitsSpaceAvailable[unitIdx] >= dirAllocations[dirIdx]["size"]):
-                        dirAllocations[dirIdx]["unit"] = unitIdx + 1
-                        unitsSpaceAvailable[unitIdx] -= dirAllocations[dirIdx]["size"]
-                        break
-                else:
-                    # Allocate new unit
-                    unitsSpaceAvailable += [unitSize]
-                    unitIdx = len(unitsSpaceAvailable) - 1
-                    dirAllocations[dirIdx]["unit"] = unitIdx + 1
-                    unitsSpaceAvailable[unitIdx] -= dirAllocations[dirIdx]["size"]
-        for recurseDir in recurseDirs:
-            if not processDirectoryIntoUnits(recurseDir, unitSize, dirAllocations, unitsSpaceAvailable):
-                return False
-        return True
-    else:
+    listingFile.flush()
+    if retcode != 0:
         log.warning("Error calling Hadoop: %d", retcode)
         return False
+    return True
+
+def pathKey(path):
+    # Sorts a directory's contents straight after it & before its next sibling, which a plain sort of the paths
+    # doesn't - eg. '/a/b c' sorts between '/a/b' & '/a/b/f'
+    return path.split("/")
+
+def sortListing(entries, chunkSize=SORT_CHUNK_SIZE):
+    # External merge sort of the listing into depth-first order. Sorted runs of chunkSize entries are written to
+    # temporary files & then merged, so only a single run is ever held in memory.
+    entries = iter(entries)
+    runs = []
+    try:
+        while True:
+            run = sorted(itertools.islice(entries, chunkSize), key=lambda entry: pathKey(entry["path"]))
+            if not run:
+                break
+            runFp = tempfile.TemporaryFile(mode="w+")
+            runFp.writelines([json.dumps(entry) + "\n" for entry in run])
+            runFp.seek(0)
+            runs.append(runFp)
+        def readRun(runIdx, runFp):
+            for lineIdx, line in enumerate(runFp):
+                entry = json.loads(line)
+                yield pathKey(entry["path"]), runIdx, lineIdx, entry
+        for _, _, _, entry in heapq.merge(*[readRun(runIdx, runFp) for runIdx, runFp in enumerate(runs)]):
+            yield entry
+    finally:
+        for runFp in runs:
+            runFp.close()
+
+def directoryTotals(sourceDir, entries):
+    # Rolls the sizes up the tree while streaming a depth-first listing (as produced by 'hadoop fs -ls -R' or 
+    # sortListing), holding only the chain of directories above the current entry. Yields (entry, size) for each
+    # entry - a directory is yielded once all of its contents have been seen, with the source directory last.
+    stack = [[{'path': sourceDir, 'size': 0, 'is_dir': True}, 0]]
+    for entry in entries:
+        if entry["path"] == sourceDir:
+            continue
+        # Close the directories that this entry isn't beneath
+        while len(stack) > 1 and not entry["path"].startswith(stack[-1][0]["path"].rstrip("/") + "/"):
+            directory, size = stack.pop()
+            stack[-1][1] += size
+            yield directory, size
+        if entry["is_dir"]:
+            stack.append([entry, 0])
+        else:
+            stack[-1][1] += entry["size"]
+            yield entry, entry["size"]
+    while stack:
+        directory, size = stack.pop()
+        if stack:
+            stack[-1][1] += size
+        yield directory, size
+
+def calculateDirectorySizes(sourceDir, entries, minSize=None):
+    # First pass over the listing. Returns the total size of the source directory & of every directory larger than
+    # minSize (all of them by default). Only those directories may be split, so no other state is proportional to
+    # the size of the tree.
+    return dict((entry["path"], size) for entry, size in directoryTotals(sourceDir, entries) 
+        if entry["is_dir"] and (minSize is None or size > minSize or entry["path"] == sourceDir))
+
+def collectAllocations(sourceDir, splitSize, entries, dirSizes):
+    # Second pass over the listing. Directories larger than the split size (the directories in dirSizes) may be 
+    # split - their immediate children are then allocated individually (or split further). Returns the children of
+    # each such directory, in listing order.
+    children = {sourceDir: []}
+    for path, size in dirSizes.items():
+        if size > splitSize:
+            children[path] = []
+    for entry, size in directoryTotals(sourceDir, entries):
+        siblings = children.get(parentPath(entry["path"])) if entry["path"] != sourceDir else None
+        if siblings is not None:
+            siblings.append({
+                'path': entry["path"],
+                'size': size,
+                'unit': 0
+            })
+    return children
+
+def processDirectoryIntoUnits(sourceDir, unitSize, children, dirAllocations, unitsSpaceAvailable):
+    # Allocate each child that fits into the first unit with space, then recurse down the larger directories
+    recurseDirs = []
+    for allocation in children[sourceDir]:
+        dirAllocations.append(allocation)
+        if allocation["path"] in children and allocation["size"] > unitSize:
+            # This item will remain in the array, but unassigned with unit == 0. This will be filtered when we project the filelists
+            recurseDirs.append(allocation["path"])
+            continue
+        if allocation["size"] > unitSize:
+            log.warning("File '%s' is larger than a single unit", allocation["path"])
+        for unitIdx in range(0, len(unitsSpaceAvailable)):
+            if (unitsSpaceAvailable[unitIdx] >= allocation["size"]):
+                break
+        else:
+            # Allocate new unit
+            unitsSpaceAvailable += [unitSize]
+            unitIdx = len(unitsSpaceAvailable) - 1
+        allocation["unit"] = unitIdx + 1
+        unitsSpaceAvailable[unitIdx] -= allocation["size"]
+    for recurseDir in recurseDirs:
+        processDirectoryIntoUnits(recurseDir, unitSize, children, dirAllocations, unitsSpaceAvailable)
+
+class FirstFitUnits:
+    # Free space of each unit, held in a max segment tree so that the first unit with enough space is found in 
+    # O(log units)
+    def __init__(self, unitSize):
+        self.unitSize = unitSize
+        self.count = 0
+        self.capacity = 1
+        self.tree = [0] * 2
+
+    def find(self, size):
+        # Returns the index of the first unit with at least 'size' free, or -1
+        if self.count == 0 or self.tree[1] < size:
+            return -1
+        node = 1
+        while node < self.capacity:
+            node = node * 2 if self.tree[node * 2] >= size else node * 2 + 1
+        return node - self.capacity
+
+    def add(self):
+        if self.count == self.capacity:
+            # Double the number of leaves, moving the existing leaves into the new bottom level
+            leaves = self.tree[self.capacity:]
+            self.capacity *= 2
+            self.tree = [0] * (2 * self.capacity)
+            self.tree[self.capacity:self.capacity + len(leaves)] = leaves
+            for node in range(self.capacity - 1, 0, -1):
+                self.tree[node] = max(self.tree[node * 2], self.tree[node * 2 + 1])
+        self.count += 1
+        self.update(self.count - 1, self.unitSize)
+        return self.count - 1
+
+    def allocate(self, unitIdx, size):
+        self.update(unitIdx, self.tree[self.capacity + unitIdx] - size)
+
+    def update(self, unitIdx, free):
+        node = self.capacity + unitIdx
+        self.tree[node] = free
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[node * 2], self.tree[node * 2 + 1])
+            node //= 2
+
+class BestFitUnits:
+    # Free space of each unit, held as a sorted list of (free, unit) so that the unit with the least space that is 
+    # still enough is found by bisection
+    def __init__(self, unitSize):
+        self.unitSize = unitSize
+        self.count = 0
+        self.free = []
+        self.unitFree = []
+
+    def find(self, size):
+        idx = bisect.bisect_left(self.free, (size, -1))
+        return self.free[idx][1] if idx < len(self.free) else -1
+
+    def add(self):
+        self.count += 1
+        self.unitFree.append(self.unitSize)
+        bisect.insort(self.free, (self.unitSize, self.count - 1))
+        return self.count - 1
+
+    def allocate(self, unitIdx, size):
+        free = self.unitFree[unitIdx]
+        del self.free[bisect.bisect_left(self.free, (free, unitIdx))]
+        self.unitFree[unitIdx] = free - size
+        bisect.insort(self.free, (free - size, unitIdx))
+
+def packUnits(sourceDir, unitSize, children, dirSizes, packing):
+    # Allocates the largest items first. Directories larger than a unit are always split into their children. Other
+    # directories that have been listed are only split when they don't fit into any of the open units & we already 
+    # have as many units as the total size requires - splitting into more file list entries to avoid an extra unit.
+    units = FirstFitUnits(unitSize) if packing == PACKING_FFD else BestFitUnits(unitSize)
+    minimumUnits = (dirSizes[sourceDir] + unitSize - 1) // unitSize
+    allocations = []
+    pending = []
+    sequence = itertools.count()
+    def push(directory):
+        for allocation in children[directory]:
+            heapq.heappush(pending, (-allocation["size"], next(sequence), allocation))
+    push(sourceDir)
+    while pending:
+        _, _, allocation = heapq.heappop(pending)
+        splittable = allocation["path"] in children
+        if splittable and allocation["size"] > unitSize:
+            push(allocation["path"])
+            continue
+        unitIdx = units.find(allocation["size"])
+        if unitIdx < 0:
+            if splittable and units.count >= minimumUnits:
+                push(allocation["path"])
+                continue
+            if allocation["size"] > unitSize:
+                log.warning("File '%s' is larger than a single unit", allocation["path"])
+            unitIdx = units.add()
+        units.allocate(unitIdx, allocation["size"])
+        allocation["unit"] = unitIdx + 1
+        allocations.append(allocation)
+    return allocations
+
+def logUnitSummary(allocations, unitSize):
+    keyfunc = lambda x: x["unit"]
+    totalUsed = 0
+    units = 0
+    for unit, unitAllocations in itertools.groupby(sorted(allocations, key=keyfunc), keyfunc):
+        unitAllocations = list(unitAllocations)
+        used = sum(allocation["size"] for allocation in unitAllocations)
+        log.info("Unit %d: %d paths, %d bytes, %.1f%% full", unit, len(unitAllocations), used, 100.0 * used / unitSize)
+        totalUsed += used
+        units += 1
+    if units:
+        log.info("Total: %d units, %d bytes, %.1f%% average fill", units, totalUsed, 100.0 * totalUsed / (units * unitSize))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Calculate filelist of HDFS contents into Databox sized blocks")
     parser.add_argument('path', help="The base HDFS path to process.")
     parser.add_argument('-s', '--databox-size', default=109951162777600, type=int, help="The size of each Databox in Bytes.")
     parser.add_argument('-b', '--filelist-basename', default="filelist", help="The base name for the output filelists. Lists will be named basename1, basename2, ... .")
+    parser.add_argument('-i', '--listing', help="The name of a file containing the output of 'hadoop fs -ls -R' for the path, saved by a previous run. The path is not listed again, so planning can be re-run offline.")
+    parser.add_argument('-o', '--save-listing', help="The name of a file to save the recursive listing to, so that it can be re-used via --listing")
+    parser.add_argument('-m', '--fsimage', help="The name of a file containing the output of 'hdfs oiv -p Delimited' for a copy of the NameNode fsimage. Planning is then performed entirely off-cluster.")
+    parser.add_argument('-d', '--fsimage-delimiter', default="\t", help="The delimiter used in the fsimage dump. Default is tab.")
+    parser.add_argument('-a', '--export-acls', help="When planning from an fsimage dump, also write the owner, group & permissions of each path to this file, in the format read by copy-acls.py")
+    parser.add_argument('-p', '--packing', default=PACKING_BFD, choices=[PACKING_FIRST_FIT, PACKING_FFD, PACKING_BFD], help="The algorithm used to pack directories & files into units. 'first-fit' allocates in listing order (the original behavior). Default is '{0}'.".format(PACKING_BFD))
+    parser.add_argument('-z', '--write-sizes', action='store_true', help="Also write the size (in bytes) of each path in the file lists to basename1.sizes, basename2.sizes, ... . These are used by distcp-to-databox.py to balance the copy jobs.")
+    parser.add_argument('-S', '--split-size', type=int, help="Directories larger than this size (in bytes) may be split into their files & subdirectories to avoid needing an extra unit. Default is 1%% of the Databox size. Not used by 'first-fit' packing.")
     parser.add_argument('-f', '--log-config', help="The name of a configuration file for logging.")
     parser.add_argument('-l', '--log-file', help="Name of file to have log output written to (default is stdout/stderr)")
     parser.add_argument('-v', '--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="Level of log information to output. Default is 'INFO'.")
@@ -61,17 +323,63 @@ if __name__ == '__main__':
     logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=getattr(logging, args.log_level.upper()), filename=args.log_file)
     log.info("Starting processing of HDFS contents into chunked file lists")
 
+    sourceDir = args.path.rstrip("/") or "/"
+    listingFile = args.listing
+    parseLine = parseListingLine
+    if args.fsimage:
+        listingFile = args.fsimage
+        parseLine = lambda line: parseFsImageLine(line, args.fsimage_delimiter)
+    elif not listingFile:
+        listingFp = open(args.save_listing, "w+") if args.save_listing else tempfile.NamedTemporaryFile(mode="w+", suffix=".listing")
+        if not saveListing(sourceDir, listingFp):
+            log.error("Filelist sizing failed")
+            sys.exit(1)
+        listingFile = listingFp.name
+
+    if args.packing == PACKING_FIRST_FIT:
+        splitSize = args.databox_size
+    else:
+        splitSize = args.split_size if args.split_size is not None else args.databox_size // 100
+    if args.fsimage:
+        # The fsimage dump isn't in depth-first order, so it is sorted once & both passes read the sorted copy
+        log.info("Sorting the fsimage dump")
+        entries = readListing(listingFile, sourceDir, parseLine)
+        aclFp = None
+        if args.export_acls:
+            log.info("Exporting ownership & permissions to: %s", args.export_acls)
+            aclFp = open(args.export_acls, "w")
+            entries = exportAcls(entries, aclFp)
+        sortedFp = tempfile.TemporaryFile(mode="w+")
+        sortedFp.writelines(json.dumps(entry) + "\n" for entry in sortListing(entries))
+        if aclFp:
+            aclFp.close()
+        def readEntries():
+            sortedFp.seek(0)
+            return (json.loads(line) for line in sortedFp)
+    else:
+        readEntries = lambda: readListing(listingFile, sourceDir, parseLine)
+
     log.info("Calculating space requirements for HDFS directories")
-    dirAllocations = []
-    unitsSpaceAvailable = []
-    if processDirectoryIntoUnits(args.path, args.databox_size, dirAllocations, unitsSpaceAvailable):
-        log.info("Writing file lists with basename: %s", args.filelist_basename)
-        keyfunc = lambda x: x["unit"]
-        for unit, dirs in itertools.groupby(sorted([dir for dir in dirAllocations if dir["unit"] != 0], key=keyfunc), keyfunc):
-            with open("{0}{1}".format(args.filelist_basename, unit), "w+") as fp:
-                fp.writelines([dir["path"] + '\n' for dir in dirs])
-
-        log.info("Completed processing successfully")
+    dirSizes = calculateDirectorySizes(sourceDir, readEntries(), splitSize)
+    children = collectAllocations(sourceDir, splitSize, readEntries(), dirSizes)
+    log.info("Packing units using %s", args.packing)
+    if args.packing == PACKING_FIRST_FIT:
+        dirAllocations = []
+        unitsSpaceAvailable = []
+        processDirectoryIntoUnits(sourceDir, args.databox_size, children, dirAllocations, unitsSpaceAvailable)
     else:
-        log.error("Filelist sizing failed")
-    
\ No newline at end of file
+        dirAllocations = packUnits(sourceDir, args.databox_size, children, dirSizes, args.packing)
+    logUnitSummary([dir for dir in dirAllocations if dir["unit"] != 0], args.databox_size)
+
+    log.info("Writing file lists with basename: %s", args.filelist_basename)
+    keyfunc = lambda x: x["unit"]
+    for unit, dirs in itertools.groupby(sorted([dir for dir in dirAllocations if dir["unit"] != 0], key=keyfunc), keyfunc):
+        dirs = list(dirs)
+        with open("{0}{1}".format(args.filelist_basename, unit), "w+") as fp:
+            fp.writelines([dir["path"] + '\n' for dir in dirs])
+        if args.write_sizes:
+            # The size comes first, as the path may contain tabs
+            with open("{0}{1}.sizes".format(args.filelist_basename, unit), "w+") as fp:
+                fp.writelines(["{0}\t{1}\n".format(dir["size"], dir["path"]) for dir in dirs])
+
+    log.info("Completed processing successfully")
@@ -2,56 +2,79 @@
 
 import requests
 import sys, subprocess, datetime, json, itertools, os.path, threading, argparse, logging
-from adls_copy_utils import AdlsCopyUtils
+from adls_copy_utils import AdlsCopyUtils, PermissionsMapper
 
 log = logging.getLogger(__name__)
 
-def update_files_owners(account, container, sas_token, work_queue):
+def update_files_owners(account, container, sas_token, permissions_mapper, work_queue):
     log = logging.getLogger(threading.currentThread().name)
     log.debug("Thread starting: %d", threading.currentThread().ident)
     while not work_queue.isDone():
         file = work_queue.nextItem()
         if file:
-            file["permissions"]["owner"] = AdlsCopyUtils.lookupIdentity(AdlsCopyUtils.IDENTITY_USER, file["permissions"]["owner"], identity_map)
-            file["permissions"]["group"] = AdlsCopyUtils.lookupIdentity(AdlsCopyUtils.IDENTITY_GROUP, file["permissions"]["group"], identity_map)
-            # Merge the updated information into the other metadata properties, so that we can update in 1 call
-            file["metadata"][AdlsCopyUtils.METDATA_PERMISSIONS] = json.dumps(file["permissions"])
-            if file["is_folder"]:
-                file["metadata"][AdlsCopyUtils.METADATA_ISFOLDER] = "true"
-            url = "http://{0}.blob.core.windows.net/{1}/{2}?comp=metadata&{3}".format(account, container, file["name"], sas_token)
-            log.debug(url)
-            # No portable way to combine 2 dicts
-            metadata_headers = {
-                "x-ms-version": "2018-03-28",
-                "x-ms-date": datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
-            }
-            metadata_headers.update({"x-ms-meta-" + name: value for (name, value) in file["metadata"].items()})
-            with requests.put(url, headers=metadata_headers) as response:
-                if not response:
-                    log.warning("Failed to set metadata on file: %s. Error: %s", url, response.text)
-                else:
+            try:
+                # The item is left untouched, so that it can be retried (or dead-lettered) as it was originally listed.
+                # Items whose permissions don't change have already been skipped, unless their lookup failed then.
+                permissions = permissions_mapper.mapPermissions(file["permissions"])
+                if permissions is None:
                     work_queue.itemDone()
-                    log.debug("Updated ownership for %s", file["name"])
+                    continue
+                # Merge the updated information into the other metadata properties, so that we can update in 1 call
+                metadata = dict(file["metadata"])
+                metadata[AdlsCopyUtils.METDATA_PERMISSIONS] = permissions
+                if file["is_folder"]:
+                    metadata[AdlsCopyUtils.METADATA_ISFOLDER] = "true"
+                url = "{0}/{1}/{2}?comp=metadata&{3}".format(AdlsCopyUtils.blobEndpoint(account, "http"), container, file["name"], sas_token)
+                log.debug(url)
+                # No portable way to combine 2 dicts
+                metadata_headers = {
+                    "x-ms-version": "2018-03-28",
+                    "x-ms-date": datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
+                }
+                metadata_headers.update({"x-ms-meta-" + name: value for (name, value) in metadata.items()})
+                with AdlsCopyUtils.httpSession().put(url, headers=metadata_headers) as response:
+                    AdlsCopyUtils.raiseForResponse(response)
+                work_queue.itemDone()
+                log.debug("Updated ownership for %s", file["name"])
+            except IOError as e:
+                log.debug("Failed to set metadata on file: %s. Error: %s", file["name"], e.args)
+                work_queue.itemFailed(file, e)
     log.debug("Thread ending")
 
 if __name__ == '__main__':
     parser = AdlsCopyUtils.createCommandArgsParser("Remaps identities on HDFS sourced data")
+    parser.add_argument('-L', '--list-parallelism', type=int, default=8, help="The number of concurrent requests used to list the source account. The top levels of the directory tree are listed separately, in parallel. Specify 1 to list the account sequentially.")
     parser.add_argument('-g', '--generate-identity-map', action='store_true', help="Specify this flag to generate a based identity mapping file using the unique identities in the source account. The identity map will be written to the file specified by the --identity-map argument.")
     args = parser.parse_known_args()[0]
+    if args.shard and args.generate_identity_map:
+        parser.error("--shard can't be used with --generate-identity-map, as each shard would only see some of the identities")
 
     AdlsCopyUtils.configureLogging(args.log_config, args.log_level, args.log_file)
+    AdlsCopyUtils.configureHttpSessions(args.max_parallelism)
+    AdlsCopyUtils.configureMetrics(args)
+    AdlsCopyUtils.configureEndpoints(args)
     print("Remapping identities for file owners in account: " + args.source_account)
 
     # Acquire SAS token, so that we don't have to sign each request (construct as string as Python 2.7 on linux doesn't marshall the args correctly with shell=True)
     sas_token = AdlsCopyUtils.getSasToken(args.source_account, args.source_key)
 
-    # Get the full account list 
-    inventory = AdlsCopyUtils.getSourceFileList(args.source_account, args.source_key, args.source_container, args.prefix)
-    
+    # Stream the account list
+    if args.replay_dead_letters:
+        inventory = AdlsCopyUtils.loadDeadLetters(args.replay_dead_letters)
+    elif args.list_parallelism > 1:
+        # The order in which the items are processed doesn't matter
+        inventory = AdlsCopyUtils.getSourceFileListParallel(args.source_account, sas_token, args.source_container, args.prefix, args.list_parallelism)
+    else:
+        inventory = AdlsCopyUtils.getSourceFileList(args.source_account, sas_token, args.source_container, args.prefix)
+    inventory = AdlsCopyUtils.filterShard(inventory, args.shard)
+
     if args.generate_identity_map:
         log.info("Generating identity map from source account to file: " + args.identity_map)
-        unique_users = set([x["permissions"]["owner"] for x in inventory])
-        unique_groups = set([x["permissions"]["group"] for x in inventory])
+        unique_users = set()
+        unique_groups = set()
+        for x in inventory:
+            unique_users.add(x["permissions"]["owner"])
+            unique_groups.add(x["permissions"]["group"])
         identities = [{
             "type": identity_type["type"],
             "source": identity,
@@ -61,9 +84,23 @@ if __name__ == '__main__':
         with open(args.identity_map, "w+") as f:
             json.dump(identities, f)
     else:
-        # Load identity map
-        identity_map = AdlsCopyUtils.loadIdentityMap(args.identity_map)
-        # Fire up the processing in args.max_parallelism threads, co-ordinated via a thread-safe queue
-        AdlsCopyUtils.processWorkQueue(update_files_owners, [args.source_account, args.source_container, sas_token], inventory, args.max_parallelism)
+        # Load identity map (& the directory used to resolve identities missing from it)
+        identity_map = AdlsCopyUtils.createIdentityResolver(args)
+        # Only the items whose owner or group actually changes are updated, so re-running after a partial failure
+        # skips everything that has already been remapped
+        permissions_mapper = PermissionsMapper(identity_map)
+        inventory = permissions_mapper.filterChanged(inventory)
+        # Fire up the processing in args.max_parallelism threads, co-ordinated via a bounded thread-safe queue that is fed as the listing is streamed
+        update_args = [args.source_account, args.source_container, sas_token, permissions_mapper]
+        if args.engine == AdlsCopyUtils.ENGINE_ASYNCIO:
+            import adls_copy_async
+            stats = adls_copy_async.processWorkQueue(adls_copy_async.update_files_owners, update_args, inventory, args.max_parallelism, args.max_retries, args.dead_letter_file)
+        else:
+            stats = AdlsCopyUtils.processWorkQueue(update_files_owners, update_args, inventory, args.max_parallelism, args.max_retries, args.dead_letter_file)
+        identity_map.close()
+        log.info("Skipped %d items whose owner & group are unchanged", permissions_mapper.unchanged)
+        stats["unchanged"] = permissions_mapper.unchanged
+        if args.stats_file:
+            AdlsCopyUtils.writeStats(args.stats_file, stats)
     print("All work processed. Exiting")
 
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+
+# A local stand-in for the Azure Storage & Azure AD endpoints used by these scripts, for benchmarking & testing. It
+# serves a synthetic source inventory (List Blobs & ranged Get Blob), accepts Set Blob Metadata & the dfs create,
+# append, flush & setAccessControl(Recursive) calls without storing any data, and issues OAuth tokens. Latency,
+# bandwidth & throttling can be injected. Point the scripts at it with:
+#
+#   --blob-endpoint http://127.0.0.1:{port}/blob/{account} --dfs-endpoint http://127.0.0.1:{port}/dfs/{account}
+#   --login-endpoint http://127.0.0.1:{port}/login
+
+import json, threading, argparse, logging, random, time, base64, bisect
+from xml.sax.saxutils import escape
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl, unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+    from urllib import unquote
+
+log = logging.getLogger(__name__)
+
+def mixed_size(rnd):
+    # Mostly small files, with a long tail of large ones
+    draw = rnd.random()
+    if draw < 0.9:
+        return rnd.randint(1, pow(2, 20))
+    if draw < 0.99:
+        return rnd.randint(pow(2, 20), 64 * pow(2, 20))
+    return rnd.randint(64 * pow(2, 20), pow(2, 30))
+
+# Named file size distributions for the synthetic inventory. Each is a function of a random.Random returning a size.
+DISTRIBUTIONS = {
+    # Typical of log & small-file heavy namespaces
+    "small": lambda rnd: min(int(rnd.lognormvariate(11, 1.5)), 4 * pow(2, 20)),
+    "mixed": mixed_size,
+    # Data warehouse style - every file is hundreds of MB
+    "large": lambda rnd: rnd.randint(100 * pow(2, 20), 2 * pow(2, 30)),
+}
+
+def file_size_distribution(name):
+    # Either one of the named distributions or 'fixed:{bytes}'
+    if name.startswith("fixed:"):
+        size = int(name.split(":", 1)[1])
+        return lambda rnd: size
+    return DISTRIBUTIONS[name]
+
+class SyntheticInventory:
+    # A deterministic namespace of directories, each holding up to 'fanout' files, in List Blobs (lexical) order
+    LAST_MODIFIED = "Mon, 01 Jan 2018 00:00:00 GMT"
+
+    def __init__(self, file_count, distribution="mixed", fanout=1000, users=10, groups=5, seed=0):
+        rnd = random.Random(seed)
+        size_of = file_size_distribution(distribution)
+        self.names = []
+        self.sizes = []
+        self.owners = []
+        self.is_folder = []
+        for idx in range(file_count):
+            if idx % fanout == 0:
+                self._add("dir{0:05d}".format(idx // fanout), 0, (idx // fanout) % users, True)
+            self._add("dir{0:05d}/file{1:07d}".format(idx // fanout, idx), size_of(rnd), rnd.randrange(users * groups), False)
+        self.users = users
+        self.groups = groups
+        self.index = dict((name, idx) for idx, name in enumerate(self.names))
+
+    def _add(self, name, size, owner, is_folder):
+        self.names.append(name)
+        self.sizes.append(size)
+        self.owners.append(owner)
+        self.is_folder.append(is_folder)
+
+    def __len__(self):
+        return len(self.names)
+
+    def permissions(self, idx):
+        return {
+            "owner": "user{0}".format(self.owners[idx] % self.users),
+            "group": "group{0}".format(self.owners[idx] % self.groups),
+            "permissions": "rwxr-x---",
+            "stickyBit": "false"
+        }
+
+    def totalBytes(self):
+        return sum(self.sizes)
+
+    def fileCount(self):
+        return len(self.is_folder) - sum(self.is_folder)
+
+    def writeAcls(self, output):
+        # In the format written by export-acls.py
+        for idx, name in enumerate(self.names):
+            permissions = self.permissions(idx)
+            acl = ["user::rwx", "group::r-x", "other::---", "user:{0}:r-x".format(permissions["owner"])]
+            if self.is_folder[idx]:
+                acl += ["default:" + entry for entry in acl]
+            output.write(json.dumps({"file": name, "owner": permissions["owner"], "group": permissions["group"], "acl": acl}) + "\n")
+
+    def writeIdentityMap(self, output):
+        json.dump([{"type": identity_type, "source": "{0}{1}".format(identity_type, idx), "target": "00000000-0000-0000-{0:04d}-{1:012d}".format(type_idx, idx)}
+            for type_idx, (identity_type, count) in enumerate([("user", self.users), ("group", self.groups)])
+            for idx in range(count)], output)
+
+class MockStorageStats:
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.requests = {}
+        self.throttled = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def record(self, operation, bytes_read=0, bytes_written=0, throttled=False):
+        with self.mutex:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+            if throttled:
+                self.throttled += 1
+
+    def toDict(self):
+        with self.mutex:
+            return {"requests": dict(self.requests), "throttled": self.throttled, "bytes_read": self.bytes_read, "bytes_written": self.bytes_written}
+
+class MockStorageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    CHUNK_SIZE = 64 * 1024
+    # Bytes served for every blob, repeated as needed
+    PATTERN = bytes(bytearray(random.Random(0).getrandbits(8) for _ in range(CHUNK_SIZE)))
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_PATCH(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        parts = [unquote(part) for part in url.path.lstrip("/").split("/")]
+        service = parts[0]
+        # /{service}/{account}/{container}/{path}
+        name = "/".join(parts[3:])
+        operation = self._operationOf(service, params)
+        config = self.server.config
+        body_length = self._readBody()
+        if config.latency:
+            time.sleep(max(0, random.gauss(config.latency, config.latency_jitter)))
+        if operation not in ("token", "list", "stats") and config.throttle_rate and random.random() < config.throttle_rate:
+            self.server.stats.record(operation, throttled=True)
+            self._sendError(service, 503, "ServerBusy", "Injected throttling", {"Retry-After": str(config.retry_after)})
+            return
+        if operation == "stats":
+            self._sendJson(200, self.server.stats.toDict())
+        elif operation == "token":
+            self.server.stats.record(operation)
+            self._sendToken()
+        elif operation == "list":
+            self.server.stats.record(operation)
+            self._sendListing(params)
+        elif operation == "read":
+            self._sendBlob(name)
+        elif operation == "setAccessControlRecursive":
+            self.server.stats.record(operation)
+            self._sendJson(200, {"directoriesSuccessful": 1, "filesSuccessful": 0, "failureCount": 0, "failedEntries": []})
+        elif operation in ("append", "append_flush"):
+            self.server.stats.record(operation, bytes_written=body_length)
+            self._send(202)
+        elif operation == "create":
+            self.server.stats.record(operation)
+            self._send(201)
+        else:
+            self.server.stats.record(operation)
+            self._send(200)
+
+    def _operationOf(self, service, params):
+        if service == "_stats":
+            return "stats"
+        if service == "login":
+            return "token"
+        if "resource" in params:
+            return "create"
+        if "action" in params:
+            return "append_flush" if params["action"] == "append" and params.get("flush") == "true" else params["action"]
+        if "comp" in params:
+            return params["comp"]
+        return "read" if self.command == "GET" else self.command.lower()
+
+    def _throttleBandwidth(self, length, start_time):
+        bandwidth = self.server.config.bandwidth
+        if bandwidth:
+            delay = length / (bandwidth * pow(2, 20)) - (time.time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _readBody(self):
+        # Request bodies are discarded, but read at the configured bandwidth
+        start_time = time.time()
+        length = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                chunk_length = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if chunk_length == 0:
+                    self.rfile.readline()
+                    break
+                self._discard(chunk_length)
+                self.rfile.readline()
+                length += chunk_length
+                self._throttleBandwidth(length, start_time)
+        else:
+            remaining = int(self.headers.get("Content-Length") or 0)
+            while remaining > 0:
+                read = self._discard(min(remaining, self.CHUNK_SIZE))
+                if not read:
+                    break
+                remaining -= read
+                length += read
+                self._throttleBandwidth(length, start_time)
+        return length
+
+    def _discard(self, length):
+        read = 0
+        while read < length:
+            data = self.rfile.read(min(length - read, self.CHUNK_SIZE))
+            if not data:
+                break
+            read += len(data)
+        return read
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _sendJson(self, status, value, headers=None):
+        headers = dict(headers or {})
+        headers["Content-Type"] = "application/json"
+        self._send(status, json.dumps(value).encode("utf-8"), headers)
+
+    def _sendError(self, service, status, code, message, headers=None):
+        # As with the real services, the blob endpoint returns XML error bodies & the dfs endpoint JSON
+        if service != "blob":
+            self._sendJson(status, {"error": {"code": code, "message": message}}, headers)
+            return
+        headers = dict(headers or {})
+        headers["Content-Type"] = "application/xml"
+        body = '<?xml version="1.0" encoding="utf-8"?><Error><Code>{0}</Code><Message>{1}</Message></Error>'.format(escape(code), escape(message))
+        self._send(status, body.encode("utf-8"), headers)
+
+    def _sendToken(self):
+        # Unsigned, but shaped like a JWT so that the object id can be decoded
+        encode = lambda value: base64.urlsafe_b64encode(json.dumps(value).encode("utf-8")).decode("ascii").rstrip("=")
+        token = ".".join([encode({"alg": "none"}), encode({"oid": "00000000-0000-0000-ffff-000000000000"}), ""])
+        self._sendJson(200, {"access_token": token, "expires_in": 3600, "token_type": "Bearer"})
+
+    def _sendListing(self, params):
+        inventory = self.server.inventory
+        prefix = params.get("prefix", "")
+        max_results = int(params.get("maxresults", 5000))
+        start = bisect.bisect_left(inventory.names, params.get("marker") or prefix)
+        delimiter = params.get("delimiter")
+        blobs = []
+        idx = start
+        while idx < len(inventory) and len(blobs) < max_results and inventory.names[idx].startswith(prefix):
+            if delimiter and delimiter in inventory.names[idx][len(prefix):]:
+                # Roll the whole sub-tree up into a single BlobPrefix & skip past it
+                blob_prefix = inventory.names[idx][:inventory.names[idx].index(delimiter, len(prefix)) + len(delimiter)]
+                blobs.append("<BlobPrefix><Name>{0}</Name></BlobPrefix>".format(escape(blob_prefix)))
+                idx = bisect.bisect_left(inventory.names, blob_prefix[:-1] + chr(ord(blob_prefix[-1]) + 1), idx)
+                continue
+            metadata = "<hdi_permission>{0}</hdi_permission>".format(escape(json.dumps(inventory.permissions(idx))))
+            if inventory.is_folder[idx]:
+                metadata += "<hdi_isfolder>true</hdi_isfolder>"
+            blobs.append("<Blob><Name>{0}</Name><Properties><Last-Modified>{1}</Last-Modified><Content-Length>{2}</Content-Length></Properties><Metadata>{3}</Metadata></Blob>".format(
+                escape(inventory.names[idx]), inventory.LAST_MODIFIED, inventory.sizes[idx], metadata))
+            idx += 1
+        next_marker = inventory.names[idx] if idx < len(inventory) and inventory.names[idx].startswith(prefix) else ""
+        body = '<?xml version="1.0" encoding="utf-8"?><EnumerationResults><Blobs>{0}</Blobs><NextMarker>{1}</NextMarker></EnumerationResults>'.format(
+            "".join(blobs), escape(next_marker))
+        self._send(200, body.encode("utf-8"), {"Content-Type": "application/xml"})
+
+    def _sendBlob(self, name):
+        inventory = self.server.inventory
+        idx = inventory.index.get(name)
+        if idx is None:
+            self.server.stats.record("read")
+            self._sendError("blob", 404, "BlobNotFound", name)
+            return
+        size = inventory.sizes[idx]
+        status = 200
+        start, end = 0, size - 1
+        range_header = self.headers.get("x-ms-range") or self.headers.get("Range")
+        if range_header:
+            first, _, last = range_header.split("=", 1)[1].partition("-")
+            start, end = int(first), min(int(last) if last else size - 1, size - 1)
+            status = 206
+        length = max(end - start + 1, 0)
+        self.server.stats.record("read", bytes_read=length)
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Last-Modified", inventory.LAST_MODIFIED)
+        self.end_headers()
+        start_time = time.time()
+        sent = 0
+        while sent < length:
+            offset = (start + sent) % self.CHUNK_SIZE
+            chunk = self.PATTERN[offset:offset + min(length - sent, self.CHUNK_SIZE - offset)]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            self._throttleBandwidth(sent, start_time)
+
+class MockStorageServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Allow plenty of connections from highly parallel clients
+    request_queue_size = 1024
+
+    def __init__(self, inventory, config, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), MockStorageHandler)
+        self.inventory = inventory
+        self.config = config
+        self.stats = MockStorageStats()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def endpointArgs(self):
+        base_url = "http://127.0.0.1:{0}".format(self.port)
+        return ["--blob-endpoint", base_url + "/blob/{account}", "--dfs-endpoint", base_url + "/dfs/{account}", "--login-endpoint", base_url + "/login"]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+def add_server_args(parser):
+    parser.add_argument('--latency', type=float, default=0.0, help="The mean latency (in seconds) added to every request")
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help="The standard deviation of the added latency (in seconds)")
+    parser.add_argument('--bandwidth', type=float, default=0.0, help="The bandwidth (in MB/s) of each request body & response. 0 is unlimited.")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="The fraction of requests (0-1) that are rejected with 503 ServerBusy")
+    parser.add_argument('--retry-after', type=int, default=1, help="The Retry-After (in seconds) returned with throttled requests")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the Azure Storage blob & dfs endpoints, serving a synthetic inventory")
+    parser.add_argument('-P', '--port', type=int, default=8100, help="The port to listen on")
+    parser.add_argument('-n', '--files', type=int, default=10000, help="The number of files in the synthetic inventory")
+    parser.add_argument('-d', '--distribution', default="mixed", help="The file size distribution: {0} or fixed:{{bytes}}".format(", ".join(sorted(DISTRIBUTIONS))))
+    parser.add_argument('--fanout', type=int, default=1000, help="The number of files in each directory")
+    parser.add_argument('--seed', type=int, default=0, help="The seed for the synthetic inventory")
+    parser.add_argument('--acls', help="Also write the ACLs of the inventory to this file (as exported by export-acls.py)")
+    parser.add_argument('--identity-map', help="Also write an identity map covering the inventory's users & groups to this file")
+    add_server_args(parser)
+    parser.add_argument('-v', '--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="Level of log information to output. Default is 'INFO'.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=getattr(logging, args.log_level))
+    inventory = SyntheticInventory(args.files, args.distribution, args.fanout, seed=args.seed)
+    if args.acls:
+        with open(args.acls, "w") as f:
+            inventory.writeAcls(f)
+    if args.identity_map:
+        with open(args.identity_map, "w") as f:
+            inventory.writeIdentityMap(f)
+    server = MockStorageServer(inventory, args, args.port)
+    log.info("Serving %d files (%.1f MB) on port %d. Stats at http://127.0.0.1:%d/_stats", inventory.fileCount(), inventory.totalBytes() / float(pow(2, 20)), server.port, server.port)
+    log.info("Endpoint arguments: %s", " ".join(server.endpointArgs()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Benchmarks copy-to-adls.py, copy-acls.py & identity-mapper.py against a local mock storage server (see
+# mock_storage_server.py), so that block size, parallelism & engine choices can be compared before a long run. Every
+# combination of the given tools, file size distributions, engines, parallelism & block sizes is run in turn, and the
+# elapsed time, throughput, requests per item & peak memory of each run is reported.
+
+import sys, subprocess, json, argparse, logging, tempfile, shutil, os, time, itertools
+from mock_storage_server import SyntheticInventory, MockStorageServer, DISTRIBUTIONS, add_server_args
+
+log = logging.getLogger(__name__)
+
+TOOLS = ["copy-to-adls", "copy-acls", "identity-mapper"]
+
+def tool_args(tool, work_dir, parallelism, engine, block_size):
+    common = ["-t", str(parallelism), "-e", engine, "-i", os.path.join(work_dir, "identity_map.json"), "--progress-interval", "0"]
+    dest = ["-A", "bench", "-C", "dest", "-I", "benchmark", "-S", "secret"]
+    # Any base64 string will do as the key, as the server doesn't check signatures
+    source = ["-s", "bench", "-k", "a2V5", "-c", "source"]
+    if tool == "copy-to-adls":
+        return source + dest + common + ["-b", str(block_size), "-P", str(block_size * 4)]
+    elif tool == "copy-acls":
+        return dest + common + ["--source-acls", os.path.join(work_dir, "acls.json")]
+    return source + common
+
+def run_tool(command, log_file):
+    # Returns the exit code, elapsed time & peak RSS (in MB, if available) of the command
+    start_time = time.time()
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        # ru_maxrss is in KB on Linux
+        peak_rss = usage.ru_maxrss / 1024.0
+    else:
+        process.wait()
+        peak_rss = None
+    return process.returncode, time.time() - start_time, peak_rss
+
+def run_benchmark(tool, inventory, server_args, parallelism, engine, block_size, work_dir, python):
+    server = MockStorageServer(inventory, server_args).start()
+    try:
+        command = [python, os.path.join(os.path.dirname(os.path.abspath(__file__)), tool + ".py")] + tool_args(tool, work_dir, parallelism, engine, block_size) + server.endpointArgs()
+        log.debug(" ".join(command))
+        log_name = os.path.join(work_dir, "{0}-{1}-{2}-{3}.log".format(tool, engine, parallelism, block_size))
+        with open(log_name, "w") as log_file:
+            retcode, elapsed, peak_rss = run_tool(command, log_file)
+        stats = server.stats.toDict()
+    finally:
+        server.shutdown()
+        server.server_close()
+    # The listing & token requests are a fixed overhead, rather than a cost of each item
+    item_requests = sum(count for operation, count in stats["requests"].items() if operation not in ("list", "token"))
+    return {
+        "tool": tool,
+        "engine": engine,
+        "parallelism": parallelism,
+        "block_size": block_size,
+        "exit_code": retcode,
+        "log": log_name,
+        "elapsed": elapsed,
+        "items_per_sec": len(inventory) / elapsed,
+        "mb_per_sec": stats["bytes_written"] / float(pow(2, 20)) / elapsed,
+        "requests_per_item": float(item_requests) / len(inventory),
+        "throttled": stats["throttled"],
+        "peak_rss_mb": peak_rss,
+        "requests": stats["requests"]
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the copy scripts against a local mock storage server")
+    parser.add_argument('--tools', default=",".join(TOOLS), help="Comma separated list of the tools to benchmark. Default is all of: {0}".format(", ".join(TOOLS)))
+    parser.add_argument('-n', '--files', type=int, default=10000, help="The number of files in each synthetic inventory")
+    parser.add_argument('-d', '--distributions', default="small,mixed", help="Comma separated list of the file size distributions to benchmark: {0} or fixed:{{bytes}}".format(", ".join(sorted(DISTRIBUTIONS))))
+    parser.add_argument('--fanout', type=int, default=1000, help="The number of files in each directory")
+    parser.add_argument('-e', '--engines', default="threads", help="Comma separated list of the engines to benchmark (threads, asyncio)")
+    parser.add_argument('-t', '--parallelism', default="10", help="Comma separated list of the --max-parallelism values to benchmark")
+    parser.add_argument('-b', '--block-sizes', default="4", help="Comma separated list of the block sizes (in MB) to benchmark for copy-to-adls")
+    parser.add_argument('-o', '--report', help="The name of a file to write the results to (JSON)")
+    parser.add_argument('--python', default=sys.executable, help="The python interpreter used to run the tools")
+    add_server_args(parser)
+    parser.add_argument('-v', '--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="Level of log information to output. Default is 'INFO'.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=getattr(logging, args.log_level))
+    work_dir = tempfile.mkdtemp(prefix="adls-benchmark-")
+    results = []
+    failures = 0
+    for distribution in args.distributions.split(","):
+        inventory = SyntheticInventory(args.files, distribution, args.fanout)
+        with open(os.path.join(work_dir, "acls.json"), "w") as f:
+            inventory.writeAcls(f)
+        with open(os.path.join(work_dir, "identity_map.json"), "w") as f:
+            inventory.writeIdentityMap(f)
+        log.info("Inventory '%s': %d files, %.1f MB", distribution, inventory.fileCount(), inventory.totalBytes() / float(pow(2, 20)))
+        for tool, engine, parallelism in itertools.product(args.tools.split(","), args.engines.split(","), [int(value) for value in args.parallelism.split(",")]):
+            # The block size only affects the copy
+            for block_size in [int(value) for value in args.block_sizes.split(",")] if tool == "copy-to-adls" else [0]:
+                result = run_benchmark(tool, inventory, args, parallelism, engine, block_size, work_dir, args.python)
+                result["distribution"] = distribution
+                results.append(result)
+                if result["exit_code"] != 0:
+                    failures += 1
+                    log.error("%s failed with exit code %d. See: %s", tool, result["exit_code"], result["log"])
+                log.info("%-15s %-6s %-8s t=%-4d b=%-3d %8.1fs %9.1f items/s %8.1f MB/s %5.2f req/item %6d throttled %8s MB peak RSS",
+                    tool, distribution, engine, parallelism, block_size, result["elapsed"], result["items_per_sec"], result["mb_per_sec"],
+                    result["requests_per_item"], result["throttled"], "{0:.1f}".format(result["peak_rss_mb"]) if result["peak_rss_mb"] is not None else "n/a")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+    if failures:
+        log.error("%d runs failed. Logs are in: %s", failures, work_dir)
+        sys.exit(1)
+    shutil.rmtree(work_dir, ignore_errors=True)
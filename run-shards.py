@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Runs N shards of copy-to-adls.py, copy-acls.py or identity-mapper.py on this machine, each as a separate process,
+# so that the work is spread across all cores. The output of each shard is merged (each line prefixed with its shard)
+# as are their statistics once they have all completed. Any argument containing {shard} has it replaced with the
+# shard index, so that each shard can be given its own journal, manifest, dead letter or log file. eg:
+#
+#   ./run-shards.py -n 8 -- ./copy-to-adls.py -s {source_account} ... --journal ./journal-{shard}.db
+#
+# To spread the work across several machines, run the same command on each with a different --first-shard and the
+# same --total-shards.
+
+import sys, subprocess, json, threading, argparse, logging, tempfile, shutil, os
+from adls_copy_utils import AdlsCopyUtils
+
+log = logging.getLogger(__name__)
+
+class ShardProcess:
+    def __init__(self, command, index, count, stats_file, output, output_mutex):
+        self.index = index
+        self.stats_file = stats_file
+        self.output = output
+        self.output_mutex = output_mutex
+        args = [arg.replace("{shard}", str(index)) for arg in command] + ["--shard", "{0}/{1}".format(index, count), "--stats-file", stats_file]
+        log.debug(" ".join(args))
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        self.reader = threading.Thread(target=self._copyOutput)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _copyOutput(self):
+        prefix = "[shard {0}] ".format(self.index)
+        for line in self.process.stdout:
+            with self.output_mutex:
+                self.output.write(prefix + line)
+                self.output.flush()
+
+    def wait(self):
+        retcode = self.process.wait()
+        self.reader.join()
+        return retcode
+
+    def loadStats(self):
+        # The stats file is only written if the shard ran to completion
+        if not os.path.exists(self.stats_file) or not os.path.getsize(self.stats_file):
+            return None
+        with open(self.stats_file) as f:
+            return json.load(f)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a command as several shards in parallel & merge their output & statistics")
+    parser.add_argument('-n', '--processes', type=int, default=os.cpu_count() if hasattr(os, "cpu_count") else 2, help="The number of shards to run on this machine. Defaults to the number of CPUs.")
+    parser.add_argument('--total-shards', type=int, help="The total number of shards across all machines. Defaults to the number of processes (ie. all of the work runs on this machine).")
+    parser.add_argument('--first-shard', type=int, default=0, help="The index of the first shard run on this machine. Shards first-shard to first-shard + processes - 1 are run.")
+    parser.add_argument('--stats-file', help="The name of a file to write the combined statistics of all shards to (JSON)")
+    parser.add_argument('-f', '--log-config', help="The name of a configuration file for logging.")
+    parser.add_argument('-l', '--log-file', help="Name of file to have log output written to (default is stdout/stderr)")
+    parser.add_argument('-v', '--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="Level of log information to output. Default is 'INFO'.")
+    parser.add_argument('command', nargs=argparse.REMAINDER, help="The command (and its arguments) to run for each shard. Separate it from these arguments with --")
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not command:
+        parser.error("A command to run must be specified")
+    total_shards = args.total_shards or args.processes
+    if args.processes < 1 or args.first_shard < 0 or args.first_shard + args.processes > total_shards:
+        parser.error("Shards {0} to {1} are outside of the {2} total shards".format(args.first_shard, args.first_shard + args.processes - 1, total_shards))
+
+    AdlsCopyUtils.configureLogging(args.log_config, args.log_level, args.log_file)
+    log.info("Running shards %d to %d (of %d): %s", args.first_shard, args.first_shard + args.processes - 1, total_shards, " ".join(command))
+
+    stats_dir = tempfile.mkdtemp()
+    output_mutex = threading.Lock()
+    shards = []
+    try:
+        for index in range(args.first_shard, args.first_shard + args.processes):
+            shards.append(ShardProcess(command, index, total_shards, os.path.join(stats_dir, "shard-{0}.json".format(index)), sys.stdout, output_mutex))
+        failures = 0
+        for shard in shards:
+            retcode = shard.wait()
+            if retcode != 0:
+                log.error("Shard %d failed. Exit code: %d", shard.index, retcode)
+                failures += 1
+        stats = {}
+        for shard in shards:
+            shard_stats = shard.loadStats()
+            if shard_stats:
+                AdlsCopyUtils.mergeStats(stats, shard_stats)
+    except KeyboardInterrupt:
+        log.warning("Interrupted. Stopping all shards")
+        for shard in shards:
+            shard.process.terminate()
+        raise
+    finally:
+        shutil.rmtree(stats_dir, ignore_errors=True)
+
+    log.info("Combined statistics for %d shards: %s", len(shards), json.dumps(stats, sort_keys=True))
+    if args.stats_file:
+        AdlsCopyUtils.writeStats(args.stats_file, stats)
+    if failures:
+        log.error("%d of %d shards failed", failures, len(shards))
+        sys.exit(1)
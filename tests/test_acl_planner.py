@@ -0,0 +1,91 @@
+import io, json
+import pytest
+from conftest import load_script
+
+copy_acls = load_script("copy-acls")
+AclPlanner = copy_acls.AclPlanner
+
+DIR_ACL = ["user::rwx", "group::r-x", "other::---", "default:user::rwx", "default:group::r-x", "default:other::---"]
+FILE_ACL = ["user::rwx", "group::r-x", "other::---"]
+OTHER_ACL = ["user::rwx", "group::rwx", "other::r-x"]
+
+def entry(name, acl):
+    return {"file": name, "owner": "hdfs", "group": "hadoop", "acl": acl}
+
+def plan(entries, min_subtree_size):
+    planner = AclPlanner(min_subtree_size)
+    planner.countSubtrees(entries)
+    exceptions = io.StringIO()
+    planner.plan(entries, exceptions)
+    return planner, [json.loads(line)["file"] for line in exceptions.getvalue().splitlines()]
+
+def test_with_next_pairs_each_entry_with_its_successor():
+    assert list(copy_acls.with_next([1, 2, 3])) == [(1, 2), (2, 3), (3, None)]
+    assert list(copy_acls.with_next([])) == []
+
+def test_access_acl_drops_default_entries():
+    assert copy_acls.access_acl(DIR_ACL) == tuple(FILE_ACL)
+
+def test_uniform_subtree_is_applied_recursively():
+    entries = [entry("data", DIR_ACL)] + [entry("data/f{0}".format(idx), FILE_ACL) for idx in range(10)]
+    planner, exceptions = plan(entries, min_subtree_size=5)
+    assert [item["file"] for item in planner.phases[0]] == ["data"]
+    assert planner.phases[0][0]["recursive"]
+    assert exceptions == []
+    assert planner.paths == 11
+
+def test_paths_that_differ_from_the_recursive_acl_are_exceptions():
+    entries = ([entry("data", DIR_ACL)] + [entry("data/f{0}".format(idx), FILE_ACL) for idx in range(10)] +
+        [entry("data/odd", OTHER_ACL)])
+    planner, exceptions = plan(entries, min_subtree_size=5)
+    assert [item["file"] for item in planner.phases[0]] == ["data"]
+    assert exceptions == ["data/odd"]
+
+def test_small_subtrees_are_applied_individually():
+    entries = [entry("data", DIR_ACL)] + [entry("data/f{0}".format(idx), FILE_ACL) for idx in range(3)]
+    planner, exceptions = plan(entries, min_subtree_size=5)
+    assert planner.phases == []
+    assert exceptions == ["data", "data/f0", "data/f1", "data/f2"]
+
+def test_nested_subtree_with_a_different_acl_is_a_later_phase():
+    entries = ([entry("data", DIR_ACL)] + [entry("data/f{0}".format(idx), FILE_ACL) for idx in range(10)] +
+        [entry("data/sub", OTHER_ACL + ["default:user::rwx"])] +
+        [entry("data/sub/g{0}".format(idx), OTHER_ACL) for idx in range(10)])
+    planner, exceptions = plan(entries, min_subtree_size=5)
+    assert [item["file"] for item in planner.phases[0]] == ["data"]
+    assert [item["file"] for item in planner.phases[1]] == ["data/sub"]
+    assert exceptions == []
+
+def test_out_of_order_export_is_rejected():
+    # a/c/d is listed without its parent, a/c
+    entries = [entry("a", DIR_ACL), entry("a/b", FILE_ACL), entry("a/c/d", FILE_ACL)]
+    with pytest.raises(ValueError):
+        AclPlanner(1).countSubtrees(entries)
+
+class FakeResponse:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.headers = {}
+        self.text = text
+
+@pytest.mark.parametrize("body", ["", "<html>Bad Gateway</html>", '{"message": "no error object"}'])
+def test_acl_errors_without_a_json_error_are_raised(body):
+    with pytest.raises(IOError) as error:
+        copy_acls.raise_acl_error("data/f", FakeResponse(502, body), {"x-ms-acl": "user::rwx"})
+    assert error.value.isRetriable()
+
+def test_acl_error_for_a_missing_path_is_ignored():
+    copy_acls.raise_acl_error("data/f", FakeResponse(404, '{"error": {"code": "PathNotFound"}}'), {"x-ms-acl": "user::rwx"})
+
+def test_async_acl_errors_without_a_json_error_are_raised():
+    adls_copy_async = pytest.importorskip("adls_copy_async")
+    asyncio = pytest.importorskip("asyncio")
+    class AsyncResponse:
+        status = 503
+        headers = {}
+        async def text(self):
+            return ""
+    response = AsyncResponse()
+    with pytest.raises(IOError) as error:
+        asyncio.run(adls_copy_async._raiseAclError("data/f", response, {"x-ms-acl": "user::rwx"}))
+    assert error.value.isRetriable()
@@ -0,0 +1,83 @@
+import asyncio, threading, time
+import pytest
+from adls_copy_utils import IdentityResolver
+
+adls_copy_async = pytest.importorskip("adls_copy_async")
+
+class SlowDirectory:
+    BATCH_SIZE = 10
+
+    def resolve(self, identity_type, identities):
+        time.sleep(0.3)
+        return dict((identity, "resolved-" + identity) for identity in identities)
+
+def test_directory_lookups_dont_block_the_event_loop():
+    resolver = IdentityResolver({"user": {"mapped": "target"}}, SlowDirectory())
+    ticks = []
+    async def ticker():
+        for _ in range(10):
+            ticks.append(time.time())
+            await asyncio.sleep(0.02)
+    async def lookup():
+        headers = {}
+        await adls_copy_async._add_identity_header(headers, "user", "bob", "x-ms-owner", resolver)
+        await adls_copy_async._add_identity_header(headers, "group", "staff", "x-ms-group", resolver)
+        return headers
+    async def run():
+        return await asyncio.gather(lookup(), ticker())
+    try:
+        headers, _ = asyncio.run(run())
+    finally:
+        resolver.close()
+    assert headers == {"x-ms-owner": "resolved-bob", "x-ms-group": "resolved-staff"}
+    # The ticker kept running while the lookups waited for the directory
+    assert len(ticks) == 10 and ticks[-1] - ticks[0] < 0.5
+
+def test_identity_map_lookups_run_inline():
+    headers = {}
+    asyncio.run(adls_copy_async._add_identity_header(headers, "user", "bob", "x-ms-owner", {"user": {"bob": "target"}}))
+    assert headers == {"x-ms-owner": "target"}
+
+def test_items_waiting_for_the_concurrency_limit_are_woken_in_turn():
+    async def run():
+        work_queue = adls_copy_async.AsyncWorkQueue(None, None, [], 4, 0, None)
+        work_queue.concurrency.throttled()
+        acquired = []
+        async def item(idx):
+            await work_queue.acquire()
+            acquired.append(idx)
+        tasks = [asyncio.ensure_future(item(idx)) for idx in range(20)]
+        await asyncio.sleep(0.01)
+        # The limit has been halved to 2 & the other items wait without polling
+        assert acquired == [0, 1]
+        assert len(work_queue.limit_waiters) == 18
+        # A cancelled waiter doesn't hold up the rest
+        tasks[2].cancel()
+        for _ in range(100):
+            if len(acquired) == 19:
+                break
+            work_queue.release(success=False)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+        assert sorted(acquired) == [idx for idx in range(20) if idx != 2]
+        assert work_queue.concurrency.active == 2
+    asyncio.run(run())
+
+def test_feeder_hands_over_items_read_before_the_stream_blocks():
+    resume = threading.Event()
+    def inventory():
+        yield "a"
+        yield "b"
+        # Eg. DirectoryTracker waiting for "a" to be created
+        resume.wait(5)
+        yield "c"
+        raise IOError("listing failed")
+    feeder = adls_copy_async.InventoryFeeder(inventory())
+    batch = feeder.nextBatch()
+    while len(batch) < 2:
+        batch += feeder.nextBatch()
+    assert batch == ["a", "b"]
+    resume.set()
+    assert feeder.nextBatch() == ["c"]
+    with pytest.raises(IOError):
+        feeder.nextBatch()
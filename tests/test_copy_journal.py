@@ -0,0 +1,73 @@
+import threading
+from adls_copy_utils import CopyJournal
+
+def test_lookup_sees_buffered_and_committed_records(tmp_path):
+    journal = CopyJournal(str(tmp_path / "journal.db"))
+    try:
+        assert journal.lookup("a") is None
+        journal.recordCreated("a")
+        assert journal.lookup("a") == (CopyJournal.STATE_CREATED, 0)
+        journal.commit()
+        assert journal.lookup("a") == (CopyJournal.STATE_CREATED, 0)
+        journal.recordFlushed("a", 100)
+        assert journal.lookup("a") == (CopyJournal.STATE_FLUSHED, 100)
+    finally:
+        journal.close()
+
+def test_only_the_contiguous_appended_offset_is_recorded(tmp_path):
+    journal = CopyJournal(str(tmp_path / "journal.db"))
+    try:
+        journal.recordCreated("a")
+        journal.recordAppend("a", 10, 10)
+        journal.recordAppend("a", 20, 10)
+        # The first range is still outstanding, so resuming must start from 0
+        assert journal.lookup("a") == (CopyJournal.STATE_CREATED, 0)
+        journal.recordAppend("a", 0, 10)
+        assert journal.lookup("a") == (CopyJournal.STATE_APPENDED, 30)
+    finally:
+        journal.close()
+
+def test_resumed_file_records_from_its_offset(tmp_path):
+    journal = CopyJournal(str(tmp_path / "journal.db"))
+    try:
+        journal.recordCreated("a", 50)
+        assert journal.lookup("a") == (CopyJournal.STATE_APPENDED, 50)
+        journal.recordAppend("a", 50, 25)
+        assert journal.lookup("a") == (CopyJournal.STATE_APPENDED, 75)
+    finally:
+        journal.close()
+
+def test_records_survive_reopening(tmp_path):
+    journal_file = str(tmp_path / "journal.db")
+    journal = CopyJournal(journal_file)
+    journal.recordCreated("a")
+    journal.recordAppend("a", 0, 10)
+    journal.recordFlushed("b", 5)
+    journal.close()
+    journal = CopyJournal(journal_file)
+    try:
+        assert journal.lookup("a") == (CopyJournal.STATE_APPENDED, 10)
+        assert journal.lookup("b") == (CopyJournal.STATE_FLUSHED, 5)
+    finally:
+        journal.close()
+
+def test_concurrent_lookups_see_every_record(tmp_path):
+    journal = CopyJournal(str(tmp_path / "journal.db"))
+    journal.BATCH_SIZE = 50
+    errors = []
+    def worker(idx):
+        try:
+            for file_idx in range(200):
+                name = "{0}/{1}".format(idx, file_idx)
+                journal.recordFlushed(name, file_idx)
+                if journal.lookup(name) != (CopyJournal.STATE_FLUSHED, file_idx):
+                    errors.append(name)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    journal.close()
+    assert errors == []
@@ -0,0 +1,36 @@
+import threading
+from conftest import load_script
+
+copy_to_adls = load_script("copy-to-adls")
+
+def item(name, is_folder=False):
+    parent = name.rsplit("/", 1)[0] if "/" in name else ""
+    return {"name": name, "parent_directory": parent, "is_folder": is_folder}
+
+def test_children_wait_for_their_directory():
+    tracker = copy_to_adls.DirectoryTracker()
+    scheduled = [entry["name"] for entry in tracker.schedule([item("a", True), item("a/f1"), item("a/f2"), item("b")])]
+    assert scheduled == ["a", "b"]
+    assert [entry["name"] for entry in tracker.directoryCreated("a")] == ["a/f1", "a/f2"]
+    assert tracker.held == 0
+
+def test_listing_blocks_while_too_many_items_are_held():
+    tracker = copy_to_adls.DirectoryTracker(max_held=3)
+    inventory = [item("a", True)] + [item("a/f{0}".format(idx)) for idx in range(5)] + [item("b")]
+    schedule = tracker.schedule(inventory)
+    scheduled = [next(schedule)["name"]]
+    def drain():
+        scheduled.extend(entry["name"] for entry in schedule)
+    feeder = threading.Thread(target=drain)
+    feeder.start()
+    feeder.join(0.2)
+    # The feeder is waiting for the held items to be released
+    assert feeder.is_alive()
+    assert tracker.held == 3
+    released = [entry["name"] for entry in tracker.directoryCreated("a")]
+    feeder.join(5)
+    assert not feeder.is_alive()
+    assert released == ["a/f0", "a/f1", "a/f2"]
+    # The directory exists now, so the rest of its children aren't held
+    assert scheduled == ["a", "a/f3", "a/f4", "b"]
+    assert tracker.held == 0
@@ -0,0 +1,52 @@
+import sys
+from conftest import load_script
+
+distcp_to_databox = load_script("distcp-to-databox")
+DistcpScheduler = distcp_to_databox.DistcpScheduler
+
+def run(items, max_jobs, max_inflight_size, failing=()):
+    # Each job is a short-lived python process. Returns the failed items & (path, in-flight size, running jobs) as
+    # each job is started.
+    started = []
+    def build_command(item):
+        started.append((item["path"], scheduler.inflight_size + (item["size"] or 0), len(scheduler.running) + 1))
+        return [sys.executable, "-c", "import sys, time; time.sleep(0.05); sys.exit({0})".format(1 if item["path"] in failing else 0)]
+    scheduler = DistcpScheduler(items, build_command, max_jobs, max_inflight_size)
+    return scheduler.run(), started
+
+def items(*sizes):
+    return [{"path": "/p{0}".format(idx), "size": size} for idx, size in enumerate(sizes)]
+
+def test_largest_paths_are_started_first():
+    failed, started = run(items(10, 30, None, 20), max_jobs=1, max_inflight_size=None)
+    assert failed == []
+    assert [path for path, _, _ in started] == ["/p1", "/p3", "/p0", "/p2"]
+
+def test_running_jobs_are_bounded():
+    failed, started = run(items(*([1] * 10)), max_jobs=3, max_inflight_size=None)
+    assert len(started) == 10
+    assert max(running for _, _, running in started) == 3
+
+def test_inflight_size_is_capped():
+    failed, started = run(items(60, 50, 40, 30, 20, 10), max_jobs=6, max_inflight_size=100)
+    assert len(started) == 6
+    assert max(inflight for _, inflight, _ in started) <= 100
+    # 50 doesn't fit alongside 60, so the next largest path that does (40) is started first
+    assert [path for path, _, _ in started[:2]] == ["/p0", "/p2"]
+
+def test_path_larger_than_the_cap_is_started_on_its_own():
+    failed, started = run(items(500, 10), max_jobs=2, max_inflight_size=100)
+    assert started[0] == ("/p0", 500, 1)
+    assert len(started) == 2
+
+def test_failed_jobs_are_reported():
+    failed, started = run(items(3, 2, 1), max_jobs=2, max_inflight_size=None, failing={"/p1"})
+    assert failed == [{"path": "/p1", "size": 2}]
+
+def test_read_file_list_with_sizes(tmp_path):
+    file_list = tmp_path / "list"
+    file_list.write_text("/a\n/b c\n\n/d\n")
+    sizes = tmp_path / "list.sizes"
+    sizes.write_text("10\t/a\n20\t/b c\n")
+    assert distcp_to_databox.readFileList(str(file_list), str(sizes)) == [
+        {"path": "/a", "size": 10}, {"path": "/b c", "size": 20}, {"path": "/d", "size": None}]
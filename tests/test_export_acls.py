@@ -0,0 +1,65 @@
+import io, json, time
+from conftest import load_script
+
+export_acls = load_script("export-acls")
+
+GETFACL_OUTPUT = """# file: /data
+# owner: hdfs
+# group: supergroup
+user::rwx
+group::r-x
+other::r-x
+default:user::rwx
+
+# file: /data/some file
+# owner: bob
+# group: analysts
+user::rw-
+user:alice:rwx	#effective:r--
+group::r--
+mask::r--
+other::---
+
+"""
+
+def test_relative_name():
+    assert export_acls.relative_name("/data/dir") == "data/dir"
+    assert export_acls.relative_name("hdfs://namenode:8020/data/dir") == "data/dir"
+    assert export_acls.relative_name("hdfs://namenode:8020") == ""
+
+def test_parse_getfacl():
+    entries = list(export_acls.parse_getfacl(io.StringIO(GETFACL_OUTPUT)))
+    assert entries == [
+        {"file": "data", "owner": "hdfs", "group": "supergroup", "acl": ["user::rwx", "group::r-x", "other::r-x", "default:user::rwx"]},
+        {"file": "data/some file", "owner": "bob", "group": "analysts", "acl": ["user::rw-", "user:alice:rwx", "group::r--", "mask::r--", "other::---"]},
+    ]
+
+def test_parse_getfacl_without_trailing_blank_line():
+    entries = list(export_acls.parse_getfacl(["# file: /a\n", "# owner: u\n", "# group: g\n", "user::rwx\n"]))
+    assert entries == [{"file": "a", "owner": "u", "group": "g", "acl": ["user::rwx"]}]
+
+def test_sharded_export_keeps_shard_order(monkeypatch):
+    def fake_export(paths, recursive, output):
+        # The first shard finishes last
+        if paths == ["first"]:
+            time.sleep(0.2)
+        for path in paths:
+            output.write(json.dumps({"file": path}) + "\n")
+        return len(paths)
+    monkeypatch.setattr(export_acls, "export_acls", fake_export)
+    output = io.StringIO()
+    shards = [(["first"], False), (["second", "third"], True), (["fourth"], True)]
+    total, failures = export_acls.ShardedExport(shards, 3).run(output)
+    assert (total, failures) == (4, 0)
+    assert [json.loads(line)["file"] for line in output.getvalue().splitlines()] == ["first", "second", "third", "fourth"]
+
+def test_sharded_export_counts_failed_shards(monkeypatch):
+    def fake_export(paths, recursive, output):
+        if paths == ["bad"]:
+            raise IOError("getfacl failed")
+        output.write(json.dumps({"file": paths[0]}) + "\n")
+        return 1
+    monkeypatch.setattr(export_acls, "export_acls", fake_export)
+    output = io.StringIO()
+    total, failures = export_acls.ShardedExport([(["good"], True), (["bad"], True)], 2).run(output)
+    assert (total, failures) == (1, 1)
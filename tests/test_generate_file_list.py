@@ -0,0 +1,126 @@
+import io, json, random
+import pytest
+from conftest import load_script
+
+generate_file_list = load_script("generate-file-list")
+
+def test_parse_listing_line():
+    assert generate_file_list.parseListingLine("drwxr-xr-x   - hdfs supergroup          0 2019-01-01 10:00 /data/dir\n") == {
+        "path": "/data/dir", "size": 0, "is_dir": True}
+    assert generate_file_list.parseListingLine("-rw-r--r--   3 hdfs supergroup    1048576 2019-01-01 10:00 /data/a file\n") == {
+        "path": "/data/a file", "size": 1048576, "is_dir": False}
+    assert generate_file_list.parseListingLine("Found 2 items\n") is None
+
+def test_parse_fsimage_line():
+    header = "Path\tReplication\tModificationTime\tAccessTime\tPreferredBlockSize\tBlocksCount\tFileSize\tNSQUOTA\tDSQUOTA\tPermission\tUserName\tGroupName\n"
+    assert generate_file_list.parseFsImageLine(header, "\t") is None
+    line = "/data/file\t3\t2019-01-01 10:00\t2019-01-01 10:00\t134217728\t1\t1024\t0\t0\t-rw-r-----+\tbob\thadoop\n"
+    assert generate_file_list.parseFsImageLine(line, "\t") == {
+        "path": "/data/file", "size": 1024, "is_dir": False, "permission": "-rw-r-----+", "owner": "bob", "group": "hadoop"}
+
+def test_base_acl_of_sticky_bit():
+    assert generate_file_list.baseAcl("drwxr-xr-t") == ["user::rwx", "group::r-x", "other::r-x"]
+    assert generate_file_list.baseAcl("drwxr-x--T") == ["user::rwx", "group::r-x", "other::---"]
+
+def test_export_acls_passes_entries_through():
+    entries = [{"path": "/data", "size": 0, "is_dir": True, "permission": "drwxr-x---", "owner": "hdfs", "group": "hadoop"}]
+    output = io.StringIO()
+    assert list(generate_file_list.exportAcls(entries, output)) == entries
+    assert json.loads(output.getvalue()) == {"file": "data", "owner": "hdfs", "group": "hadoop", "acl": ["user::rwx", "group::r-x", "other::---"]}
+
+def test_read_listing_only_returns_the_source_tree(tmp_path):
+    listing = tmp_path / "listing"
+    listing.write_text("".join([
+        "drwxr-xr-x   - hdfs supergroup 0 2019-01-01 10:00 /data\n",
+        "-rw-r--r--   3 hdfs supergroup 5 2019-01-01 10:00 /data/a\n",
+        "-rw-r--r--   3 hdfs supergroup 5 2019-01-01 10:00 /database/b\n",
+    ]))
+    assert [entry["path"] for entry in generate_file_list.readListing(str(listing), "/data")] == ["/data", "/data/a"]
+
+def test_calculate_directory_sizes_rolls_up_the_tree():
+    entries = [
+        {"path": "/src/a", "size": 0, "is_dir": True},
+        {"path": "/src/a/b", "size": 0, "is_dir": True},
+        {"path": "/src/a/b/f", "size": 10, "is_dir": False},
+        {"path": "/src/a/g", "size": 5, "is_dir": False},
+        {"path": "/src/h", "size": 1, "is_dir": False},
+    ]
+    assert generate_file_list.calculateDirectorySizes("/src", entries) == {"/src": 16, "/src/a": 15, "/src/a/b": 10}
+    # Only the directories that may be split are kept
+    assert generate_file_list.calculateDirectorySizes("/src", entries, 10) == {"/src": 16, "/src/a": 15}
+
+def test_sort_listing_is_depth_first():
+    paths = ["/src/b", "/src/a/b c", "/src/a/b/f", "/src/a", "/src/a/b", "/src/a/b/e", "/src/a/a"]
+    entries = [{"path": path, "size": 1, "is_dir": False} for path in paths]
+    assert [entry["path"] for entry in generate_file_list.sortListing(entries, chunkSize=2)] == [
+        "/src/a", "/src/a/a", "/src/a/b", "/src/a/b/e", "/src/a/b/f", "/src/a/b c", "/src/b"]
+
+def test_collect_allocations_keeps_the_children_of_split_directories():
+    entries = [
+        {"path": "/src/a", "size": 0, "is_dir": True},
+        {"path": "/src/a/b", "size": 0, "is_dir": True},
+        {"path": "/src/a/b/f", "size": 10, "is_dir": False},
+        {"path": "/src/a/g", "size": 5, "is_dir": False},
+        {"path": "/src/h", "size": 1, "is_dir": False},
+    ]
+    dir_sizes = generate_file_list.calculateDirectorySizes("/src", entries, 12)
+    children = generate_file_list.collectAllocations("/src", 12, entries, dir_sizes)
+    assert children == {
+        "/src": [{"path": "/src/a", "size": 15, "unit": 0}, {"path": "/src/h", "size": 1, "unit": 0}],
+        "/src/a": [{"path": "/src/a/b", "size": 10, "unit": 0}, {"path": "/src/a/g", "size": 5, "unit": 0}],
+    }
+
+@pytest.mark.parametrize("units_class", ["FirstFitUnits", "BestFitUnits"])
+def test_units_find_matches_a_linear_scan(units_class):
+    rnd = random.Random(1)
+    units = getattr(generate_file_list, units_class)(100)
+    free = []
+    for _ in range(2000):
+        size = rnd.randint(1, 100)
+        candidates = [idx for idx, space in enumerate(free) if space >= size]
+        unit_idx = units.find(size)
+        if units_class == "FirstFitUnits":
+            assert unit_idx == (candidates[0] if candidates else -1)
+        else:
+            best = min(candidates, key=lambda idx: (free[idx], idx)) if candidates else -1
+            assert unit_idx == best
+        if unit_idx < 0:
+            unit_idx = units.add()
+            free.append(100)
+        units.allocate(unit_idx, size)
+        free[unit_idx] -= size
+
+def pack(sizes, unit_size, packing):
+    children = {"/src": [{"path": "/src/f{0}".format(idx), "size": size, "unit": 0} for idx, size in enumerate(sizes)]}
+    dir_sizes = {"/src": sum(sizes)}
+    return generate_file_list.packUnits("/src", unit_size, children, dir_sizes, packing)
+
+@pytest.mark.parametrize("packing", [generate_file_list.PACKING_FFD, generate_file_list.PACKING_BFD])
+def test_pack_units_fills_each_unit_without_overflowing(packing):
+    rnd = random.Random(2)
+    sizes = [rnd.randint(1, 60) for _ in range(200)]
+    allocations = pack(sizes, 100, packing)
+    assert sorted(allocation["size"] for allocation in allocations) == sorted(sizes)
+    used = {}
+    for allocation in allocations:
+        used[allocation["unit"]] = used.get(allocation["unit"], 0) + allocation["size"]
+    assert max(used.values()) <= 100
+    # Decreasing order packing is within 11/9 OPT + 1 - the total size is a lower bound for OPT
+    assert len(used) <= 11.0 / 9 * -(-sum(sizes) // 100) + 1
+
+def test_best_fit_prefers_the_fullest_unit():
+    # 85 & 70 each open a unit & 20 fills the second to 90. First fit puts 10 into the first unit (15 free), best fit
+    # into the second (10 free).
+    ffd = pack([85, 70, 20, 10], 100, generate_file_list.PACKING_FFD)
+    bfd = pack([85, 70, 20, 10], 100, generate_file_list.PACKING_BFD)
+    assert [allocation["unit"] for allocation in ffd] == [1, 2, 2, 1]
+    assert [allocation["unit"] for allocation in bfd] == [1, 2, 2, 2]
+
+def test_pack_units_splits_directories_larger_than_a_unit():
+    children = {
+        "/src": [{"path": "/src/big", "size": 150, "unit": 0}, {"path": "/src/f", "size": 30, "unit": 0}],
+        "/src/big": [{"path": "/src/big/a", "size": 80, "unit": 0}, {"path": "/src/big/b", "size": 70, "unit": 0}],
+    }
+    allocations = generate_file_list.packUnits("/src", 100, children, {"/src": 180, "/src/big": 150}, generate_file_list.PACKING_FFD)
+    assert sorted((allocation["path"], allocation["unit"]) for allocation in allocations) == [
+        ("/src/big/a", 1), ("/src/big/b", 2), ("/src/f", 2)]
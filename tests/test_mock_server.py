@@ -0,0 +1,59 @@
+import os, sys, json, argparse, subprocess
+import pytest
+from conftest import REPO_DIR
+from mock_storage_server import MockStorageServer, SyntheticInventory
+from adls_copy_utils import AdlsCopyUtils
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+ENGINES = [AdlsCopyUtils.ENGINE_THREADS,
+    pytest.param(AdlsCopyUtils.ENGINE_ASYNCIO, marks=pytest.mark.skipif(aiohttp is None, reason="requires aiohttp"))]
+
+def server_config(throttle_rate):
+    # A Retry-After of 0 falls back to the (exponential) backoff of each item
+    return argparse.Namespace(latency=0.0, latency_jitter=0.0, bandwidth=0.0, throttle_rate=throttle_rate, retry_after=0)
+
+def copy(tmp_path, inventory, throttle_rate, engine, max_retries):
+    # Runs copy-to-adls.py against a mock server. Returns the run's stats, its dead letters & the server's stats.
+    identity_map = str(tmp_path / "identity_map.json")
+    with open(identity_map, "w") as f:
+        inventory.writeIdentityMap(f)
+    stats_file = tmp_path / "stats.json"
+    dead_letter_file = tmp_path / "dead-letters.json"
+    server = MockStorageServer(inventory, server_config(throttle_rate)).start()
+    try:
+        command = [sys.executable, os.path.join(REPO_DIR, "copy-to-adls.py"),
+            "-s", "bench", "-k", "a2V5", "-c", "source", "-A", "bench", "-C", "dest", "-I", "test", "-S", "secret",
+            "-i", identity_map, "-t", "4", "-e", engine, "--max-retries", str(max_retries), "--progress-interval", "0",
+            "--dead-letter-file", str(dead_letter_file), "--stats-file", str(stats_file)] + server.endpointArgs()
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=240)
+        assert output.returncode == 0, output.stdout
+        server_stats = server.stats.toDict()
+    finally:
+        server.shutdown()
+        server.server_close()
+    dead_letters = [json.loads(line) for line in dead_letter_file.read_text().splitlines()] if dead_letter_file.exists() else []
+    return json.loads(stats_file.read_text()), dead_letters, server_stats
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_throttled_requests_are_retried(tmp_path, engine):
+    inventory = SyntheticInventory(40, "fixed:1024", fanout=10)
+    stats, dead_letters, server_stats = copy(tmp_path, inventory, 0.05, engine, max_retries=10)
+    assert server_stats["throttled"] > 0
+    assert stats["abandoned"] == 0
+    assert dead_letters == []
+    # Every file was eventually written
+    assert server_stats["bytes_written"] == inventory.totalBytes()
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_items_are_dead_lettered_once_retries_are_exhausted(tmp_path, engine):
+    inventory = SyntheticInventory(8, "fixed:1024", fanout=4)
+    stats, dead_letters, server_stats = copy(tmp_path, inventory, 1.0, engine, max_retries=1)
+    # Every directory & file is abandoned, after 1 retry, & dead-lettered exactly once
+    assert stats["abandoned"] == len(inventory)
+    assert sorted(letter["item"]["name"] for letter in dead_letters) == sorted(inventory.names)
+    assert server_stats["throttled"] == 2 * len(inventory)
+    assert server_stats["bytes_written"] == 0
@@ -0,0 +1,43 @@
+import pytest
+from conftest import load_script
+
+copy_to_adls = load_script("copy-to-adls")
+
+@pytest.fixture
+def commits(monkeypatch):
+    # Appends always succeed & the first flush fails
+    commits = []
+    def commit_file(dest_base_url, file, token_handler, journal, manifest=None, md5=None):
+        commits.append(file["name"])
+        if len(commits) == 1:
+            raise IOError("flush failed")
+    monkeypatch.setattr(copy_to_adls, "copy_range", lambda *args, **kwargs: None)
+    monkeypatch.setattr(copy_to_adls, "commit_file", commit_file)
+    return commits
+
+def test_ranges_cover_the_file():
+    range_copy = copy_to_adls.RangeCopy({"name": "f", "length": 25}, 10)
+    assert [(item["offset"], item["length"]) for item in range_copy.ranges()] == [(0, 10), (10, 10), (20, 5)]
+    assert range_copy.range_count == 3
+    resumed = copy_to_adls.RangeCopy({"name": "f", "length": 25}, 10, start_offset=10)
+    assert [item["offset"] for item in resumed.ranges()] == [10, 20]
+
+def test_only_the_last_range_flushes(commits):
+    range_copy = copy_to_adls.RangeCopy({"name": "f", "length": 30}, 10)
+    ranges = list(range_copy.ranges())
+    copy_to_adls.copy_file_range("src", "dest?", ranges[2], None, None, None)
+    copy_to_adls.copy_file_range("src", "dest?", ranges[0], None, None, None)
+    assert commits == []
+    with pytest.raises(IOError):
+        copy_to_adls.copy_file_range("src", "dest?", ranges[1], None, None, None)
+    assert commits == ["f"]
+
+def test_retried_range_flushes_again(commits):
+    range_copy = copy_to_adls.RangeCopy({"name": "f", "length": 20}, 10)
+    ranges = list(range_copy.ranges())
+    copy_to_adls.copy_file_range("src", "dest?", ranges[0], None, None, None)
+    with pytest.raises(IOError):
+        copy_to_adls.copy_file_range("src", "dest?", ranges[1], None, None, None)
+    # The work queue retries the range whose flush failed
+    copy_to_adls.copy_file_range("src", "dest?", ranges[1], None, None, None)
+    assert commits == ["f", "f"]
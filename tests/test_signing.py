@@ -0,0 +1,62 @@
+import base64, hashlib, hmac, datetime
+import requests
+from adls_copy_utils import SharedKeyCredential, AccountSasToken, AdlsCopyUtils
+try:
+    from urllib.parse import parse_qsl
+except ImportError:
+    from urlparse import parse_qsl
+
+KEY = base64.b64encode(b"not a real account key").decode("utf-8")
+
+def expected_signature(string_to_sign):
+    return base64.b64encode(hmac.new(base64.b64decode(KEY), string_to_sign.encode("utf-8"), hashlib.sha256).digest()).decode("utf-8")
+
+def test_shared_key_signs_the_canonical_request():
+    request = requests.Request("PUT", "https://acct.dfs.core.windows.net/fs/dir/a%20file?resource=file&Timeout=30&comp=b&comp=a",
+        headers={"Content-Type": "application/octet-stream", "x-ms-meta-Owner": "bob", "x-ms-acl": "user::rwx"}, data=b"").prepare()
+    SharedKeyCredential("acct", KEY)(request)
+    string_to_sign = "\n".join([
+        "PUT",
+        # Content-Encoding, Content-Language & Content-Length (which is empty when it's 0)
+        "", "", "",
+        # Content-MD5, Content-Type, Date, If-Modified-Since, If-Match, If-None-Match, If-Unmodified-Since & Range
+        "", "application/octet-stream", "", "", "", "", "", "",
+        # The x-ms- headers, lower cased & sorted
+        "x-ms-acl:user::rwx",
+        "x-ms-date:" + request.headers["x-ms-date"],
+        "x-ms-meta-owner:bob",
+        "x-ms-version:" + AdlsCopyUtils.ADLS_REST_VERSION,
+        "/acct/fs/dir/a%20file",
+        # The query parameters, lower cased & sorted, with the values of repeated parameters sorted & joined
+        "comp:a,b",
+        "resource:file",
+        "timeout:30"])
+    assert request.headers["Authorization"] == "SharedKey acct:" + expected_signature(string_to_sign)
+
+def test_shared_key_signs_content_length():
+    request = requests.Request("PATCH", "https://acct.dfs.core.windows.net/fs/file?action=append&position=0", data=b"12345").prepare()
+    SharedKeyCredential("acct", KEY)(request)
+    string_to_sign = "\n".join(["PATCH", "", "", "5", "", "", "", "", "", "", "", "",
+        "x-ms-date:" + request.headers["x-ms-date"], "x-ms-version:" + AdlsCopyUtils.ADLS_REST_VERSION,
+        "/acct/fs/file", "action:append", "position:0"])
+    assert request.headers["Authorization"] == "SharedKey acct:" + expected_signature(string_to_sign)
+
+def test_account_sas_token_is_signed_with_the_account_key():
+    token = AccountSasToken(SharedKeyCredential("acct", KEY), "rl")
+    fields = dict(parse_qsl(str(token)))
+    assert (fields["sv"], fields["ss"], fields["srt"], fields["sp"]) == (AccountSasToken.SAS_VERSION, "b", "sco", "rl")
+    string_to_sign = "\n".join(["acct", "rl", "b", "sco", fields["st"], fields["se"], "", "", fields["sv"], ""])
+    assert fields["sig"] == expected_signature(string_to_sign)
+    start = datetime.datetime.strptime(fields["st"], "%Y-%m-%dT%H:%M:%SZ")
+    expiry = datetime.datetime.strptime(fields["se"], "%Y-%m-%dT%H:%M:%SZ")
+    assert expiry - start == AccountSasToken.LIFETIME + AccountSasToken.START_MARGIN
+
+def test_account_sas_token_is_regenerated_before_it_expires():
+    token = AccountSasToken(SharedKeyCredential("acct", KEY), "rl")
+    first = str(token)
+    assert str(token) is first
+    # Once within the refresh margin of its expiry, the next use generates a new token
+    token.token_refresh_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    token.token = "expired"
+    assert str(token) != "expired"
+    assert "{0}".format(token) == str(token)
@@ -0,0 +1,112 @@
+import json, threading, time
+import pytest
+from adls_copy_utils import AdlsCopyUtils, ConcurrencyController, RequestError, ThrottledError
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(AdlsCopyUtils, "RETRY_BASE_DELAY", 0.001)
+    monkeypatch.setattr(AdlsCopyUtils, "metrics", None)
+
+def test_limit_is_halved_when_throttled():
+    controller = ConcurrencyController(16)
+    controller.throttled()
+    assert int(controller.limit) == 8
+
+def test_simultaneous_throttling_is_a_single_decrease():
+    controller = ConcurrencyController(16)
+    for _ in range(5):
+        controller.throttled()
+    assert int(controller.limit) == 8
+    controller.last_decrease -= ConcurrencyController.DECREASE_INTERVAL + 1
+    controller.throttled()
+    assert int(controller.limit) == 4
+
+def test_limit_never_drops_below_1():
+    controller = ConcurrencyController(2)
+    for _ in range(5):
+        controller.last_decrease = 0
+        controller.throttled()
+    assert controller.limit == 1.0
+
+def test_limit_recovers_additively_up_to_the_maximum():
+    controller = ConcurrencyController(8)
+    controller.throttled()
+    assert int(controller.limit) == 4
+    # Approximately 1 for every 'limit' successful items
+    for _ in range(4):
+        assert controller.acquire()
+        controller.release(success=True)
+    assert int(controller.limit) == 4
+    for _ in range(100):
+        assert controller.acquire()
+        controller.release(success=True)
+    assert controller.limit == 8
+
+def test_acquire_waits_for_the_limit():
+    controller = ConcurrencyController(2)
+    assert controller.acquire()
+    assert controller.acquire()
+    assert not controller.tryAcquire()
+    assert not controller.acquire(0.05)
+    controller.release(success=True)
+    assert controller.tryAcquire()
+
+def test_close_wakes_waiting_acquirers():
+    controller = ConcurrencyController(1)
+    assert controller.acquire()
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(controller.acquire()))
+    waiter.start()
+    time.sleep(0.05)
+    controller.close()
+    waiter.join(5)
+    assert results == [False]
+
+def process(work_items, failures, tmp_path, max_retries=3):
+    # Runs a work queue whose target fails each item with the next error in failures[item], then succeeds
+    attempts = {}
+    mutex = threading.Lock()
+    def target(work_queue):
+        while not work_queue.isDone():
+            item = work_queue.nextItem()
+            if item:
+                with mutex:
+                    attempt = attempts[item["name"]] = attempts.get(item["name"], 0) + 1
+                errors = failures.get(item["name"], [])
+                if attempt <= len(errors):
+                    work_queue.itemFailed(item, errors[attempt - 1])
+                else:
+                    work_queue.itemDone()
+    dead_letter_file = tmp_path / "dead-letters.json"
+    stats = AdlsCopyUtils.processWorkQueue(target, [], work_items, 4, max_retries, str(dead_letter_file))
+    dead_letters = [json.loads(line) for line in dead_letter_file.read_text().splitlines()] if dead_letter_file.exists() else []
+    return stats, attempts, dead_letters
+
+def test_transient_failures_are_retried(tmp_path):
+    items = [{"name": "f{0}".format(idx)} for idx in range(20)]
+    failures = {"f3": [IOError("connection reset")], "f7": [ThrottledError("ServerBusy", 503), RequestError("InternalError", 500)]}
+    stats, attempts, dead_letters = process(items, failures, tmp_path)
+    assert stats == {"items": 20, "abandoned": 0}
+    assert attempts["f3"] == 2 and attempts["f7"] == 3 and attempts["f0"] == 1
+    assert dead_letters == []
+
+def test_items_are_dead_lettered_once_retries_are_exhausted(tmp_path):
+    items = [{"name": "f{0}".format(idx)} for idx in range(5)]
+    failures = {"f1": [IOError("connection reset")] * 10}
+    stats, attempts, dead_letters = process(items, failures, tmp_path, max_retries=2)
+    assert stats == {"items": 5, "abandoned": 1}
+    assert attempts["f1"] == 3
+    assert [letter["item"] for letter in dead_letters] == [{"name": "f1"}]
+
+def test_permanent_failures_are_not_retried(tmp_path):
+    items = [{"name": "f0"}, {"name": "f1"}]
+    failures = {"f0": [RequestError("AuthorizationPermissionMismatch", 403)]}
+    stats, attempts, dead_letters = process(items, failures, tmp_path)
+    assert stats["abandoned"] == 1
+    assert attempts["f0"] == 1
+    assert [letter["item"]["name"] for letter in dead_letters] == ["f0"]
+
+def test_dead_letters_can_be_replayed(tmp_path):
+    items = [{"name": "f0", "length": 10}]
+    process(items, {"f0": [RequestError("Forbidden", 403)]}, tmp_path)
+    assert list(AdlsCopyUtils.loadDeadLetters(str(tmp_path / "dead-letters.json"))) == items
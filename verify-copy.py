@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+# Verifies a copy without reading any data, by comparing the name, size & MD5 of every file in a source & destination
+# manifest. Each manifest is either a file written by 'copy-to-adls.py --manifest' or the listing of an account,
+# where the MD5 is the Content-MD5 property of each blob (copy-to-adls.py sets this on the files it copies).
+
+import sys, json, argparse, logging, itertools, heapq, tempfile, shutil, os
+from adls_copy_utils import AdlsCopyUtils, OAuthBearerToken, VerificationManifest
+
+log = logging.getLogger(__name__)
+
+RESULT_MISSING = "missing"
+RESULT_EXTRA = "extra"
+RESULT_SIZE_MISMATCH = "size_mismatch"
+RESULT_MD5_MISMATCH = "md5_mismatch"
+RESULT_MATCHED = "matched"
+RESULT_SIZE_ONLY = "size_only"
+
+# The number of manifest entries sorted in memory at a time. Larger manifests are sorted as several runs, which are
+# written to temporary files & then merged.
+SORT_RUN_SIZE = 1000000
+
+def load_manifest(file_name, run_size=SORT_RUN_SIZE):
+    # Manifests are written in completion order, so must be sorted before they can be merged. A file that was copied
+    # more than once (eg. by a re-run) has several entries - the last one wins.
+    log.info("Loading manifest: %s", file_name)
+    temp_dir = tempfile.mkdtemp(prefix="verify-copy-")
+    try:
+        runs = []
+        # Each entry is sorted by name, then by its position in the manifest
+        entries = ((entry["name"], position, entry) for position, entry in enumerate(VerificationManifest.load(file_name)))
+        while True:
+            run = sorted(itertools.islice(entries, run_size))
+            if len(run) < run_size:
+                # The last run is merged from memory
+                runs.append(run)
+                break
+            run_file = os.path.join(temp_dir, "run{0}".format(len(runs)))
+            with open(run_file, "w") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in run)
+            runs.append(read_run(run_file))
+        if len(runs) > 1:
+            log.info("Merging %d sorted runs of the manifest", len(runs))
+        previous = None
+        for name, _, entry in heapq.merge(*runs):
+            if previous is not None and previous["name"] != name:
+                yield previous
+            previous = entry
+        if previous is not None:
+            yield previous
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def read_run(file_name):
+    with open(file_name) as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+def listing_manifest(listing):
+    for entry in listing:
+        if not entry["is_folder"]:
+            yield {
+                "name": entry["name"],
+                "length": entry["length"],
+                "md5": entry.get("content_md5"),
+                "md5_type": VerificationManifest.MD5
+            }
+
+def compare_entries(source, dest):
+    if source["length"] != dest["length"]:
+        return RESULT_SIZE_MISMATCH
+    # Hashes can only be compared if they were calculated the same way
+    if (not source.get("md5") or not dest.get("md5") or 
+            source.get("md5_type") != dest.get("md5_type") or source.get("block_size") != dest.get("block_size")):
+        return RESULT_SIZE_ONLY
+    return RESULT_MATCHED if source["md5"] == dest["md5"] else RESULT_MD5_MISMATCH
+
+def verify(source, dest, report):
+    results = dict.fromkeys([RESULT_MATCHED, RESULT_SIZE_ONLY, RESULT_MISSING, RESULT_EXTRA, RESULT_SIZE_MISMATCH, RESULT_MD5_MISMATCH], 0)
+    for source_entry, dest_entry in AdlsCopyUtils.mergeListings(source, dest):
+        if dest_entry is None:
+            result = RESULT_MISSING
+        elif source_entry is None:
+            result = RESULT_EXTRA
+        else:
+            result = compare_entries(source_entry, dest_entry)
+        results[result] += 1
+        if report and result not in (RESULT_MATCHED, RESULT_SIZE_ONLY):
+            report.write(json.dumps({"result": result, "source": source_entry, "dest": dest_entry}) + "\n")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Verify a copy by comparing the size & MD5 of each file in the source & destination manifests")
+    parser.add_argument('--source-manifest', help="A manifest file describing the source. If omitted, the source account is listed.")
+    parser.add_argument('--dest-manifest', help="A manifest file written by copy-to-adls.py. If omitted, the destination account is listed.")
+    parser.add_argument('-s', '--source-account', help="The name of the source storage account")
+    parser.add_argument('-k', '--source-key', help="The source storage account key")
+    parser.add_argument('-c', '--source-container', help="The name of the source storage account container")
+    parser.add_argument('-A', '--dest-account', help="The name of the destination storage account")
+    parser.add_argument('-C', '--dest-container', help="The name of the destination storage container")
+    parser.add_argument('-I', '--dest-spn-id', help="The client id for the service principal used to authenticate to the destination account")
+    parser.add_argument('-S', '--dest-spn-secret', help="The client secret for the service principal used to authenticate to the destination account")
+    parser.add_argument('-p', '--prefix', default="", help="A prefix that constrains the listed files")
+    parser.add_argument('-r', '--report', help="The name of a file to write each missing, extra or mismatched file to (one JSON object per line)")
+    parser.add_argument('-f', '--log-config', help="The name of a configuration file for logging.")
+    parser.add_argument('-l', '--log-file', help="Name of file to have log output written to (default is stdout/stderr)")
+    parser.add_argument('-v', '--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="Level of log information to output. Default is 'INFO'.")
+    args = parser.parse_known_args()[0]
+
+    AdlsCopyUtils.configureLogging(args.log_config, args.log_level, args.log_file)
+    AdlsCopyUtils.configureHttpSessions(2)
+
+    if args.source_manifest:
+        source = load_manifest(args.source_manifest)
+    elif args.source_account and args.source_key and args.source_container:
+        sas_token = AdlsCopyUtils.getSasToken(args.source_account, args.source_key)
+        source = listing_manifest(AdlsCopyUtils.getSourceFileList(args.source_account, sas_token, args.source_container, args.prefix))
+    else:
+        parser.error("Either --source-manifest or the source account must be specified")
+
+    if args.dest_manifest:
+        dest = load_manifest(args.dest_manifest)
+    elif args.dest_account and args.dest_container and args.dest_spn_id and args.dest_spn_secret:
+        token_handler = OAuthBearerToken(args.dest_spn_id, args.dest_spn_secret)
+        dest = listing_manifest(AdlsCopyUtils.getDestinationFileList(args.dest_account, args.dest_container, token_handler, args.prefix))
+    else:
+        parser.error("Either --dest-manifest or the destination account must be specified")
+
+    report = open(args.report, "w") if args.report else None
+    try:
+        results = verify(source, dest, report)
+    finally:
+        if report:
+            report.close()
+    log.info("Verified: %d matching MD5, %d matching size (no comparable MD5). Failed: %d missing, %d size mismatches, %d MD5 mismatches. %d only in the destination.",
+        results[RESULT_MATCHED], results[RESULT_SIZE_ONLY], results[RESULT_MISSING], results[RESULT_SIZE_MISMATCH], results[RESULT_MD5_MISMATCH], results[RESULT_EXTRA])
+    if results[RESULT_MISSING] or results[RESULT_SIZE_MISMATCH] or results[RESULT_MD5_MISMATCH]:
+        sys.exit(1)